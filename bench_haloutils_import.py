@@ -0,0 +1,38 @@
+"""
+Startup benchmark for haloutils.
+
+Usage: python bench_haloutils_import.py [repeats]
+
+Times 'import haloutils' in fresh interpreters (what every worker of a job
+array pays), then the same import followed by touching every lazily imported
+module, which is what the import used to cost up front.
+CATERPILLAR_BASEPATH is set to a dummy path so this runs on any host.
+"""
+import os
+import sys
+import subprocess
+import time
+import numpy as np
+
+IMPORT_ONLY = "import haloutils"
+IMPORT_ALL = "import haloutils as h\nfor m in [h.asciitable,h.pd,h.rsg,h.RDR,h.RSF,h.MTC,h.bconversions,h.plt]: m.__name__"
+
+def time_python(code,repeats):
+    env = dict(os.environ)
+    env.setdefault('CATERPILLAR_BASEPATH','/tmp')
+    env['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))+os.pathsep+env.get('PYTHONPATH','')
+    times = []
+    for i in xrange(repeats):
+        start = time.time()
+        subprocess.check_call([sys.executable,'-c',code],env=env)
+        times.append(time.time()-start)
+    return np.median(times)
+
+if __name__=="__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    empty = time_python("pass",repeats)
+    lazy = time_python(IMPORT_ONLY,repeats)
+    full = time_python(IMPORT_ALL,repeats)
+    print "median of {0} fresh interpreters (interpreter startup {1:.3f} sec subtracted)".format(repeats,empty)
+    print "  import haloutils:                   {0:.3f} sec".format(lazy-empty)
+    print "  import haloutils + all lazy modules: {0:.3f} sec".format(full-empty)
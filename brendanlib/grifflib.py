@@ -2542,10 +2542,10 @@ def get_pos_mass_hsml_render(hpath,zoomid,idlist,snapshot):
 
     print "Number of particles in snapshot",snapshot,"is",header.npart[1]
     #print "Number of particles in fg/mh to render for this snapshot",len(idlist)
-    pos = htils.load_partblock(hpath,snapshot,"POS ",parttype=1,ids=idlist).astype('float32')
+    pos,mass,ids = htils.load_partblocks(hpath,snapshot,["POS ","MASS","ID  "],parttype=1,ids=idlist)
+    pos = pos.astype('float32')
     pos -= center_arr
-    mass = htils.load_partblock(hpath,snapshot,"MASS",parttype=1,ids=idlist).astype('float32')*1e10/header.hubble
-    ids = htils.load_partblock(hpath,snapshot,"ID  ",parttype=1,ids=idlist)
+    mass = mass.astype('float32')*1e10/header.hubble
     
     #if os.path.isdir(hpath+"/outputs/hsmldir_"+str(snapshot).zfill(3)):
     #    print "Loading them from file: outputs/hsmldir_"+str(snapshot).zfill(3)
@@ -2596,8 +2596,9 @@ def get_pos_mass_hsml(hpath,zoomid,snapshot,img_width_nrvir,img_width=0,nth_halo
     #print pos_host
     
     t0 = time.clock()
-    pos = htils.load_partblock(hpath,snapshot,"POS ",parttype=1).astype('float32')
-    mass = htils.load_partblock(hpath,snapshot,"MASS",parttype=1).astype('float32')*1e10/header.hubble
+    pos,mass = htils.load_partblocks(hpath,snapshot,["POS ","MASS"],parttype=1)
+    pos = pos.astype('float32')
+    mass = mass.astype('float32')*1e10/header.hubble
     t1 = time.clock()
 
     print "[ > reading positions, masses, smoothing lengths: %3.2f minutes ]" % ((t1-t0)/60.)
@@ -3052,9 +3053,9 @@ def create_fullbox_render(sim_path,snapshot=127,img_res=2048,lx=14,projection='a
 
     header = htils.get_halo_header(sim_path,snap=snapshot)
 
-    pos = htils.load_partblock(sim_path,snapshot,"POS ",parttype=1).astype('float32')
-    mass = htils.load_partblock(sim_path,snapshot,"MASS",parttype=1).astype('float32')*1e10/header.hubble
-    ids = htils.load_partblock(sim_path,snapshot,"ID  ",parttype=1)
+    pos,mass,ids = htils.load_partblocks(sim_path,snapshot,["POS ","MASS","ID  "],parttype=1)
+    pos = pos.astype('float32')
+    mass = mass.astype('float32')*1e10/header.hubble
 
     center = np.array([header.boxwidth/2.,header.boxwidth/2.,header.boxwidth/2.], dtype="float32")
 
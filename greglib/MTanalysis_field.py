@@ -73,9 +73,12 @@ def getM_xcrit(hpath,pids,cat,rsid,delta=350):
 def get_field_halos(cat,hpath,hostID,mlow=10,mhigh=11.5):
     # get halos beyond host halo virial radius, but less than
     # contamination radius                     
-    hosts = cat.get_hosts()
-    dists = dm.distance(cat.ix[hostID][['posX','posY','posZ']], hosts[['posX','posY','posZ']])
+    # only look at halos in the contamination sphere (periodic KD-tree ball query)
     contam_dist = dm.get_contam_dist(hpath)
+    rows,offsets = cat.query_ball(np.array(cat.ix[hostID][['posX','posY','posZ']]),contam_dist)
+    hosts = cat.data.iloc[rows]
+    hosts = hosts[hosts['hostID']==-1]
+    dists = dm.distance(cat.ix[hostID][['posX','posY','posZ']], hosts[['posX','posY','posZ']])
     mask = (dists < contam_dist)&(dists > .001)
     mass_mask = (10**mlow < hosts['mgrav']/cat.h0) &(10**mhigh > hosts['mgrav']/cat.h0)
     return hosts[mask & mass_mask]
@@ -316,51 +319,39 @@ class AllExtantFieldData(PluginBase):
         dataE = ED.read(hpath)
         dtype = ['max_mass_mgrav','infall_mgrav','max_mass_hostid_RS','infall_hostid_RS','max_mass200','infall_mass200','max_mass350', 'max_mass350NFW']
         data_newE = pandas.DataFrame(np.zeros((len(dataE),len(dtype)))-1,columns=dtype)
+        # each catalogue is loaded once; scalar columns come from series.get while it is resident
+        series = haloutils.RockstarSeries(hpath,maxcats=2,rmaxcut=False)
+        columns = ['mgrav','hostID','altm2']
         maxmass_dataE = {}
         for maxmass_snap,line in zip(dataE['max_mass_snap'],dataE.index):
             maxmass_dataE.setdefault(maxmass_snap, []).append(line)
-
         infall_dataE = {}
         for infallsnap,line in zip(dataE['infall_snap'],dataE.index):
             infall_dataE.setdefault(infallsnap, []).append(line)
 
-        # initialize arrays for tagging                                                                                           
-        allstars=[]; start_pos=0
-
         for snap in range(haloutils.get_numsnaps(hpath)):
             sys.stdout.flush()
             if maxmass_dataE.has_key(snap) or infall_dataE.has_key(snap):
-                cat=haloutils.load_rscat(hpath,snap,rmaxcut=False)
+                cat = series[snap]
                 print snap, 'snap in get extra parameters Extant'
                 if maxmass_dataE.has_key(snap):
-                    for line in maxmass_dataE[snap]:
+                    lines = maxmass_dataE[snap]
+                    maxmass = series.get(snap,dataE.ix[lines,'max_mass_rsid'],columns).fillna(-1)
+                    data_newE.ix[lines,'max_mass_mgrav'] = maxmass['mgrav'].values
+                    data_newE.ix[lines,'max_mass_hostid_RS'] = maxmass['hostID'].values
+                    data_newE.ix[lines,'max_mass200'] = maxmass['altm2'].values
+                    for line in lines:
                         maxmass_rsid = int(dataE.ix[line]['max_mass_rsid'])
-                        data_newE.ix[line]['max_mass_mgrav'] = cat.ix[maxmass_rsid]['mgrav']
-                        data_newE.ix[line]['max_mass_hostid_RS'] = cat.ix[maxmass_rsid]['hostID']
-                        data_newE.ix[line]['max_mass200'] = cat.ix[maxmass_rsid]['altm2']
-                        
                         pids = cat.get_all_particles_from_halo(maxmass_rsid)
                         m350,m350NFW = getM_xcrit(hpath,pids,cat,maxmass_rsid,delta=350)
-                        data_newE.ix[line]['max_mass350'] = m350
-                        data_newE.ix[line]['max_mass350NFW'] = m350NFW
-                        #print cat.ix[maxmass_rsid]['mgrav']/cat.h0, 'max mass mgrav'
-                        #print m350/cat.h0, 'max mass m350'
-                        #print m350NFW/cat.h0, 'max mass m350 NFW'
-                        #print cat.ix[maxmass_rsid]['altm2']/cat.h0, 'max mass 200'
-
+                        data_newE.ix[line,'max_mass350'] = m350
+                        data_newE.ix[line,'max_mass350NFW'] = m350NFW
                 if infall_dataE.has_key(snap):
-                    for line in infall_dataE[snap]:
-                        infall_rsid = int(dataE.ix[line]['infall_rsid'])
-                        data_newE.ix[line]['infall_mgrav'] = cat.ix[infall_rsid]['mgrav']
-                        data_newE.ix[line]['infall_hostid_RS'] = cat.ix[infall_rsid]['hostID']
-                        data_newE.ix[line]['infall_mass200'] = cat.ix[infall_rsid]['altm2']
-
-                        #iPids = cat.get_all_particles_from_halo(infall_rsid)
-                        #star_pids = iPids[0:int(np.round(len(iPids)*frac_to_tag))]
-                        #data_newE.ix[line]['nstars'] = len(star_pids)
-                        #data_newE.ix[line]['start_pos'] = start_pos
-                        #allstars=np.r_[allstars,star_pids]
-                        #start_pos+=len(star_pids)
+                    lines = infall_dataE[snap]
+                    infall = series.get(snap,dataE.ix[lines,'infall_rsid'],columns).fillna(-1)
+                    data_newE.ix[lines,'infall_mgrav'] = infall['mgrav'].values
+                    data_newE.ix[lines,'infall_hostid_RS'] = infall['hostID'].values
+                    data_newE.ix[lines,'infall_mass200'] = infall['altm2'].values
 
         fulldataE = pandas.concat((dataE,data_newE),axis=1)
         fulldataE.to_csv(hpath+'/'+self.OUTPUTFOLDERNAME+'/'+self.filename,sep='\t')
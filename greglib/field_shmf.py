@@ -120,9 +120,12 @@ def max_mass350_function(hpath,cat,haloid,target_halo_mass=1e12):
 def get_field_halos(cat,hpath,hostID,mlow=10,mhigh=11.5):
     # get halos beyond host halo virial radius, but less than 
     # contamination radius
-    hosts = cat.get_hosts()
-    dists = dm.distance(cat.ix[hostID][['posX','posY','posZ']], hosts[['posX','posY','posZ']])
+    # only look at halos in the contamination sphere (periodic KD-tree ball query)
     contam_dist = dm.get_contam_dist(hpath)
+    rows,offsets = cat.query_ball(np.array(cat.ix[hostID][['posX','posY','posZ']]),contam_dist)
+    hosts = cat.data.iloc[rows]
+    hosts = hosts[hosts['hostID']==-1]
+    dists = dm.distance(cat.ix[hostID][['posX','posY','posZ']], hosts[['posX','posY','posZ']])
     mask = dists < contam_dist
     mass_mask = (10**mlow < hosts['mgrav']/cat.h0) &(10**mhigh > hosts['mgrav']/cat.h0)
     return hosts[mask & mass_mask]
@@ -1,26 +1,58 @@
-import os,sys,platform
-# Allow plot creation on antares
-if 'compute-0-' in platform.node():
-    import matplotlib
-    matplotlib.use('Agg')
+import os,sys,platform,shutil
+import importlib
 
 import numpy as np
-import asciitable
 #import pickle
 import cPickle as pickle
-import pandas as pd
 import warnings
 import glob
 from multiprocessing import Pool
-import time,subprocess,itertools
+import time,subprocess,itertools,signal
+from collections import OrderedDict
 #import seaborn as sns
 
-import readsnapshots.readsnapHDF5_greg as rsg
-import readhalos.RSDataReader as RDR
-import readhalos.readsubf as RSF
-import mergertrees.MTCatalogue as MTC
-import brendanlib.conversions as bconversions
-import pylab as plt
+class _LazyModule(object):
+    """
+    Stands in for a module and imports it on first attribute access, so
+    importing haloutils does not pay for pylab, pandas, the readers, etc.
+    """
+    def __init__(self,name,loader=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_loader'] = loader
+        self.__dict__['_module'] = None
+    def __getattr__(self,attr):
+        if self.__dict__['_module'] is None:
+            if self._loader != None:
+                self.__dict__['_module'] = self._loader()
+            else:
+                self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(self.__dict__['_module'],attr)
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return "<lazy module '{0}' ({1})>".format(self._name,state)
+
+cdict = {'red'  :  ((0., 0., 0.),     (0.3,0,0),     (0.6, 0.8, 0.8), (1., 1., 1.)),
+'green':  ((0., 0., 0.),     (0.3,0.3,0.3), (0.6, 0.4, 0.4), (1., 1.0, 1.0)),
+'blue' :  ((0., 0.05, 0.05), (0.3,0.5,0.5), (0.6, 0.6, 0.6), (1.0, 1.0, 1.0))}
+
+def _import_pylab():
+    # Allow plot creation on antares
+    if 'compute-0-' in platform.node():
+        import matplotlib
+        matplotlib.use('Agg')
+    import pylab
+    cmap = pylab.matplotlib.colors.LinearSegmentedColormap('dmdens_cmap', cdict, 1024)
+    pylab.cm.register_cmap(name='caterpillar', cmap=cmap)
+    return pylab
+
+asciitable = _LazyModule('asciitable')
+pd = _LazyModule('pandas')
+rsg = _LazyModule('readsnapshots.readsnapHDF5_greg')
+RDR = _LazyModule('readhalos.RSDataReader')
+RSF = _LazyModule('readhalos.readsubf')
+MTC = _LazyModule('mergertrees.MTCatalogue')
+bconversions = _LazyModule('brendanlib.conversions')
+plt = _LazyModule('pylab',_import_pylab)
 
 def determinebasepath(node):
     if node == "csr-dyn-150.mit.edu":
@@ -36,21 +68,32 @@ def determinebasepath(node):
     elif 'compute-0-' in node:
         basepath = '/bigbang/data/AnnaGroup/'
     else:
-        raise ValueError(node+" is not a valid node")
+        raise ValueError(node+" is not a valid node (set CATERPILLAR_BASEPATH)")
         
     return basepath
 
-cdict = {'red'  :  ((0., 0., 0.),     (0.3,0,0),     (0.6, 0.8, 0.8), (1., 1., 1.)),
-'green':  ((0., 0., 0.),     (0.3,0.3,0.3), (0.6, 0.4, 0.4), (1., 1.0, 1.0)),
-'blue' :  ((0., 0.05, 0.05), (0.3,0.5,0.5), (0.6, 0.6, 0.6), (1.0, 1.0, 1.0))}
-
-cmap = plt.matplotlib.colors.LinearSegmentedColormap('dmdens_cmap', cdict, 1024)
-plt.cm.register_cmap(name='caterpillar', cmap=cmap)
-
-
-global_basepath = os.path.normpath(determinebasepath(platform.node()))
-global_halobase = global_basepath+'/caterpillar/halos'
-global_prntbase = global_basepath+'/caterpillar/parent/gL100X10'
+# The base paths are resolved on first use by get_basepath/get_halobase/get_prntbase.
+# There are no global_basepath/global_halobase/global_prntbase attributes to read;
+# assigning one (e.g. haloutils.global_halobase = path) overrides the matching getter.
+_basepath = None
+def get_basepath():
+    """
+    $CATERPILLAR_BASEPATH if set, otherwise determined from the hostname
+    """
+    global _basepath
+    if 'global_basepath' in globals(): return global_basepath
+    if _basepath == None:
+        if 'CATERPILLAR_BASEPATH' in os.environ:
+            _basepath = os.path.normpath(os.environ['CATERPILLAR_BASEPATH'])
+        else:
+            _basepath = os.path.normpath(determinebasepath(platform.node()))
+    return _basepath
+def get_halobase():
+    if 'global_halobase' in globals(): return global_halobase
+    return get_basepath()+'/caterpillar/halos'
+def get_prntbase():
+    if 'global_prntbase' in globals(): return global_prntbase
+    return get_basepath()+'/caterpillar/parent/gL100X10'
 
 
 cid2hid = {1:1631506,
@@ -157,14 +200,152 @@ def hidstr(hid):
         return 'H'+hid
     raise ValueError("hid must be int or str, is "+str(type(hid)))
 
-def get_parent_zoom_index(filename=global_halobase+"/parent_zoom_index.txt"):
-    return asciitable.read(filename, Reader=asciitable.FixedWidth)
+_parent_zoom_index = {}
+def _get_parent_zoom_index(filename):
+    """
+    @return: table, rowdict. rowdict maps (parentid,ictype,LX,NV) to the list of rows of table.
+             Parsed once per process and again only if the file's mtime changes.
+    """
+    mtime = os.path.getmtime(filename)
+    if filename not in _parent_zoom_index or _parent_zoom_index[filename][0] != mtime:
+        htable = asciitable.read(filename, Reader=asciitable.FixedWidth)
+        rowdict = {}
+        for i,key in enumerate(zip(htable['parentid'],htable['ictype'],htable['LX'],htable['NV'])):
+            rowdict.setdefault((int(key[0]),key[1],int(key[2]),int(key[3])),[]).append(i)
+        _parent_zoom_index[filename] = (mtime,htable,rowdict)
+    return _parent_zoom_index[filename][1:]
+def get_parent_zoom_index(filename=None):
+    """
+    @param filename: default get_halobase()+"/parent_zoom_index.txt"
+    The returned table is shared between calls, copy it before modifying it
+    """
+    if filename == None: filename = get_halobase()+"/parent_zoom_index.txt"
+    return _get_parent_zoom_index(filename)[0]
+def _list_directory(path):
+    listing = {}
+    for name in os.listdir(path):
+        listing[name] = os.path.isdir(path+'/'+name)
+    return listing
+def _count_lines(path):
+    return sum(1 for line in open(path))
+def _read_sorted_flag(path):
+    h = rsg.snapshot_header(path)
+    try:
+        return h.sorted=='yes'
+    except:
+        return False
+
+class HaloPathInventory(object):
+    """
+    Persistent cache of directory listings (snapdirs, rockstar, subfind and tree
+    folders of every hpath) and of per-file values (number of snaps, sorted flag).
+    Directory entries are keyed by the directory mtime, file values by the file
+    mtime and size. An entry is re-checked with one stat at most every maxage
+    seconds, and only re-listed/recomputed if that stamp changed, so path
+    filtering over the whole suite is an in-memory query.
+    Listings hold names only: a file growing or being truncated in place does not
+    change the directory mtime, so file sizes are never cached here.
+    """
+    version = 2
+    def __init__(self,filename=None,maxage=600):
+        """
+        @param filename: pickle file the inventory is loaded from and saved to (None: not persistent)
+        @param maxage: seconds an entry is trusted without a stat (0: always check)
+        """
+        self.filename = filename
+        self.maxage = maxage
+        self.entries = {}
+        self._dirty = False
+        if filename != None and os.path.exists(filename):
+            try:
+                with open(filename,'rb') as f:
+                    version,entries = pickle.load(f)
+                if version == self.version: self.entries = entries
+            except (IOError,EOFError,ValueError,TypeError,pickle.UnpicklingError):
+                self.entries = {}
+
+    def _lookup(self,key,path,compute,isdir):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry != None and now-entry[0] < self.maxage:
+            return entry[2]
+        try:
+            st = os.stat(path)
+            stamp = st.st_mtime if isdir else (st.st_mtime,st.st_size)
+            # mtimes have coarse resolution; don't trust a stamp from the last couple of seconds
+            if now-st.st_mtime < 2: stamp = None
+        except OSError:
+            st = None; stamp = None
+        if entry != None and stamp != None and entry[1] == stamp:
+            self.entries[key] = (now,stamp,entry[2])
+            return entry[2]
+        value = None
+        if st != None:
+            try:
+                value = compute(path)
+            except (IOError,OSError):
+                value = None
+        self.entries[key] = (now,stamp,value)
+        self._dirty = True
+        return value
+
+    def listdir(self,path):
+        """
+        @return: dict name -> isdir of the contents of path, None if it is not a directory
+        """
+        return self._lookup(('listdir',path),path,_list_directory,True)
+    def filevalue(self,path,func):
+        """
+        @return: func(path), recomputed only when the file changes; None if it does not exist
+        """
+        return self._lookup((func.__name__,path),path,func,False)
+    def exists(self,path):
+        listing = self.listdir(os.path.dirname(path))
+        return listing != None and os.path.basename(path) in listing
+    def isdir(self,path):
+        listing = self.listdir(os.path.dirname(path))
+        return listing != None and listing.get(os.path.basename(path),False)
+
+    def refresh(self):
+        """
+        Re-check every entry now: directories are re-listed if their mtime changed,
+        file values are re-checked on their next use.
+        """
+        for key,(checktime,stamp,value) in self.entries.items():
+            self.entries[key] = (0,stamp,value)
+        for key in self.entries.keys():
+            if key[0]=='listdir': self.listdir(key[1])
+    def save(self):
+        """ Write the inventory to self.filename if anything changed """
+        if self.filename == None or not self._dirty: return
+        tmpname = self.filename+'.tmp'+str(os.getpid())
+        try:
+            with open(tmpname,'wb') as f:
+                pickle.dump((self.version,self.entries),f,pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpname,self.filename)
+            self._dirty = False
+        except (IOError,OSError) as e:
+            warnings.warn("Could not save halo path inventory "+self.filename+": "+str(e))
+            if os.path.exists(tmpname): os.remove(tmpname)
+
+_inventory = None
+def get_inventory():
+    """
+    The HaloPathInventory used by find_halo_paths and friends, stored in
+    get_halobase()/.hpath_inventory.p
+    """
+    global _inventory
+    if _inventory == None:
+        _inventory = HaloPathInventory(get_halobase()+'/.hpath_inventory.p')
+    return _inventory
+
 def get_numsnaps(outpath):
     """
     Uses hpath/ExpansionList to get the number of snaps in this halo
     """
-    if os.path.exists(outpath+'/ExpansionList'):
-        return sum(1 for line in open(outpath+'/ExpansionList'))
+    numsnaps = get_inventory().filevalue(outpath+'/ExpansionList',_count_lines)
+    if numsnaps != None:
+        return numsnaps
     else:
         warnings.warn(outpath+"/ExpansionList not found, using default (256)")
         return 256
@@ -181,7 +362,8 @@ def get_zoom_params(outpath):
     """ return ictype, LX, NV """
     split = get_foldername(outpath).split('_')
     return split[1],int(split[5][2:]),int(split[7][2:])
-def get_outpath(haloid,ictype,lx,nv,contamtype=None,halobase=global_halobase,check=True):
+def get_outpath(haloid,ictype,lx,nv,contamtype=None,halobase=None,check=True):
+    if halobase == None: halobase = get_halobase()
     haloid = hidstr(haloid); ictype = ictype.upper()
     outpath = halobase+'/'+haloid+'/'+haloid+'_'+ictype+'_'+'Z127_P7_LN7_LX'+str(lx)+'_O4_NV'+str(nv)
     if contamtype != None:
@@ -189,8 +371,8 @@ def get_outpath(haloid,ictype,lx,nv,contamtype=None,halobase=global_halobase,che
     if check and not os.path.exists(outpath):
         raise IOError("Invalid hpath")
     return outpath
-def get_hpath(haloid,ictype,lx,nv,contamtype=None,halobase=global_halobase,check=True):
-    return get_outpath(haloid,ictype,lx,nv,contamtype=contamtype,halobase=global_halobase,check=check)
+def get_hpath(haloid,ictype,lx,nv,contamtype=None,halobase=None,check=True):
+    return get_outpath(haloid,ictype,lx,nv,contamtype=contamtype,halobase=halobase,check=check)
 
 def get_hpath_lx(hid,do_lx):
     lxpaths = get_lxlist(hid,gethpaths=True)
@@ -202,55 +384,85 @@ def get_paper_paths_lx(do_lx):
     return [get_hpath_lx(cid2hid[i+1],do_lx) for i in np.arange(24)] #[get_hpath_lx(hid,do_lx) for hid in hid2name.keys()]
 
 def get_paper_paths():
-    return [global_halobase+"/H"+str(hid) for hid in hid2name.keys()]
+    return [get_halobase()+"/H"+str(hid) for hid in hid2name.keys()]
 def get_good_paper_paths():
-    hpaths = [global_halobase+"/H"+str(hid) for hid in hid2name.keys()]
-    hpaths.remove(global_halobase+"/H95289")
+    hpaths = [get_halobase()+"/H"+str(hid) for hid in hid2name.keys()]
+    hpaths.remove(get_halobase()+"/H95289")
     return hpaths
 
-def get_scale_snap(hpath,snaps):
+def _read_scales(path):
+    return np.atleast_1d(np.loadtxt(path,usecols=(0,)))
+_snap_tables = {}
+def get_snap_table(hpath,OmegaM=.3175,OmegaL=.6825,h=.6711):
+    """
+    @return: structured array with scale, redshift, time and lookback (Gyr) for every snap of hpath.
+             Built once per hpath and cosmology; ExpansionList is re-read only when it changes.
+    """
+    scales = get_inventory().filevalue(hpath+'/ExpansionList',_read_scales)
+    if scales is None:
+        raise IOError(hpath+"/ExpansionList not found")
+    key = (hpath,OmegaM,OmegaL,h)
+    if key not in _snap_tables or _snap_tables[key][0] is not scales:
+        table = np.zeros(len(scales),dtype=[('scale',float),('redshift',float),('time',float),('lookback',float)])
+        table['scale'] = scales
+        table['redshift'] = 1./scales - 1.0
+        table['time'] = bconversions.GetTime(scales,OmegaM=OmegaM,OmegaL=OmegaL,h=h)
+        table['lookback'] = bconversions.GetTime(1.,OmegaM=OmegaM,OmegaL=OmegaL,h=h) - table['time']
+        _snap_tables[key] = (scales,table)
+    return _snap_tables[key][1]
+def _lookup_snaps(table,column,snaps):
+    """
+    table[column] at each snap; NaN for snaps that are NaN or negative (e.g. -1)
+    """
     snaps = np.ravel(snaps)
-    if type(snaps[0]) == np.float64 or type(snaps[0])==np.float:
-        badii = np.isnan(snaps)
+    if snaps.dtype.kind == 'f':
+        badii = np.isnan(snaps) | (snaps < 0)
     else:
         badii = snaps < 0
     goodii = ~badii
     assert np.all(snaps[goodii].astype(int)==snaps[goodii]),'Snaps must be integers'
-    snaps = snaps.astype(int)
-    snaps[badii] = -1
-
-    numsnaps = get_numsnaps(hpath)
-    assert np.all(snaps[goodii] < numsnaps) and np.all(snaps[goodii] >= 0), "Snaps must be between 0 and {0}".format(numsnaps-1)
-    with open(hpath+'/ExpansionList','r') as f:
-        lines = f.readlines()
-    #assert(len(lines))==numsnaps
-    def _get_scale_snap(snap):
-        if snap == -1: return np.nan
-        return float(lines[snap].split()[0])
-    return np.array(map(_get_scale_snap,snaps))
+    goodsnaps = snaps[goodii].astype(int)
+    numsnaps = len(table)
+    assert np.all(goodsnaps < numsnaps), "Snaps must be between 0 and {0}".format(numsnaps-1)
+    values = np.zeros(len(snaps))+np.nan
+    values[goodii] = table[column][goodsnaps]
+    return values
+def get_scale_snap(hpath,snaps):
+    return _lookup_snaps(get_snap_table(hpath),'scale',snaps)
 def get_z_snap(hpath,snap):
-    scale = get_scale_snap(hpath,snap)
-    return (1./scale) - 1.0
+    return _lookup_snaps(get_snap_table(hpath),'redshift',snap)
 def get_t_snap(hpath,snap,OmegaM=.3175,OmegaL=.6825,h=.6711):
-    scale = get_scale_snap(hpath,snap)
-    return bconversions.GetTime(scale,OmegaM=OmegaM,OmegaL=OmegaL,h=h)
+    return _lookup_snaps(get_snap_table(hpath,OmegaM=OmegaM,OmegaL=OmegaL,h=h),'time',snap)
+def get_lookback_snap(hpath,snap,OmegaM=.3175,OmegaL=.6825,h=.6711):
+    return _lookup_snaps(get_snap_table(hpath,OmegaM=OmegaM,OmegaL=OmegaL,h=h),'lookback',snap)
 
 def get_available_hpaths(hid,contam=False,
                          checkgadget=True,
                          onlychecklastsnap=True,
                          checkallblocks=False,
                          hdf5=True,verbose=False,
-                         basepath=global_halobase,
+                         basepath=None,
                          hires=False):
+    hpathlist = _available_hpaths(hid,contam=contam,checkgadget=checkgadget,
+                                  onlychecklastsnap=onlychecklastsnap,checkallblocks=checkallblocks,
+                                  hdf5=hdf5,verbose=verbose,basepath=basepath,hires=hires)
+    get_inventory().save()
+    return hpathlist
+def _available_hpaths(hid,contam=False,checkgadget=True,onlychecklastsnap=True,checkallblocks=False,
+                      hdf5=True,verbose=False,basepath=None,hires=False):
+    """ get_available_hpaths without saving the inventory (find_halo_paths saves once at the end) """
+    if basepath == None: basepath = get_halobase()
     hidpath = basepath+'/'+hidstr(hid)
     if contam: hidpath += '/contamination_suite'
-    if not os.path.exists(hidpath):
+    inventory = get_inventory()
+    listing = inventory.listdir(hidpath)
+    if listing == None:
         raise IOError("Invalid hid: "+hidpath)
     hpathlist = []
-    for foldername in os.listdir(hidpath):
+    for foldername in sorted(listing):
         if foldername[0] != 'H': continue
         hpath = hidpath+'/'+foldername
-        if not os.path.isdir(hpath): continue
+        if not listing[foldername]: continue
         try:
             if checkgadget and not gadget_finished(hpath,onlychecklastsnap=onlychecklastsnap,
                                                    checkallblocks=checkallblocks,hdf5=hdf5,
@@ -276,21 +488,23 @@ def get_lxlist(hid,gethpaths=False):
 def check_last_subfind_exists(outpath):
     numsnaps = get_numsnaps(outpath)
     lastsnap = numsnaps - 1; snapstr = str(lastsnap).zfill(3)
-    group_tab = os.path.exists(outpath+'/outputs/groups_'+snapstr+'/group_tab_'+snapstr+'.0')
-    subhalo_tab = os.path.exists(outpath+'/outputs/groups_'+snapstr+'/subhalo_tab_'+snapstr+'.0')
+    inventory = get_inventory()
+    group_tab = inventory.exists(outpath+'/outputs/groups_'+snapstr+'/group_tab_'+snapstr+'.0')
+    subhalo_tab = inventory.exists(outpath+'/outputs/groups_'+snapstr+'/subhalo_tab_'+snapstr+'.0')
     return group_tab and subhalo_tab
 
 def check_rockstar_exists(outpath,snap,boundbin=True,fullbin=False,particles=False):
     snapstr = str(snap)
+    inventory = get_inventory()
     if fullbin:
-        halo_exists = os.path.exists(outpath+'/halos/halos_'+snapstr+'/halos_'+snapstr+'.0.fullbin')
+        halo_exists = inventory.exists(outpath+'/halos/halos_'+snapstr+'/halos_'+snapstr+'.0.fullbin')
     elif boundbin:
-        halo_exists = os.path.exists(outpath+'/halos_bound/halos_'+snapstr+'/halos_'+snapstr+'.0.boundbin')
+        halo_exists = inventory.exists(outpath+'/halos_bound/halos_'+snapstr+'/halos_'+snapstr+'.0.boundbin')
     else:
-        halo_exists = os.path.exists(outpath+'/halos/halos_'+snapstr+'/halos_'+snapstr+'.0.bin')
+        halo_exists = inventory.exists(outpath+'/halos/halos_'+snapstr+'/halos_'+snapstr+'.0.bin')
     if not particles:
         return halo_exists
-    part_exists = os.path.exists(outpath+'/halos/halos_'+snapstr+'/halos_'+snapstr+'.0.particles')
+    part_exists = inventory.exists(outpath+'/halos/halos_'+snapstr+'/halos_'+snapstr+'.0.particles')
     return halo_exists and part_exists
 
 def check_last_rockstar_exists(outpath,boundbin=True,fullbin=False,particles=False):
@@ -301,8 +515,9 @@ def check_last_rockstar_exists(outpath,boundbin=True,fullbin=False,particles=Fal
 def check_mergertree_exists(outpath,autoconvert=False,boundbin=True,treedir='trees'):
     if boundbin: halodir = 'halos_bound'
     else: halodir = 'halos'
-    ascii_exists = os.path.exists(outpath+'/'+halodir+'/'+treedir+'/tree_0_0_0.dat')
-    binary_exists = os.path.exists(outpath+'/'+halodir+'/'+treedir+'/tree.bin')
+    inventory = get_inventory()
+    ascii_exists = inventory.exists(outpath+'/'+halodir+'/'+treedir+'/tree_0_0_0.dat')
+    binary_exists = inventory.exists(outpath+'/'+halodir+'/'+treedir+'/tree.bin')
     if autoconvert and ascii_exists and not binary_exists:
         print "---check_mergertree_exists: Automatically converting ascii to binary"
         MTC.convertmt(outpath+'/'+halodir+'/'+treedir,version=4)
@@ -314,11 +529,7 @@ def check_is_sorted(outpath,snap=0,hdf5=True):
     snap = str(snap).zfill(3)
     filename = outpath+'/outputs/snapdir_'+snap+'/snap_'+snap+'.0'
     if hdf5: filename += '.hdf5'
-    h = rsg.snapshot_header(filename)
-    try:
-        if h.sorted=='yes': return True
-    except:
-        return False
+    return bool(get_inventory().filevalue(filename,_read_sorted_flag))
 
 def gadget_finished(outpath,
                     onlychecklastsnap=False,
@@ -330,28 +541,37 @@ def gadget_finished(outpath,
     if hires: 
         numsnaps = 320
         gadgetpath = outpath+'/outputs_hires'
-    if (not os.path.exists(gadgetpath)):
+    inventory = get_inventory()
+    if (not inventory.isdir(gadgetpath)):
         if verbose: print "  Gadget folder not present in "+get_foldername(outpath)
         return False
     if onlychecklastsnap: #only check last snap
         snapstr = str(numsnaps-1).zfill(3)
         snappath = gadgetpath+"/snapdir_"+snapstr+"/snap_"+snapstr+".0"
         if hdf5: snappath += ".hdf5"
-        if (not os.path.exists(snappath)):
+        if (not inventory.exists(snappath)):
             if verbose: print "  Snap "+snapstr+" not in "+get_foldername(outpath)
             return False
         else:
             return True
     for snap in xrange(numsnaps): # check that all snaps are there
         snapstr = str(snap).zfill(3)
-        snappath = gadgetpath+"/snapdir_"+snapstr+"/snap_"+snapstr+".0"
-        if hdf5: snappath += ".hdf5"
-        if (not os.path.exists(snappath)):
+        snapname = "snap_"+snapstr+".0"
+        if hdf5: snapname += ".hdf5"
+        listing = inventory.listdir(gadgetpath+"/snapdir_"+snapstr)
+        if (listing == None or snapname not in listing):
             if verbose: print "  Snap "+snapstr+" not in "+get_foldername(outpath)
             return False
         if checkallblocks:
-            for snapfile in glob.glob(gadgetpath+"/snapdir_"+snapstr+'/*'):
-                if (os.path.getsize(snapfile) <= 0):
+            # sizes are stat'ed every time: a block being written or truncated does not touch the dir mtime
+            for snapfile,isdir in listing.items():
+                if snapfile[0] == '.' or isdir: continue
+                snapfile = gadgetpath+"/snapdir_"+snapstr+"/"+snapfile
+                try:
+                    size = os.path.getsize(snapfile)
+                except OSError:
+                    size = 0
+                if size <= 0:
                     if verbose: print snapfile,"has no data (skipping)"
                     return False
     return True
@@ -391,9 +611,10 @@ def restrict_halopaths(halopathlist,
             if check_mergertree_exists(outpath,autoconvert=autoconvert_mergertree):
                 newhalopathlist.append(outpath) 
         halopathlist = newhalopathlist
+    get_inventory().save()
     return halopathlist
 
-def find_halo_paths(basepath=global_halobase,
+def find_halo_paths(basepath=None,
                     nrvirlist=[3,4,5,6],levellist=[11,12,13,14],
                     ictypelist=["BA","BB","BC","BD","EA","EB","EC","EX","CA","CB","CC"],
                     contamsuite=False,
@@ -405,6 +626,7 @@ def find_halo_paths(basepath=global_halobase,
                     use_fullbin_rockstar=False,hires=False):
     """ Returns a list of paths to halos that have gadget completed/rsynced
         with the specified nrvirlist/levellist/ictype """
+    if basepath == None: basepath = get_halobase()
     if verbose:
         print "basepath:",basepath
         print "nrvirlist:",nrvirlist
@@ -413,13 +635,16 @@ def find_halo_paths(basepath=global_halobase,
 
     halopathlist = []
     haloidlist = []
-    for filename in os.listdir(basepath):
+    listing = get_inventory().listdir(basepath)
+    if listing == None:
+        raise IOError("Invalid basepath: "+basepath)
+    for filename in sorted(listing):
         if filename[0] == "H":
             haloidlist.append(filename)
     for haloid in haloidlist:
         try:
-            hpathlist = get_available_hpaths(haloid,contam=contamsuite,checkgadget=False,
-                                             basepath=basepath)
+            hpathlist = _available_hpaths(haloid,contam=contamsuite,checkgadget=False,
+                                          basepath=basepath)
         except IOError as e:
             print "ERROR: skipping",haloid
             continue
@@ -445,28 +670,25 @@ def find_halo_paths(basepath=global_halobase,
                                       use_fullbin_rockstar=use_fullbin_rockstar)
     return halopathlist
 
-def _load_index_row(hpath,filename=global_halobase+"/parent_zoom_index.txt"):
+def _load_index_row(hpath,filename=None):
     haloid = get_parent_hid(hpath)
     ictype,lx,nv = get_zoom_params(hpath)
-    htable = get_parent_zoom_index()
+    if filename == None: filename = get_halobase()+"/parent_zoom_index.txt"
+    htable,rowdict = _get_parent_zoom_index(filename)
     haloid = hidint(haloid); lx = int(lx); nv = int(nv)
 
-    idmask = htable['parentid']==haloid
-    icmask = htable['ictype']==ictype.upper()
-    lxmask = htable['LX']==lx
-    nvmask = htable['NV']==nv
-    maskall = idmask & icmask & lxmask & nvmask
-    if np.sum(maskall) == 0:
+    rows = rowdict.get((haloid,ictype.upper(),lx,nv),[])
+    if len(rows) == 0:
         raise ValueError("no such halo in index for %s" % (hpath))
-    if np.sum(maskall) > 1:
+    if len(rows) > 1:
         print "FATAL ERROR: duplicate row in index"
         exit()
-    row = htable[maskall]
+    row = htable[rows]
     if row['badflag']+row['badsubf'] > 0:
         if (lx != 14) or (lx==14 and row['badflag']>0):
             print "WARNING: potentially bad halo match for H%i %s LX%i NV%i" % (haloid,ictype,lx,nv)
     return row
-def load_zoomid(hpath,filename=global_halobase+"/parent_zoom_index.txt",snap=None):
+def load_zoomid(hpath,filename=None,snap=None):
     """
     @param hpath: halo path to load zoom id
     @param snap: default None (automatically picks snap with get_numsnaps)
@@ -503,7 +725,7 @@ def load_zoomid(hpath,filename=global_halobase+"/parent_zoom_index.txt",snap=Non
             raise ValueError("{0} snap {1} does not have a valid main branch rsid ({2} indices match snap)".format(get_foldername(hpath),snap,np.sum(ii)))
         return tab['origid'][ii][0]
     
-def load_haloprops(hpath,filename=global_halobase+"/parent_zoom_index.txt"):
+def load_haloprops(hpath,filename=None):
     row = _load_index_row(hpath,filename=filename)
     mvir = float(row['mgrav']) # physical Msun
     rvir = float(row['rvir'])  # physical kpc
@@ -512,9 +734,9 @@ def load_haloprops(hpath,filename=global_halobase+"/parent_zoom_index.txt"):
 
 def load_pcatz0(old=False):
     if old:
-        return RDR.RSDataReader(global_basepath+"/caterpillar/parent/RockstarData",63,version=2)
+        return RDR.RSDataReader(get_basepath()+"/caterpillar/parent/RockstarData",63,version=2)
     else:
-        return RDR.RSDataReader(global_prntbase+"/rockstar",127,version=6)
+        return RDR.RSDataReader(get_prntbase()+"/rockstar",127,version=6)
 
 def load_scat(hpath):
     snap = get_lastsnap(hpath)
@@ -526,49 +748,245 @@ def load_scat(hpath):
     else: 
         return RSF.subfind_catalog(hpath+'/outputs',snap)
 
-def load_rscat(hpath,snap,verbose=True,halodir='halos_bound',unboundfrac=None,minboundpart=None,version=None,rmaxcut=True):
-    if version != None:
-        rscat = RDR.RSDataReader(hpath+'/'+halodir,snap,version=version,digits=1,unboundfrac=unboundfrac,minboundpart=minboundpart)
-    else:
-        try:
-            rscat = RDR.RSDataReader(hpath+'/'+halodir,snap,version=10,digits=1,unboundfrac=unboundfrac,minboundpart=minboundpart)
-        except IOError as e: #try to identify a unique valid rockstar version
-            print e
-            versionlist = [2,3,4,5,6,7,8,9]
-            testlist = []
-            for version in versionlist:
+def load_rscat(hpath,snap,verbose=True,halodir='halos_bound',unboundfrac=None,minboundpart=None,version=None,rmaxcut=True,cache=True,numthreads=1):
+    """
+    @param cache: if True (default), read/write the columnar cache of the decoded
+        catalogue in hpath/halodir/rscache (see RSDataReader), so only the first
+        load of a snapshot parses the rockstar binaries
+    @param numthreads: number of threads used to decode the rockstar block files
+    """
+    if version == None and cache:
+        cachedversions = RDR.rs_cachedversions(hpath+'/'+halodir,snap,digits=1)
+        if len(cachedversions)==1: version = cachedversions[0]
+    if version == None:
+        versionlist = RDR.rs_probeversion(hpath+'/'+halodir,snap,digits=1)
+        if len(versionlist) == 0:
+            raise IOError("No rockstar catalogue matching a known version for {0} snap {1}".format(get_foldername(hpath),snap))
+        if len(versionlist) > 1:
+            # fall back to trial-decoding the remaining candidates, as before the probe existed
+            candidates = versionlist
+            versionlist = []
+            for version in candidates:
                 try:
-                    rscat = RDR.RSDataReader(hpath+'/'+halodir,snap,version=version,digits=1,unboundfrac=unboundfrac,minboundpart=minboundpart)
-                    testlist.append(True)
-                except KeyError:
-                    testlist.append(False)
-                except IOError:
-                    testlist.append(False)
-            if sum(testlist) != 1:
-                raise RuntimeError("Can't determine what version to use {0}".format(get_foldername(hpath)))
-            else:
-                version = np.array(versionlist)[np.array(testlist)][0]
-                if verbose:
-                    print "Using version "+str(version)+" for "+get_foldername(hpath)
-                    rscat = RDR.RSDataReader(hpath+'/'+halodir,snap,version=version,digits=1,unboundfrac=unboundfrac,minboundpart=minboundpart)
-
-    if rmaxcut:
-        zoomid = load_zoomid(hpath,snap=snap)
-        hpos = np.array(rscat.ix[zoomid][['posX','posY','posZ']])
-        spos = rscat[['posX','posY','posZ']]
-        dr = np.sqrt(np.sum((spos-hpos)**2,1))
-        rscat['dr'] = dr*1000.
-        badii = rscat['dr']<rscat['rvmax']
-        badii[zoomid] = False
-        goodii = ~badii
-        rscat.badhalos = rscat.data.ix[badii]
-        rscat.numbad = len(rscat.badhalos)
-        rscat.data = rscat.data.ix[goodii]
-        rscat.ix = rscat.data.ix
-        rscat.index = rscat.data.index
-        rscat.num_halos = len(rscat.data)
+                    RDR.RSDataReader(hpath+'/'+halodir,snap,version=version,digits=1,noparents=True,lazy=True,cache=False)
+                    versionlist.append(version)
+                except (KeyError,IOError,ValueError):
+                    continue
+        if len(versionlist) != 1:
+            raise RuntimeError("Can't determine what version to use {0} (candidates {1})".format(get_foldername(hpath),versionlist))
+        version = versionlist[0]
+        if verbose and version != 10:
+            print "Using version "+str(version)+" for "+get_foldername(hpath)
+    cacherows = None
+    if rmaxcut and cache and unboundfrac == None and minboundpart == None:
+        cut = _cached_rmaxcut(hpath,snap,RDR.rs_cachepath(hpath+'/'+halodir,snap,version,digits=1))
+        if cut != None: zoomid,dr,cacherows = cut
+    rscat = RDR.RSDataReader(hpath+'/'+halodir,snap,version=version,digits=1,unboundfrac=unboundfrac,minboundpart=minboundpart,cache=cache,numthreads=numthreads,cacherows=cacherows)
+
+    # dr is the periodic distance, so unlike the old plain difference of positions
+    # it also cuts halos across a box boundary from a host close to the edge
+    if rmaxcut and rscat.cacherows is not None:
+        # cut applied while reading the cache: no uncut frame, badhalos read on first use
+        rscat.zoomid = zoomid
+        rscat['dr'] = dr[cacherows]
+        rscat._badcolumns = {'dr':dr[rscat._badrows]}
+        rscat.numbad = len(rscat._badrows)
+    elif rmaxcut:
+        cachefile = None
+        if cache: cachefile = RDR.rs_cachepath(hpath+'/'+halodir,snap,version,digits=1)+'/hostdist.npz'
+        zoomid,dr = _host_distances(hpath,snap,rscat,cachefile)
+        rscat.zoomid = zoomid
+        rscat['dr'] = dr
+        badii = dr < np.array(rscat['rvmax'])
+        badii[rscat.data.index.get_loc(zoomid)] = False
+        badrows = np.flatnonzero(badii)
+        rscat.numbad = len(badrows)
+        rscat._badhalos = rscat.data.iloc[badrows]
+        if rscat.numbad > 0:
+            rscat.data = rscat.data.iloc[np.flatnonzero(~badii)]
+            rscat.ix = rscat.data.ix
+            rscat.index = rscat.data.index
+            rscat.num_halos = len(rscat.data)
     return rscat
 
+def _cached_rmaxcut(hpath,snap,cachepath):
+    """
+    The rmaxcut from hostdist.npz and the cached catalogue's id and rvmax columns,
+    without loading the catalogue.
+    @return: zoomid, dr, rows (positions in the cached row order of the halos kept),
+             None if hostdist.npz or the cache is missing or stale
+    """
+    zoomstamp = _zoomid_stamp(hpath,snap)
+    if zoomstamp == None: return None
+    try:
+        cached = np.load(cachepath+'/hostdist.npz')
+        if float(cached['zoomstamp']) != zoomstamp: return None
+        ids = RDR.rs_cachecolumn(cachepath,'id')
+        rvmax = RDR.rs_cachecolumn(cachepath,'rvmax')
+        if not np.array_equal(cached['ids'],ids): return None
+        zoomid = int(cached['zoomid']); dr = cached['dr']
+    except (IOError,KeyError,ValueError):
+        return None
+    badii = dr < rvmax
+    badii[np.flatnonzero(ids==zoomid)] = False
+    return zoomid,dr,np.flatnonzero(~badii)
+
+def _zoomid_stamp(hpath,snap):
+    """
+    @return: mtime of the file load_zoomid(hpath,snap) reads the host id from
+             (parent_zoom_index.txt for the last snap, the MassAccrPlugin table otherwise),
+             None if it can't be determined
+    """
+    try:
+        if snap==get_numsnaps(hpath)-1:
+            return os.path.getmtime(get_halobase()+"/parent_zoom_index.txt")
+        from caterpillaranalysis import MassAccrPlugin
+        plug = MassAccrPlugin()
+        return os.path.getmtime(hpath+'/'+plug.OUTPUTFOLDERNAME+'/'+plug.filename)
+    except (ImportError,AttributeError,OSError):
+        return None
+def _host_distances(hpath,snap,rscat,cachefile=None):
+    """
+    @return: zoomid, periodic distance (kpc/h comoving) of every halo in rscat.data from the zoom host.
+    Both are saved in cachefile (in the catalogue's rscache directory, so they go away
+    whenever that cache is rebuilt) and reused by later loads, as long as the file
+    load_zoomid takes the host from has not changed since (see _zoomid_stamp).
+    """
+    ids = rscat.data.index
+    zoomstamp = _zoomid_stamp(hpath,snap)
+    if cachefile != None and zoomstamp != None and os.path.exists(cachefile):
+        try:
+            cached = np.load(cachefile)
+            rows = pd.Index(cached['ids']).get_indexer(ids)
+            if float(cached['zoomstamp'])==zoomstamp and np.all(rows >= 0):
+                return int(cached['zoomid']),cached['dr'][rows]
+        except (IOError,KeyError,ValueError):
+            pass
+    zoomid = load_zoomid(hpath,snap=snap)
+    pos = np.array(rscat.data[['posX','posY','posZ']])
+    dpos = np.abs(pos-pos[ids.get_loc(zoomid)])
+    dpos = np.minimum(dpos,rscat.boxsize-dpos)
+    dr = np.sqrt(np.sum(dpos**2,axis=1))*1000.
+    if cachefile != None and zoomstamp != None and os.path.exists(os.path.dirname(cachefile)):
+        tmpname = cachefile+'.tmp'+str(os.getpid())+'.npz'
+        try:
+            np.savez(tmpname,ids=np.array(ids),dr=dr,zoomid=zoomid,zoomstamp=zoomstamp)
+            os.rename(tmpname,cachefile)
+        except (IOError,OSError) as e:
+            warnings.warn("Could not cache host distances "+cachefile+": "+str(e))
+            if os.path.exists(tmpname): os.remove(tmpname)
+    return zoomid,dr
+
+def _warm_rscat_cache(args):
+    hpath,snap,halodir,version = args
+    try:
+        load_rscat(hpath,snap,verbose=False,halodir=halodir,version=version,rmaxcut=False,cache=True)
+    except Exception as e:
+        print "ERROR: could not cache {0} snap {1}: {2}".format(get_foldername(hpath),snap,e)
+        return False
+    return True
+def warm_rscat_cache(hpaths,snaps=None,halodir='halos_bound',version=None,numprocs=1):
+    """
+    Builds the rockstar catalogue cache (see load_rscat) for every snap of every hpath.
+    @param snaps: list of snaps to cache (default: all snaps of each hpath)
+    @param numprocs: if larger than 1, spreads the snapshots over a multiprocessing.Pool
+    @return: list of (hpath,snap) that could not be cached
+    """
+    tasks = []
+    for hpath in hpaths:
+        if snaps==None: hsnaps = range(get_numsnaps(hpath))
+        else: hsnaps = snaps
+        for snap in hsnaps:
+            tasks.append((hpath,snap,halodir,version))
+    if numprocs==1:
+        results = map(_warm_rscat_cache,tasks)
+    else:
+        pool = Pool(numprocs)
+        results = pool.map(_warm_rscat_cache,tasks,chunksize=1)
+        pool.close()
+        pool.join()
+    return [(hpath,snap) for (hpath,snap,halodir,version),ok in zip(tasks,results) if not ok]
+
+class RockstarSeries(object):
+    """
+    The rockstar catalogues of every snapshot of an hpath.
+    Catalogues are loaded with load_rscat on first access and the least recently
+    used one is dropped once more than maxcats are in memory.
+    rows/get answer (snap, rsid) queries across many snapshots in one call.
+    """
+    def __init__(self,hpath,maxcats=4,snaps=None,**kwargs):
+        """
+        @param maxcats: number of catalogues kept in memory
+        @param snaps: snapshots in the series (default: all snaps of hpath)
+        @param kwargs: passed on to load_rscat (e.g. rmaxcut=False, halodir, version)
+        """
+        assert maxcats >= 1
+        self.hpath = hpath
+        self.maxcats = maxcats
+        if snaps == None: snaps = range(get_numsnaps(hpath))
+        self.snaps = list(snaps)
+        kwargs.setdefault('verbose',False)
+        self.kwargs = kwargs
+        self._cats = OrderedDict()
+
+    def __getitem__(self,snap):
+        if snap in self._cats:
+            rscat = self._cats.pop(snap)
+        else:
+            if snap not in self.snaps:
+                raise KeyError("snap {0} not in series for {1}".format(snap,get_foldername(self.hpath)))
+            while len(self._cats) >= self.maxcats:
+                self._cats.popitem(last=False)
+            rscat = load_rscat(self.hpath,snap,**self.kwargs)
+        self._cats[snap] = rscat
+        return rscat
+    def __contains__(self,snap):
+        return snap in self.snaps
+    def __len__(self):
+        return len(self.snaps)
+    def __iter__(self):
+        for snap in self.snaps:
+            yield self[snap]
+    def loaded(self):
+        """ snaps currently in memory, least recently used first """
+        return self._cats.keys()
+
+    def _query_order(self,snaps):
+        # catalogues already in memory first, so they are not evicted before being used
+        snaps = [snap for snap in snaps if snap in self.snaps]
+        loaded = [snap for snap in snaps if snap in self._cats]
+        return loaded+[snap for snap in snaps if snap not in self._cats]
+
+    def rows(self,snaps,rsids):
+        """
+        @param snaps, rsids: arrays of the same length (or a scalar snap)
+        @return: int array with the row position (for .iloc) of rsids[i] in self[snaps[i]].data,
+                 -1 where the snap is not in the series or the halo is not in its catalogue.
+                 Each catalogue needed is loaded once.
+        """
+        snaps,rsids = np.broadcast_arrays(np.ravel(snaps).astype(int),np.ravel(rsids).astype(int))
+        rows = -np.ones(len(snaps),dtype=np.int64)
+        for snap in self._query_order(np.unique(snaps)):
+            ii = np.where(snaps==snap)[0]
+            rows[ii] = self[snap].data.index.get_indexer(rsids[ii])
+        return rows
+
+    def get(self,snaps,rsids,columns):
+        """
+        @return: DataFrame with one row per (snaps[i],rsids[i]) holding the given columns,
+                 NaN where the halo is not found (see rows)
+        """
+        if isinstance(columns,basestring): columns = [columns]
+        snaps,rsids = np.broadcast_arrays(np.ravel(snaps).astype(int),np.ravel(rsids).astype(int))
+        values = np.zeros((len(snaps),len(columns)))+np.nan
+        for snap in self._query_order(np.unique(snaps)):
+            ii = np.where(snaps==snap)[0]
+            rscat = self[snap]
+            rows = rscat.data.index.get_indexer(rsids[ii])
+            found = rows >= 0
+            values[ii[found]] = np.array(rscat[columns].iloc[rows[found]],dtype=np.float64)
+        return pd.DataFrame(values,columns=columns)
+
 def load_rsboundindex(hpath,snap):
     return RDR.load_rsboundindex(hpath,snap)
 
@@ -578,56 +996,149 @@ def load_zoom_mtc(hpath,verbose=True,halodir='halos_bound',treedir='trees',**kwa
     return MTC.MTCatalogue(hpath+'/'+halodir+'/'+treedir,version=4,haloids=[load_zoomid(hpath)],**kwargs)
 def make_mtindex_key(snap,origid):
     return str(snap).zfill(3)+","+str(origid)
+def make_mtindex_intkey(snaps,origids):
+    """
+    int64 key snap<<40 | origid used by the snap_id_to_baseid_row index (vectorized)
+    """
+    snaps = np.asarray(snaps,dtype=np.int64); origids = np.asarray(origids,dtype=np.int64)
+    return np.left_shift(snaps,40) | origids
+
+class MTSnapIdIndex(object):
+    """
+    Maps (snap, origid) of every merger tree row to (base rsid of its tree, row in that tree).
+    keys (sorted make_mtindex_intkey), baseids and rows are parallel int64 arrays,
+    memory-mapped from the index directory.
+    """
+    def __init__(self,indexdir,mmap_mode='r'):
+        self.keys = np.load(indexdir+'/keys.npy',mmap_mode=mmap_mode)
+        self.baseids = np.load(indexdir+'/baseids.npy',mmap_mode=mmap_mode)
+        self.rows = np.load(indexdir+'/rows.npy',mmap_mode=mmap_mode)
+    def __len__(self):
+        return len(self.keys)
+    def lookup(self,snaps,origids):
+        """
+        @return: baseids, rows for each (snaps[i],origids[i]); -1 where there is no such tree row
+        """
+        keys = np.ravel(make_mtindex_intkey(snaps,origids))
+        baseids = -np.ones(len(keys),dtype=np.int64)
+        rows = -np.ones(len(keys),dtype=np.int64)
+        ii = np.searchsorted(self.keys,keys)
+        found = ii < len(self.keys)
+        found[found] = self.keys[ii[found]]==keys[found]
+        baseids[found] = self.baseids[ii[found]]
+        rows[found] = self.rows[ii[found]]
+        return baseids,rows
+    def __getitem__(self,key):
+        """ old dict interface: index[make_mtindex_key(snap,origid)] -> (base_rsid,row) """
+        snap,origid = key.split(',')
+        baseids,rows = self.lookup([int(snap)],[int(origid)])
+        if rows[0] < 0: raise KeyError(key)
+        return (baseids[0],rows[0])
+    def __contains__(self,key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
 def make_mt_snapid_to_baseidrow(hpath,recalc=False,halodir='halos_bound',treedir='trees'):
-    def make_key(arg):
-        return make_mtindex_key(arg[0],arg[1])
-    def make_val(arg):
-        return arg
-    #def make_mtindex_val(base_rsid,row):
-    #    return (base_rsid,row)
-    indexpath = hpath+'/'+halodir+'/'+treedir+'/snap_id_to_baseid_row.p'
-    if os.path.exists(indexpath) and (not recalc): return
+    indexpath = hpath+'/'+halodir+'/'+treedir+'/snap_id_to_baseid_row'
+    if os.path.exists(indexpath+'/keys.npy') and (not recalc): return
 
     start = time.time()
     mtc = load_mtc(hpath,indexbyrsid=True)
     allkeys = []
-    allvals = []
+    allbaseids = []
+    allrows = []
     print "Load Time: {0:.1f} sec".format(time.time()-start)
 
     start = time.time()
     for base_rsid,mt in mtc.Trees.iteritems():
-        snaps = mt['snap']
-        origids = mt['origid']
-        keys = map(make_key,zip(snaps,origids))
-        vals = map(make_val,zip(itertools.repeat(base_rsid,len(keys)),itertools.count()))
-        
-        allkeys += keys
-        allvals += vals
-    
-    index = dict(zip(allkeys,allvals))
-    with open(indexpath,'w') as f:
-        pickle.dump(index,f)
+        snaps = np.asarray(mt['snap'],dtype=np.int64)
+        origids = np.asarray(mt['origid'],dtype=np.int64)
+        assert np.all(origids >= 0) and np.all(origids < 2**40),"origid does not fit in 40 bits"
+        allkeys.append(make_mtindex_intkey(snaps,origids))
+        allbaseids.append(np.zeros(len(snaps),dtype=np.int64)+base_rsid)
+        allrows.append(np.arange(len(snaps),dtype=np.int64))
+    if len(allkeys)==0:
+        allkeys = allbaseids = allrows = [np.zeros(0,dtype=np.int64)]
+    keys = np.concatenate(allkeys)
+    order = np.argsort(keys,kind='mergesort')
+    keys = keys[order]
+    if len(keys) > 1 and np.any(keys[1:]==keys[:-1]):
+        warnings.warn("duplicate (snap,origid) rows in merger trees of "+get_foldername(hpath))
+
+    tmppath = indexpath+'.tmp'+str(os.getpid())
+    if not os.path.exists(tmppath): os.makedirs(tmppath)
+    np.save(tmppath+'/keys.npy',keys)
+    np.save(tmppath+'/baseids.npy',np.concatenate(allbaseids)[order])
+    np.save(tmppath+'/rows.npy',np.concatenate(allrows)[order])
+    if os.path.exists(indexpath): shutil.rmtree(indexpath)
+    os.rename(tmppath,indexpath)
     print "Convert Time: {0:.1f} sec".format(time.time()-start)
-    subprocess.call(['chmod g+rwx '+indexpath],shell=True)
-    subprocess.call(['chgrp annaproj '+indexpath],shell=True)
+    subprocess.call(['chmod -R g+rwx '+indexpath],shell=True)
+    subprocess.call(['chgrp -R annaproj '+indexpath],shell=True)
 def load_mt_snapid_to_baseidrow(hpath,halodir='halos_bound',treedir='trees'):
-    indexpath = hpath+'/'+halodir+'/'+treedir+'/snap_id_to_baseid_row.p'
-    assert os.path.exists(indexpath)
-    with open(indexpath,'r') as f:
-        index = pickle.load(f)
-    return index
+    """
+    @return: MTSnapIdIndex (memory-mapped); index.lookup(snaps,origids) -> baseids,rows
+    """
+    indexpath = hpath+'/'+halodir+'/'+treedir+'/snap_id_to_baseid_row'
+    assert os.path.exists(indexpath+'/keys.npy')
+    return MTSnapIdIndex(indexpath)
 
-def load_pmtc(hpath=global_prntbase,verbose=True,halodir='rockstar',treedir='trees',**kwargs):
+def load_pmtc(hpath=None,verbose=True,halodir='rockstar',treedir='trees',**kwargs):
+    if hpath == None: hpath = get_prntbase()
     return MTC.MTCatalogue(hpath+'/'+halodir+'/'+treedir,version=3,**kwargs)
 
 def load_partblock(hpath,snap,block,parttype=-1,ids=-1,hdf5=True):
-    #assert check_is_sorted(hpath,snap=snap,hdf5=hdf5),"snap is sorted"
+    """
+    @param ids: particle IDs to read (e.g. from a halo catalogue), in any order. On snapshots
+      not sorted by ID they are looked up in the snapshot's ID index (see make_partid_index)
+    """
     snapstr = str(snap).zfill(3)
     snappath = hpath+'/outputs/snapdir_'+snapstr+'/snap_'+snapstr
 #    if "14" in hpath:
 #        return rsg.read_block(snappath,block,parttype=parttype,ids=ids,doubleprec=True)
 #    else:
-    return rsg.read_block(snappath,block,parttype=parttype,ids=ids)
+    if type(ids) != int:
+        return rsg.read_blocks_by_id(snappath,[block],ids,parttype=parttype)[0]
+    return rsg.read_block(snappath,block,parttype=parttype)
+
+def load_partblocks(hpath,snap,blocks,parttype=-1,ids=-1):
+    """
+    Several blocks of a snapshot in one pass over its subfiles, e.g.
+    pos,vel,pids = load_partblocks(hpath,snap,["POS ","VEL ","ID  "],parttype=1)
+    @param parttype: a particle type or list of types (particles grouped by type in that order)
+    @param ids: particle IDs to read (single parttype only), as for load_partblock
+    @return: list with one array per block
+    """
+    snapstr = str(snap).zfill(3)
+    snappath = hpath+'/outputs/snapdir_'+snapstr+'/snap_'+snapstr
+    if type(ids) != int:
+        return rsg.read_blocks_by_id(snappath,blocks,ids,parttype=parttype)
+    return rsg.read_blocks(snappath,blocks,parttype=parttype)
+
+def make_partid_index(hpath,snap,parttype=1,recalc=False):
+    """
+    Saves the particle ID -> snapshot index table that load_partblock(ids=...) and
+    RSDataReader.get_block_from_halo use on snapshots not sorted by ID.
+    Without it the ID block is read and indexed on every call.
+    @return: directory of the index (None for sorted snapshots, which need none)
+    """
+    if check_is_sorted(hpath,snap=snap): return None
+    snapstr = str(snap).zfill(3)
+    snappath = hpath+'/outputs/snapdir_'+snapstr+'/snap_'+snapstr
+    return rsg.make_idindex(snappath,parttype=parttype,recalc=recalc)
+
+def make_all_partid_indexes(hpath,snaps=None,parttype=1,recalc=False,verbose=True):
+    """ Bulk job: make_partid_index for every snapshot (or snaps) of hpath """
+    if snaps is None: snaps = xrange(get_numsnaps(hpath))
+    for snap in snaps:
+        start = time.time()
+        path = make_partid_index(hpath,snap,parttype=parttype,recalc=recalc)
+        if verbose:
+            if path is None: print "snap {0}: sorted, no index needed".format(snap)
+            else: print "snap {0}: {1} ({2:.1f} sec)".format(snap,path,time.time()-start)
 
 def load_soft(hpath):
     """ plummer equivalent grav. softening = h/2.8 """
@@ -653,23 +1164,20 @@ def load_aqcat(whichAq,snap):
     assert whichAq in ['A','B','C','D','E','F']
     if snap > 127: 
         raise ValueError("Aquarius is snaps 0-127")
-    rspath = global_basepath+'/aquarius/Aq-'+whichAq+'/2/halos'
+    rspath = get_basepath()+'/aquarius/Aq-'+whichAq+'/2/halos'
     return RDR.RSDataReader(rspath,snap,version=7)
 
 def get_quant_zoom(halo_path,quant):
-    htable = get_parent_zoom_index()
+    htable,rowdict = _get_parent_zoom_index(get_halobase()+"/parent_zoom_index.txt")
     halo_split = halo_path.split("_")
     haloid = int(halo_path.split("/H")[-1].split("_")[0].strip("H"))
     geom,lx,nrvir = get_zoom_params(halo_path.split("/")[-1])
-    mask = (haloid == htable['parentid']) & \
-           (geom == htable['ictype']) & \
-           (int(lx) == htable['LX']) & \
-           (int(nrvir) == htable['NV']) 
+    rows = rowdict.get((haloid,geom,int(lx),int(nrvir)),[])
 
-    if len(htable[mask][quant])>1:
-        return htable[mask][quant]
+    if len(rows)>1:
+        return htable[rows][quant]
     else:
-        return float(htable[mask][quant])
+        return float(htable[rows][quant])
 
 def get_main_branch(hpath):
     return pickle.load( open( hpath+"/analysis/main_branch.p", "rb" ) )
@@ -732,15 +1240,84 @@ def get_colors_for_halos(nhalos=len(hid2name)):
 
     return index
 
-def tabulate(tabfn,lx=14,hids=None,exclude_hids=None,savefile=None,numprocs=1,usecid=False):
+class TabulateTimeout(Exception):
+    pass
+def _raise_tabulate_timeout(signum,frame):
+    raise TabulateTimeout()
+def _tabulate_chunk(args):
+    """
+    Runs tabfn on each hpath of a chunk (in a worker process or serially).
+    @return: list of (result, error message or None, seconds)
     """
-    @param tabfn: a function whose only argument is hpath. If successful, returns data,names,formats; data is a tuple of the values to go into the array, names is a list/tuple of the column names, formats is the data types (used for np.dtype). All three variables should be of the same length. If unsuccessful, tabfn should return None (e.g., in cases of no rockstar data), then tabulate() will make the DataFrame row be marked with missing data. TODO can I make this happen with exceptions in a nice way? Raising exceptions is better than returning None.
+    tabfn,hpaths,timeout = args
+    out = []
+    for hpath in hpaths:
+        start = time.time()
+        if timeout != None:
+            oldhandler = signal.signal(signal.SIGALRM,_raise_tabulate_timeout)
+            signal.alarm(max(1,int(np.ceil(timeout))))
+        try:
+            result = tabfn(hpath); error = None
+        except TabulateTimeout:
+            result = None; error = "timed out after {0} s".format(timeout)
+        except Exception as e:
+            result = None; error = "{0}: {1}".format(type(e).__name__,e)
+        finally:
+            if timeout != None:
+                signal.alarm(0)
+                signal.signal(signal.SIGALRM,oldhandler)
+        out.append((result,error,time.time()-start))
+    return out
+
+def _tabulate_chunk_indexed(args):
+    k,task = args
+    return k,_tabulate_chunk(task)
+
+def _tabulate_cachefile(hpath,cachename,cachedir):
+    if cachedir == None:
+        return hpath+'/analysis/tabulate/'+cachename+'.p'
+    return cachedir+'/'+cachename+'_'+get_foldername(hpath)+'.p'
+def _read_tabulate_cache(hpath,cachename,cachedir):
+    try:
+        with open(_tabulate_cachefile(hpath,cachename,cachedir),'rb') as f:
+            cached = pickle.load(f)
+    except (IOError,EOFError,pickle.UnpicklingError):
+        return None
+    if cached['name'] != cachename or cached['hpath'] != hpath: return None
+    return cached['result']
+def _write_tabulate_cache(hpath,cachename,cachedir,result):
+    filename = _tabulate_cachefile(hpath,cachename,cachedir)
+    tmpname = filename+'.tmp'+str(os.getpid())
+    try:
+        if not os.path.exists(os.path.dirname(filename)): os.makedirs(os.path.dirname(filename))
+        with open(tmpname,'wb') as f:
+            pickle.dump({'name':cachename,'hpath':hpath,'result':result},f,pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname,filename)
+    except (IOError,OSError) as e:
+        warnings.warn("Could not cache tabulate result "+filename+": "+str(e))
+        if os.path.exists(tmpname): os.remove(tmpname)
+
+def tabulate(tabfn,lx=14,hids=None,exclude_hids=None,savefile=None,numprocs=1,usecid=False,
+             cache=True,version=None,cachedir=None,recalc=False,timeout=None,chunksize=1,
+             return_timings=False,verbose=False):
+    """
+    @param tabfn: a function whose only argument is hpath. If successful, returns data,names,formats; data is a tuple of the values to go into the array, names is a list/tuple of the column names, formats is the data types (used for np.dtype). All three variables should be of the same length. If unsuccessful, tabfn should return None (e.g., in cases of no rockstar data), then tabulate() will make the DataFrame row be marked with missing data. Halos for which tabfn raises or times out are also marked as missing (with a warning) instead of stopping the run.
     @param lx: which LX to tabulate (default 14)
     @param hids: list of hids to tabulate (default, everything in cid2hid)
     @param exclude_hids: list of hids to exclude
     @param savefile: name of file to save df as a csv to
-    @param numprocs: if larger than 1, uses multiprocessing.Pool.map() to tabulate
+    @param numprocs: if larger than 1, spreads the halos over a multiprocessing.Pool of numprocs processes
     @param usecid: DataFrame index is by Cat-ID rather than hid
+    @param cache: if True, successful (not None) results are saved per halo and reused by later
+        calls, so a re-run only computes halos that are missing or failed.
+        Results are keyed by tabfn.__name__ (plus version) and hpath, and stored in
+        hpath/analysis/tabulate/ (or cachedir if given)
+    @param version: bump this when tabfn changes to ignore older cached results
+    @param recalc: recompute (and re-cache) every halo
+    @param timeout: seconds allowed per halo (None: no limit)
+    @param chunksize: number of halos sent to a worker process at once
+    @param return_timings: also return a DataFrame with seconds, status ('ok','none','cached',
+        or the error message) per halo
     @return tab: pandas DataFrame, indexed by hid (or Cat-ID if usecid)
     """
     if hids==None: hids = cid2hid.values()
@@ -751,19 +1328,55 @@ def tabulate(tabfn,lx=14,hids=None,exclude_hids=None,savefile=None,numprocs=1,us
                 hids.remove(ex_hid)
             else:
                 print "WARNING: H{0} not in hids, not removing"
+    cachename = tabfn.__name__
+    if version != None: cachename += '_v'+str(version)
+
+    hpaths = [get_hpath_lx(hid,lx) for hid in hids]
+    datalist = [None for hpath in hpaths]
+    times = np.zeros(len(hpaths))
+    status = ['' for hpath in hpaths]
+    todo = []
+    for i,hpath in enumerate(hpaths):
+        if cache and not recalc and hpath != None:
+            datalist[i] = _read_tabulate_cache(hpath,cachename,cachedir)
+            if datalist[i] != None:
+                status[i] = 'cached'
+                continue
+        todo.append(i)
+    if verbose: print "tabulate {0}: {1} cached, computing {2}".format(cachename,len(hpaths)-len(todo),len(todo))
 
+    chunks = [todo[k:k+chunksize] for k in xrange(0,len(todo),chunksize)]
+    tasks = [(tabfn,[hpaths[i] for i in chunk],timeout) for chunk in chunks]
     if numprocs==1:
-        datalist = map(tabfn,[get_hpath_lx(hid,lx) for hid in hids])
+        results = itertools.imap(lambda k: (k,_tabulate_chunk(tasks[k])),xrange(len(tasks)))
     else:
         pool = Pool(numprocs)
-        datalist = pool.map(tabfn,[get_hpath_lx(hid,lx) for hid in hids])
+        results = pool.imap_unordered(_tabulate_chunk_indexed,[(k,task) for k,task in enumerate(tasks)])
+    for k,chunkresults in results:
+        for i,(result,error,seconds) in zip(chunks[k],chunkresults):
+            datalist[i] = result; times[i] = seconds
+            if error != None:
+                status[i] = error
+                print "WARNING: tabulate {0} failed for {1}: {2}".format(cachename,hids[i],error)
+            elif result == None:
+                status[i] = 'none'
+            else:
+                status[i] = 'ok'
+                if cache and hpaths[i] != None:
+                    _write_tabulate_cache(hpaths[i],cachename,cachedir,result)
+            if verbose: print "  {0}: {1:.1f} s ({2})".format(hids[i],seconds,status[i])
+    if numprocs != 1:
         pool.close()
+        pool.join()
 
+    first_dtype = None
     for item in datalist:
         if item != None:
             data,names,formats = item
             first_dtype = np.dtype({'names':names,'formats':formats})
             break
+    if first_dtype == None:
+        raise RuntimeError("tabulate {0}: no halo returned data".format(cachename))
     rows = []
     invalid = [False for item in datalist]
     dtype = first_dtype
@@ -794,4 +1407,6 @@ def tabulate(tabfn,lx=14,hids=None,exclude_hids=None,savefile=None,numprocs=1,us
     if savefile != None:
         df.to_csv(path_or_buf=savefile)
 
+    if return_timings:
+        return df,pd.DataFrame({'seconds':times,'status':status},index=myindex,columns=['seconds','status'])
     return df
@@ -4,23 +4,401 @@ import pandas
 import struct
 import os
 import sys
+import shutil
+import gzip
+import glob
+import warnings
+import cPickle as pickle
+from multiprocessing.pool import ThreadPool
 import readsnapshots.readsnapHDF5_greg as rsg
 
 import asciitable
 def load_rsboundindex(hpath,snap):
     return asciitable.read(hpath+'/halos/halos_'+str(snap)+'/iterboundindex.csv',names=['hid','numbound','numtot','loc','numiter'])
 
+def rs_layout(version):
+    """
+    @param version: RSDataReader version number (see RSDataReader.getversion)
+    @return: headerfmt, varlist, datatypesstr for the binary halo records of that version
+    """
+    if version==1:
+        print "VERSION 1 (Greg's cosmboxes version) NOT IMPLEMENTED!"
+        raise Exception("Not implemented error")
+    if version not in [2,3,4,5,6,7,8,9,10]:
+        raise ValueError("Invalid version "+str(version))
+    if version==2: #RC1
+        headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
+        varlist = np.dtype([('id','<i8'),\
+                            ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
+                            ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
+                            ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
+                            ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
+                            ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
+                            ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
+                            ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
+                            ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
+                            ('Xoff','<f8'),('Voff','<f8'),\
+                            ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
+                            ('spin_bullock','<f8'),('T/|U|','<f8'),\
+                            ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
+                            ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
+                            ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
+                            ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
+        datatypesstr = "qffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfff" #232 bytes
+    if version==3: #RC2
+        headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
+        varlist = np.dtype([('id','<i8'),\
+                            ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
+                            ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
+                            ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
+                            ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
+                            ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
+                            ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
+                            ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
+                            ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
+                            ('Xoff','<f8'),('Voff','<f8'),\
+                            ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
+                            ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
+                            ('spin_bullock','<f8'),('T/|U|','<f8'),\
+                            ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
+                            ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
+                            ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
+                            ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
+        datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfff" #256 bytes
+    if version==4: #RC2 with numbound
+        headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
+        varlist = np.dtype([('id','<i8'),\
+                            ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
+                            ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
+                            ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
+                            ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
+                            ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
+                            ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
+                            ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
+                            ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
+                            ('Xoff','<f8'),('Voff','<f8'),\
+                            ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
+                            ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
+                            ('spin_bullock','<f8'),('T/|U|','<f8'),\
+                            ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
+                            ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
+                            ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
+                            ('num_bound','<i8'),\
+                            ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
+        datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfffq" #264 bytes
+    if version==5: #modification to include total num bound particles and tidal radius
+        # corresponds to rockstar version here: /spacebase/data/gdooley/RockstarSorted/rockstarTidal 
+        # with TIDAL defined. halo.h and properties.c are modified.
+        headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
+        varlist = np.dtype([('id','<i8'),\
+                            ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
+                            ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
+                            ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
+                            ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
+                            ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
+                            ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
+                            ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
+                            ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
+                            ('Xoff','<f8'),('Voff','<f8'),\
+                            ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
+                            ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
+                            ('spin_bullock','<f8'),('T/|U|','<f8'),\
+                            ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
+                            ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
+                            ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
+                            ('num_bound','<i8'),('tidal_r','<f8'),\
+                            ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
+        datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfffqfxxxx" #272 bytes
+    if version==6: #RC3, HDF5-compatible rockstar with pseudoevolution-corrected masses
+        headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
+        varlist = np.dtype([('id','<i8'),\
+                            ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
+                            ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
+                            ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
+                            ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
+                            ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
+                            ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
+                            ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
+                            ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
+                            ('Xoff','<f8'),('Voff','<f8'),\
+                            ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
+                            ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
+                            ('spin_bullock','<f8'),('T/|U|','<f8'),\
+                            ('m_pe_b','<f8'),('m_pe_d','<f8'),\
+                            ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
+                            ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
+                            ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
+                            ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
+        datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfff" #264 bytes
+    if version==7: #RC3, HDF5-compatible rockstar with pseudoevolution-corrected masses, total_num_p added, and full particle binary output support. 8/19/2014
+        headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
+        varlist = np.dtype([('id','<i8'),\
+                            ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
+                            ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
+                            ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
+                            ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
+                            ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
+                            ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
+                            ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
+                            ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
+                            ('Xoff','<f8'),('Voff','<f8'),\
+                            ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
+                            ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
+                            ('spin_bullock','<f8'),('T/|U|','<f8'),\
+                            ('m_pe_b','<f8'),('m_pe_d','<f8'),\
+                            ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
+                            ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
+                            ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
+                            ('total_npart','<i8'),\
+                            ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
+        datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfffq" #272 bytes
+    if version==8: #RC3+, full particle binary and half mass radius. 10/15/2014
+        headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
+        varlist = np.dtype([('id','<i8'),\
+                            ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
+                            ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
+                            ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
+                            ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
+                            ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
+                            ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
+                            ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
+                            ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
+                            ('Xoff','<f8'),('Voff','<f8'),\
+                            ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
+                            ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
+                            ('spin_bullock','<f8'),('T/|U|','<f8'),\
+                            ('m_pe_b','<f8'),('m_pe_d','<f8'),('halfmassrad','<f8'),\
+                            ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
+                            ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
+                            ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
+                            ('total_npart','<i8'),\
+                            ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
+        datatypesstr = "qffffffffffffffffffffffffffffffffffffffffffffffffqqqqqqfffq" #272 bytes
+    if version==9 or version==10: # Alex's iterunbind. Added Feb 4, 2015
+        headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
+        varlist = np.dtype([('id','<i8'),\
+                    ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
+                    ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
+                    ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
+                    ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
+                    ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
+                    ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
+                    ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
+                    ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
+                    ('Xoff','<f8'),('Voff','<f8'),\
+                    ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
+                    ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
+                    ('spin_bullock','<f8'),('T/|U|','<f8'),\
+                    ('m_pe_b','<f8'),('m_pe_d','<f8'),('halfmassrad','<f8'),\
+                    ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
+                    ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
+                    ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
+                    ('num_bound','<i8'),('num_iter','<i8'),\
+                    ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
+        datatypesstr = "qffffffffffffffffffffffffffffffffffffffffffffffffqqqqqqfffqq" #280 bytes
+        #datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfffqq"
+    return headerfmt,varlist,datatypesstr
+
+def rs_blockfilename(dir,snap_num,version,file_num,base='halos_',digits=2):
+    """ Path of one rockstar binary block file """
+    if version==10:
+        ext = '.boundbin'
+    elif version==7 or version == 8:
+        ext = '.fullbin'
+    else:
+        ext = '.bin'
+    return dir+'/'+base+str(snap_num).zfill(digits)+'/'+base+str(snap_num).zfill(digits)+'.'+str(file_num)+ext
+
+def rs_numpart_column(version):
+    """ Name of the column holding the number of particles written for each halo """
+    if version==10:
+        return 'num_bound'
+    elif version==7 or version == 8:
+        return 'total_npart'
+    return 'npart'
+
+def rs_probeversion(dir,snap_num,base='halos_',digits=2,versions=[2,3,4,5,6,7,8,9,10]):
+    """
+    Finds which binary layouts are consistent with the block files of a snapshot,
+    without decoding them. For every block file, the size must equal
+    header + num_halos*recordsize + num_particles*8. This only needs a stat and the
+    256 byte header per file. Layouts with the same record size and file extension
+    must also have a particle count column that adds up to num_particles in the header.
+    7 and 8 both pass that (total_npart is at the same offset), so they are told apart
+    by the halfmassrad column only 8 has (see rs_halfmassrad_plausible).
+    @return: list of matching versions (normally exactly one)
+    """
+    numheaderbytes = 256
+    headers = {}
+    def readheader(path):
+        if path not in headers:
+            with open(path,'rb') as f:
+                headers[path] = struct.unpack(("x"*64)+"qq"+("x"*16)+"x"*(256-96),f.read(numheaderbytes))
+        return headers[path]
+
+    candidates = []
+    for version in versions:
+        numbytes = struct.calcsize(rs_layout(version)[2])
+        file_num = 0
+        file_name = rs_blockfilename(dir,snap_num,version,file_num,base=base,digits=digits)
+        if not os.path.exists(file_name): continue
+        paths = []
+        while os.path.exists(file_name):
+            num_halos,num_particles = readheader(file_name)
+            if os.path.getsize(file_name) != numheaderbytes+num_halos*numbytes+num_particles*8:
+                break
+            paths.append(file_name)
+            file_num += 1
+            file_name = rs_blockfilename(dir,snap_num,version,file_num,base=base,digits=digits)
+        else:
+            candidates.append((version,paths))
+    if len(candidates) <= 1:
+        return [version for version,paths in candidates]
+
+    versions = []
+    for version,paths in candidates:
+        headerfmt,varlist,datatypesstr = rs_layout(version)
+        num_p = rs_numpart_column(version)
+        diskdtype = rs_diskdtype(datatypesstr,varlist)
+        numpartdtype = np.dtype({'names':[num_p],'formats':[diskdtype.fields[num_p][0]],
+                                 'offsets':[diskdtype.fields[num_p][1]],'itemsize':diskdtype.itemsize})
+        for path in paths:
+            num_halos,num_particles = headers[path]
+            if num_halos == 0: continue
+            npart = np.memmap(path,dtype=numpartdtype,mode='r',offset=numheaderbytes,shape=(num_halos,))[num_p]
+            if np.any(npart < 0) or np.sum(npart) != num_particles:
+                break
+        else:
+            versions.append(version)
+    if 7 in versions and 8 in versions:
+        paths = [paths for version,paths in candidates if version==8][0]
+        versions.remove(7 if rs_halfmassrad_plausible(paths,headers) else 8)
+    return versions
+
+def rs_halfmassrad_plausible(paths,headers):
+    """
+    Version 8 records have halfmassrad where version 7 records have 4 pad bytes.
+    @param headers: dict path -> (num_halos,num_particles)
+    @return: True if, read with the version 8 layout, halfmassrad is finite and between 0
+             and rvir for every halo and not zero for all of them
+    """
+    headerfmt,varlist,datatypesstr = rs_layout(8)
+    diskdtype = rs_diskdtype(datatypesstr,varlist)
+    names = ['rvir','halfmassrad']
+    radiusdtype = np.dtype({'names':names,'formats':[diskdtype.fields[name][0] for name in names],
+                            'offsets':[diskdtype.fields[name][1] for name in names],'itemsize':diskdtype.itemsize})
+    nonzero = False
+    for path in paths:
+        num_halos,num_particles = headers[path]
+        if num_halos == 0: continue
+        radii = np.memmap(path,dtype=radiusdtype,mode='r',offset=256,shape=(num_halos,))
+        rvir = np.array(radii['rvir']); halfmassrad = np.array(radii['halfmassrad'])
+        if not np.all(np.isfinite(halfmassrad)) or np.any(halfmassrad < 0) or np.any(halfmassrad > rvir):
+            return False
+        nonzero = nonzero or np.any(halfmassrad > 0)
+    return nonzero
+
+def rs_cachepath(dir,snap_num,version,base='halos_',digits=2):
+    """ Directory holding the columnar cache for one snapshot/version of a rockstar catalogue """
+    return dir+'/rscache/'+base+str(snap_num).zfill(digits)+'_v'+str(version)
+
+def rs_cachedversions(dir,snap_num,base='halos_',digits=2):
+    """ @return: sorted list of versions that have a cache directory for this snapshot """
+    prefix = rs_cachepath(dir,snap_num,'',base=base,digits=digits)
+    versions = []
+    for path in glob.glob(prefix+'*'):
+        if os.path.exists(path+'/meta.p'):
+            try:
+                versions.append(int(path[len(prefix):]))
+            except ValueError:
+                continue
+    return sorted(versions)
+
+def rs_cachecolumn(cachepath,name):
+    """
+    @return: one column of a cached catalogue, memory-mapped (IOError/KeyError if there is no such cache/column)
+    """
+    try:
+        with open(cachepath+'/meta.p','rb') as f:
+            names = pickle.load(f)['names']
+    except (EOFError,pickle.UnpicklingError) as e:
+        raise IOError("Bad rockstar cache "+cachepath+": "+str(e))
+    if name not in names:
+        raise KeyError("No column "+name+" in rockstar cache "+cachepath)
+    return np.load(cachepath+'/col%03i.npy' % names.index(name),mmap_mode='r')
+
+def rs_sourcestamps(getfilename,parentspath=None):
+    """
+    @param getfilename: function of file_num returning the path of that block file
+    @return: list of (path,size,mtime) of all block files (and parentspath if given)
+    """
+    stamps = []
+    file_num = 0
+    file_name = getfilename(file_num)
+    paths = []
+    while os.path.exists(file_name):
+        paths.append(file_name)
+        file_num += 1
+        file_name = getfilename(file_num)
+    if parentspath != None and os.path.exists(parentspath): paths.append(parentspath)
+    for path in paths:
+        st = os.stat(path)
+        stamps.append((path,st.st_size,st.st_mtime))
+    return stamps
+
+def rs_diskdtype(datatypesstr,varlist):
+    """
+    Converts a native-aligned struct format for one halo record into a numpy dtype
+    with explicit field offsets, so that pad bytes are skipped when reading whole blocks.
+    Fields are matched in order with varlist (the trailing hostID/offset/particle_offset
+    columns are not on disk).
+    """
+    names = []; formats = []; offsets = []
+    disknames = varlist.names
+    prefix = ""
+    for c in datatypesstr:
+        if c != 'x':
+            offsets.append(struct.calcsize(prefix+c)-struct.calcsize(c))
+            names.append(disknames[len(names)])
+            formats.append({'q':'<i8','f':'<f4'}[c])
+        prefix += c
+    return np.dtype({'names':names,'formats':formats,'offsets':offsets,'itemsize':struct.calcsize(datatypesstr)})
+
 class RSDataReader:
     """
     Alex's 10/4/13 rewrite of RSDataReader, combining v2 and v3 and cleaning everything up
+
+    lazy=True memory-maps the block files and only decodes the columns listed in
+    columns (plus the ones needed internally) up front. Any other column is decoded
+    the first time it is accessed through rscat[...] or rscat.ix[...].
+
+    cache=True stores the decoded, sorted, parent-linked catalogue as one .npy file
+    per column under dir/rscache/ and reuses it as long as the sizes and mtimes of
+    the block files and parents.list are unchanged.
+
+    numthreads > 1 decodes the block files concurrently in a thread pool.
+
+    cacherows (positions in the cached row order) keeps only those rows when the
+    catalogue is read from the cache, without building the full frame first; the
+    other rows are read from the cache on first access to badhalos (with any
+    extra columns in self._badcolumns).
+    self.cacherows is cacherows if it was applied, None otherwise.
     """
-    def __init__(self, dir, snap_num, version=2, sort_by='mgrav', base='halos_', digits=2, noparents=False, AllParticles=False, unboundfrac=None, minboundpart=None):
+    def __init__(self, dir, snap_num, version=2, sort_by='mgrav', base='halos_', digits=2, noparents=False, AllParticles=False, unboundfrac=None, minboundpart=None, lazy=False, columns=None, cache=False, numthreads=1, cacherows=None):
         self.dir = dir
         self.snap_num = snap_num
         self.base = base
         self.AllParticles = AllParticles
         self.version=version
         self.sort_by = sort_by
+        self.lazy = lazy
+        self._hierarchy = None
+        self._kdtree = None
+        self._boundlookup = None
+        self.cacherows = None
+        self._badrows = None
+        self._badhalos = None
+        self._badcolumns = {}
 
         self.particlebytes = 8
 
@@ -31,285 +409,140 @@ class RSDataReader:
             assert os.path.exists(self.boundpartspath)
 
         def getfilename(file_num):
-            if version==10:
-                return dir+'/'+base+str(snap_num).zfill(digits)+'/'+base+str(snap_num).zfill(digits)+'.'+str(file_num)+'.boundbin'
-            elif version==7 or version == 8:
-                return dir+'/'+base+str(snap_num).zfill(digits)+'/'+base+str(snap_num).zfill(digits)+'.'+str(file_num)+'.fullbin'
-            return dir+'/'+base+str(snap_num).zfill(digits)+'/'+base+str(snap_num).zfill(digits)+'.'+str(file_num)+'.bin'
-
-        if version==10:
-            self.num_p ='num_bound'
-        elif version==7 or version == 8:
-            self.num_p = 'total_npart'
-        else:
-            self.num_p = 'npart'
+            return rs_blockfilename(dir,snap_num,version,file_num,base=base,digits=digits)
 
-        numheaderbytes=256
-        if version==1:
-            print "VERSION 1 (Greg's cosmboxes version) NOT IMPLEMENTED!"
-            datatypesstr = ""
-            numbytes = 256
-            raise Exception("Not implemented error")
-        if version==2: #RC1
-            headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
-            varlist = np.dtype([('id','<i8'),\
-                                ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
-                                ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
-                                ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
-                                ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
-                                ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
-                                ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
-                                ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
-                                ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
-                                ('Xoff','<f8'),('Voff','<f8'),\
-                                ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
-                                ('spin_bullock','<f8'),('T/|U|','<f8'),\
-                                ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
-                                ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
-                                ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
-                                ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
-            datatypesstr = "qffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfff"
-            numbytes = struct.calcsize(datatypesstr) #232
-        if version==3: #RC2
-            headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
-            varlist = np.dtype([('id','<i8'),\
-                                ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
-                                ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
-                                ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
-                                ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
-                                ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
-                                ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
-                                ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
-                                ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
-                                ('Xoff','<f8'),('Voff','<f8'),\
-                                ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
-                                ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
-                                ('spin_bullock','<f8'),('T/|U|','<f8'),\
-                                ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
-                                ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
-                                ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
-                                ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
-            datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfff"
-            numbytes = struct.calcsize(datatypesstr) #256
-        if version==4: #RC2 with numbound
-            headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
-            varlist = np.dtype([('id','<i8'),\
-                                ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
-                                ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
-                                ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
-                                ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
-                                ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
-                                ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
-                                ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
-                                ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
-                                ('Xoff','<f8'),('Voff','<f8'),\
-                                ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
-                                ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
-                                ('spin_bullock','<f8'),('T/|U|','<f8'),\
-                                ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
-                                ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
-                                ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
-                                ('num_bound','<i8'),\
-                                ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
-            datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfffq"
-            numbytes = struct.calcsize(datatypesstr) #260
-        if version==5: #modification to include total num bound particles and tidal radius
-            # corresponds to rockstar version here: /spacebase/data/gdooley/RockstarSorted/rockstarTidal 
-            # with TIDAL defined. halo.h and properties.c are modified.
-            headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
-            varlist = np.dtype([('id','<i8'),\
-                                ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
-                                ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
-                                ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
-                                ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
-                                ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
-                                ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
-                                ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
-                                ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
-                                ('Xoff','<f8'),('Voff','<f8'),\
-                                ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
-                                ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
-                                ('spin_bullock','<f8'),('T/|U|','<f8'),\
-                                ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
-                                ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
-                                ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
-                                ('num_bound','<i8'),('tidal_r','<f8'),\
-                                ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
-            datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfffqfxxxx"
-            numbytes = struct.calcsize(datatypesstr) #264
-        if version==6: #RC3, HDF5-compatible rockstar with pseudoevolution-corrected masses
-            headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
-            varlist = np.dtype([('id','<i8'),\
-                                ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
-                                ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
-                                ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
-                                ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
-                                ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
-                                ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
-                                ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
-                                ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
-                                ('Xoff','<f8'),('Voff','<f8'),\
-                                ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
-                                ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
-                                ('spin_bullock','<f8'),('T/|U|','<f8'),\
-                                ('m_pe_b','<f8'),('m_pe_d','<f8'),\
-                                ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
-                                ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
-                                ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
-                                ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
-            datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfff"
-            numbytes = struct.calcsize(datatypesstr) #264
-        if version==7: #RC3, HDF5-compatible rockstar with pseudoevolution-corrected masses, total_num_p added, and full particle binary output support. 8/19/2014
-            headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
-            varlist = np.dtype([('id','<i8'),\
-                                ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
-                                ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
-                                ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
-                                ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
-                                ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
-                                ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
-                                ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
-                                ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
-                                ('Xoff','<f8'),('Voff','<f8'),\
-                                ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
-                                ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
-                                ('spin_bullock','<f8'),('T/|U|','<f8'),\
-                                ('m_pe_b','<f8'),('m_pe_d','<f8'),\
-                                ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
-                                ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
-                                ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
-                                ('total_npart','<i8'),\
-                                ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
-            datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfffq"
-            numbytes = struct.calcsize(datatypesstr) #264
-        if version==8: #RC3+, full particle binary and half mass radius. 10/15/2014
-            headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
-            varlist = np.dtype([('id','<i8'),\
-                                ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
-                                ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
-                                ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
-                                ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
-                                ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
-                                ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
-                                ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
-                                ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
-                                ('Xoff','<f8'),('Voff','<f8'),\
-                                ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
-                                ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
-                                ('spin_bullock','<f8'),('T/|U|','<f8'),\
-                                ('m_pe_b','<f8'),('m_pe_d','<f8'),('halfmassrad','<f8'),\
-                                ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
-                                ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
-                                ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
-                                ('total_npart','<i8'),\
-                                ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
-            datatypesstr = "qffffffffffffffffffffffffffffffffffffffffffffffffqqqqqqfffq"
-            numbytes = struct.calcsize(datatypesstr)
-        if version==9 or version==10: # Alex's iterunbind. Added Feb 4, 2015
-            headerfmt = "qqqffffffffffqqffq"+"x"*(256-96)
-            varlist = np.dtype([('id','<i8'),\
-                        ('posX','<f8'),('posY','<f8'),('posZ','<f8'),\
-                        ('pecVX','<f8'),('pecVY','<f8'),('pecVZ','<f8'),\
-                        ('corevelx','<f8'),('corevely','<f8'),('corevelz','<f8'),\
-                        ('bulkvelx','<f8'),('bulkvely','<f8'),('bulkvelz','<f8'),\
-                        ('mvir','<f8'),('rvir','<f8'),('child_r','<f8'),('vmax_r','<f8'),\
-                        ('mgrav','<f8'),('vmax','<f8'),('rvmax','<f8'),('rs','<f8'),('rs_klypin','<f8'),\
-                        ('vrms','<f8'),('Jx','<f8'),('Jy','<f8'),('Jz','<f8'),\
-                        ('Epot','<f8'),('spin','<f8'),('altm1','<f8'),('altm2','<f8'),('altm3','<f8'),('altm4','<f8'),\
-                        ('Xoff','<f8'),('Voff','<f8'),\
-                        ('b_to_a','<f8'),('c_to_a','<f8'),('A[x]','<f8'),('A[y]','<f8'),('A[z]','<f8'),\
-                        ('b_to_a2','<f8'),('c_to_a2','<f8'),('A2[x]','<f8'),('A2[y]','<f8'),('A2[z]','<f8'),\
-                        ('spin_bullock','<f8'),('T/|U|','<f8'),\
-                        ('m_pe_b','<f8'),('m_pe_d','<f8'),('halfmassrad','<f8'),\
-                        ('npart','<i8'),('num_cp','<i8'),('numstart','<i8'),\
-                        ('desc','<i8'),('flags','<i8'),('n_core','<i8'),\
-                        ('min_pos_err','<f8'),('min_vel_err','<f8'),('min_bulkvel_err','<f8'),\
-                        ('num_bound','<i8'),('num_iter','<i8'),\
-                        ('hostID','<i8'),('offset','<i8'),('particle_offset','<i8')])
-            datatypesstr = "qffffffffffffffffffffffffffffffffffffffffffffffffqqqqqqfffqq"
-            #datatypesstr = "qfffffffffffffffffffffffffffffffffffffffffffffffqqqqqqxxxxfffqq"
-            numbytes = struct.calcsize(datatypesstr) #264
+        self.num_p = rs_numpart_column(version)
 
+        numheaderbytes=256
+        headerfmt,varlist,datatypesstr = rs_layout(version)
+        numbytes = struct.calcsize(datatypesstr)
         self.datatypesstr = datatypesstr
 
-        file_num = 0
-        file_name = getfilename(file_num)
-        if (not os.path.exists(file_name)):
-            raise IOError("ERROR: file not found "+file_name)
-            
-        ## Count total number of particles/halos in all data blocks
-        self.num_halos = 0
-        self.total_particles = 0  #AllParticles
-        while os.path.exists(file_name):
-            f = open(file_name)
-            h = f.read(numheaderbytes)
-            (magic,self.snap_num,chunk,self.scale,self.Om,self.Ol,self.h0,\
-             bounds1,bounds2,bounds3,bounds4,bounds5,bounds6,\
-             num_halos,num_particles,\
-             self.boxsize,self.particle_mass,self.particle_type) = struct.unpack(headerfmt,h)
-            self.num_halos += num_halos
-            self.total_particles += num_particles #AllParticles
-            f.close()
-            file_num += 1
+        cachehit = False
+        if cache and not lazy and not AllParticles:
+            cachepath = rs_cachepath(dir,snap_num,version,base=base,digits=digits)
+            stamps = rs_sourcestamps(getfilename,None if noparents else dir+'/'+base+str(snap_num).zfill(digits)+'/parents.list')
+            if len(stamps) > 0:
+                cachehit = self._read_cache(cachepath,stamps,sort_by,noparents,cacherows)
+                if cachehit and cacherows is not None:
+                    self.cacherows = cacherows
+                    self._badrows = np.setdiff1d(np.arange(self.num_halos),cacherows)
+                    self.num_halos = len(self.data)
+
+        if not cachehit:
+            file_num = 0
             file_name = getfilename(file_num)
-        ## Initialize empty data structure
-        data = np.zeros(self.num_halos,dtype=varlist)
-        files = np.array(['']*self.num_halos, dtype='|S'+str(len(file_name)*2))
-        if AllParticles:
-            self.particles = np.array([])
-            # self.particles=np.array([-1]*self.total_particles)
-
-        ## Now, read in the actual data
-        file_num = 0 # reset file name
-        file_name = getfilename(file_num)
-        i = 0
-        particleID_start2 = 0 
-        while os.path.exists(file_name):
-            f = open(file_name)
-            h = f.read(numheaderbytes)
-            num_halos,num_particles = struct.unpack(("x"*64)+"qq"+("x"*16)+"x"*(256-96),h)            
-            # note this is current block's num_halos, not the total self.num_halos
-            particleID_start = struct.calcsize(headerfmt)+num_halos*struct.calcsize(datatypesstr)
-
-            for j in xrange(num_halos):
-                line = f.read(numbytes)
-                data[i] = struct.unpack(datatypesstr,line)+(0,0,0)
-                data[i][-2] = particleID_start  # offset
-                data[i][-1] = particleID_start2 # particle_offset
-                files[i] = file_name
-                particleID_start  += self.particlebytes * data[self.num_p][i]
-                particleID_start2 += data[self.num_p][i]
-                i += 1
+            if (not os.path.exists(file_name)):
+                raise IOError("ERROR: file not found "+file_name)
+            
+            ## Count total number of particles/halos in all data blocks
+            ## from the headers only
+            blockfiles = []; blockhalos = []; blockparticles = []
+            while os.path.exists(file_name):
+                f = open(file_name,'rb')
+                h = f.read(numheaderbytes)
+                (magic,self.snap_num,chunk,self.scale,self.Om,self.Ol,self.h0,\
+                 bounds1,bounds2,bounds3,bounds4,bounds5,bounds6,\
+                 num_halos,num_particles,\
+                 self.boxsize,self.particle_mass,self.particle_type) = struct.unpack(headerfmt,h)
+                blockfiles.append(file_name)
+                blockhalos.append(num_halos)
+                blockparticles.append(num_particles)
+                f.close()
+                file_num += 1
+                file_name = getfilename(file_num)
+            self.num_halos = int(np.sum(blockhalos))
+            self.total_particles = int(np.sum(blockparticles)) #AllParticles
+            blockstarts = np.cumsum(blockhalos)-blockhalos
+            diskdtype = rs_diskdtype(datatypesstr,varlist)
+            if lazy:
+                keep = ['id',self.num_p,'hostID','offset','particle_offset']
+                if sort_by != None: keep.append(sort_by)
+                if unboundfrac != None: keep += ['mgrav','mvir']
+                if columns != None: keep += list(columns)
+                for col in keep:
+                    if col not in varlist.names:
+                        raise KeyError("No column "+col+" in version "+str(version))
+                self._diskvarlist = varlist
+                varlist = np.dtype([(name,varlist[name]) for name in varlist.names if name in keep])
+                loadnames = [name for name in diskdtype.names if name in keep]
+                self._diskdtype = diskdtype
+            else:
+                loadnames = diskdtype.names
+
+            ## Initialize empty data structure
+            data = np.zeros(self.num_halos,dtype=varlist)
+            files = np.array(['']*self.num_halos, dtype='|S'+str(max([len(x) for x in blockfiles])*2))
 
+            ## Now, read in the actual data
+            ## Each block's halo records are read in one go with a packed dtype
+            ## into its own slice of data, so blocks can be decoded concurrently
+            def readblock(k):
+                file_name = blockfiles[k]; num_halos = blockhalos[k]
+                with open(file_name,'rb') as f:
+                    f.seek(numheaderbytes)
+                    if lazy and num_halos > 0:
+                        block = np.memmap(file_name,dtype=diskdtype,mode='r',offset=numheaderbytes,shape=(num_halos,))
+                    else:
+                        block = np.fromfile(f,dtype=diskdtype,count=num_halos)
+                    if len(block) != num_halos:
+                        raise IOError("ERROR: file truncated "+file_name)
+                    rows = slice(blockstarts[k],blockstarts[k]+num_halos)
+                    for name in loadnames:
+                        data[name][rows] = block[name]
+                    npart = data[self.num_p][rows]
+                    data['offset'][rows] = struct.calcsize(headerfmt)+num_halos*numbytes + self.particlebytes*(np.cumsum(npart)-npart)
+                    files[rows] = file_name
+                    particles = None
+                    if AllParticles and blockparticles[k] != 0:
+                        # read the rest of the file; the lazy memmap leaves f at the header
+                        f.seek(numheaderbytes+num_halos*numbytes)
+                        particles = np.fromfile(f,dtype=np.int64)
+                if not lazy: block = None
+                return block,particles
+            if numthreads > 1 and len(blockfiles) > 1:
+                pool = ThreadPool(min(numthreads,len(blockfiles)))
+                try:
+                    results = pool.map(readblock,range(len(blockfiles)))
+                finally:
+                    pool.close()
+            else:
+                results = map(readblock,range(len(blockfiles)))
+            # particles of each halo follow those of the previous halo, across block files
+            npart = data[self.num_p]
+            data['particle_offset'] = np.cumsum(npart)-npart
             if AllParticles:
-                line = f.read() # read the rest of the file
-                ## DEBUG: this ratio should be 1
-                if num_particles != 0:
-                    #assert(len(line)/float(self.particlebytes))/num_particles == 1
-                    nppf=int(len(line)/float(self.particlebytes))
-                    self.particles = np.concatenate((self.particles, np.array(struct.unpack("q"*nppf,line))))
-                    #self.particles[part_fpos:part_fpos+num_particles]=np.array(struct.unpack("q"*num_particles,line))
-            f.close()
-            file_num += 1
-            file_name = getfilename(file_num)
+                particlelist = [particles for block,particles in results if particles is not None]
+            if lazy:
+                self._memmaps = [block for block,particles in results if len(block) > 0]
+                self._filestarts = [start for start,(block,particles) in zip(blockstarts,results) if len(block) > 0]
+
+            if lazy:
+                self._filestarts = np.array(self._filestarts)
+                self._diskrow = pandas.Series(np.arange(self.num_halos),index=data['id'])
 
-        if sort_by != None:
-            sortedIndices = data[sort_by].argsort()[::-1]
-            data = data[sortedIndices]
-            files= files[sortedIndices]
+            if sort_by != None:
+                sortedIndices = data[sort_by].argsort()[::-1]
+                data = data[sortedIndices]
+                files= files[sortedIndices]
 
-        if len(files)==0:
-            raise RuntimeError("No halos in snap %i" % (snap_num))
+            if len(files)==0:
+                raise RuntimeError("No halos in snap %i" % (snap_num))
 
-        self.files = pandas.DataFrame(files, index=data['id'].astype(int),columns=['file'])
-        self.data = pandas.DataFrame(data,index=data['id'])
+            self.files = pandas.DataFrame(files, index=data['id'].astype(int),columns=['file'])
+            self.data = pandas.DataFrame(data,index=data['id'])
 
-        if AllParticles:
-            self.particles = self.particles.astype(int)
+            if AllParticles:
+                if len(particlelist) > 0:
+                    self.particles = np.concatenate(particlelist).astype(int)
+                else:
+                    self.particles = np.array([],dtype=int)
 
-        if not noparents:
-            parents = rp.readParents(dir+'/'+base+str(snap_num).zfill(digits),'parents.list',self.num_halos)
-            self.data['hostID'].ix[parents[:,0]] = parents[:,1]
+            if not noparents:
+                parents = rp.readParents(dir+'/'+base+str(snap_num).zfill(digits),'parents.list',self.num_halos,cache=cache)
+                self.data['hostID'].ix[parents[:,0]] = parents[:,1]
+            if cache and not lazy and not AllParticles:
+                self._write_cache(cachepath,stamps,sort_by,noparents)
 
         assert (unboundfrac == None) or (minboundpart == None)
         self.unboundfrac = unboundfrac
@@ -332,9 +565,131 @@ class RSDataReader:
             self.data = self.data.ix[iibound]
             self.num_halos = len(self.data)
 
-        self.ix = self.data.ix
+        if lazy:
+            self.ix = _LazyIndexer(self)
+        else:
+            self.ix = self.data.ix
         self.index = self.data.index
 
+    def _read_cache(self, cachepath, stamps, sort_by, noparents, rows=None):
+        """
+        Fill in self.data/self.files from a cache directory. Returns False if it is missing or stale
+        @param rows: positions of the cached rows to read (default all)
+        """
+        try:
+            with open(cachepath+'/meta.p','rb') as f:
+                meta = pickle.load(f)
+        except (IOError,EOFError,pickle.UnpicklingError):
+            return False
+        if meta['stamps'] != stamps or meta['sort_by'] != sort_by or meta['noparents'] != noparents:
+            return False
+        for key,val in meta['header'].items():
+            setattr(self,key,val)
+        self._cachepath = cachepath
+        self.data,self.files = self._read_cache_rows(cachepath,meta,rows)
+        return True
+
+    def _read_cache_rows(self, cachepath, meta, rows=None):
+        """ @return: data, files DataFrames of the given cached rows (default all) """
+        names = meta['names']
+        if rows is None:
+            cols = [np.load(cachepath+'/col%03i.npy' % i) for i in range(len(names))]
+            filenum = np.load(cachepath+'/filenum.npy')
+        else:
+            cols = [np.load(cachepath+'/col%03i.npy' % i,mmap_mode='r')[rows] for i in range(len(names))]
+            filenum = np.load(cachepath+'/filenum.npy',mmap_mode='r')[rows]
+        ids = cols[names.index('id')]
+        data = pandas.DataFrame(dict(zip(names,cols)),index=ids,columns=names)
+        files = pandas.DataFrame(np.array(meta['filenames'])[filenum],index=ids.astype(int),columns=['file'])
+        return data,files
+
+    @property
+    def badhalos(self):
+        """
+        Rows left out by cacherows (or set by haloutils.load_rscat's rmaxcut), read from the
+        cache on first access. None if no rows were left out.
+        """
+        if self._badhalos is None and self._badrows is not None:
+            with open(self._cachepath+'/meta.p','rb') as f:
+                meta = pickle.load(f)
+            self._badhalos = self._read_cache_rows(self._cachepath,meta,self._badrows)[0]
+            for name,values in self._badcolumns.items():
+                self._badhalos[name] = values
+        return self._badhalos
+
+    def _write_cache(self, cachepath, stamps, sort_by, noparents):
+        """ Save self.data/self.files to cachepath (written to a temporary directory, then renamed) """
+        header = {}
+        for key in ['snap_num','scale','Om','Ol','h0','boxsize','particle_mass','particle_type','num_halos','total_particles']:
+            header[key] = getattr(self,key)
+        filenames,filenum = np.unique(np.array(self.files['file']),return_inverse=True)
+        names = list(self.data.columns)
+        meta = {'stamps':stamps,'sort_by':sort_by,'noparents':noparents,'header':header,
+                'names':names,'filenames':list(filenames)}
+        tmppath = cachepath+'.tmp'+str(os.getpid())
+        try:
+            if not os.path.exists(tmppath): os.makedirs(tmppath)
+            for i,name in enumerate(names):
+                np.save(tmppath+'/col%03i.npy' % i,np.array(self.data[name]))
+            np.save(tmppath+'/filenum.npy',filenum)
+            with open(tmppath+'/meta.p','wb') as f:
+                pickle.dump(meta,f,pickle.HIGHEST_PROTOCOL)
+            if os.path.exists(cachepath): shutil.rmtree(cachepath)
+            os.rename(tmppath,cachepath)
+        except (IOError,OSError) as e:
+            warnings.warn("Could not write rockstar cache "+cachepath+": "+str(e))
+            shutil.rmtree(tmppath,ignore_errors=True)
+
+    def _read_disk_column(self, name, rows=None):
+        """
+        Decode one on-disk column from the memory-mapped blocks (lazy mode).
+        @param rows: positions in file order (all halos if None)
+        """
+        dtype = self._diskvarlist[name]
+        if rows is None:
+            if len(self._memmaps)==0: return np.array([],dtype=dtype)
+            return np.concatenate([mm[name] for mm in self._memmaps]).astype(dtype)
+        rows = np.asarray(rows)
+        out = np.zeros(len(rows),dtype=dtype)
+        filenum = np.searchsorted(self._filestarts,rows,side='right')-1
+        for k in np.unique(filenum):
+            ii = filenum==k
+            out[ii] = self._memmaps[k][name][rows[ii]-self._filestarts[k]]
+        return out
+
+    def _missing_columns(self, names=None):
+        if names is None: names = self._diskdtype.names
+        return [name for name in names if name in self._diskdtype.names and name not in self.data.columns]
+
+    def _fill_missing_rows(self, out):
+        """
+        Lazy mode: add the undecoded columns to a row selection of self.data,
+        reading just those rows from the memory-mapped blocks.
+        """
+        missing = self._missing_columns()
+        if len(missing)==0: return out
+        if isinstance(out,pandas.Series):
+            rows = self._diskrow.ix[[out.name]].values
+            extra = pandas.Series([self._read_disk_column(name,rows)[0] for name in missing],index=missing,name=out.name)
+            return pandas.concat([out,extra])
+        out = out.copy()
+        rows = self._diskrow.ix[out.index].values
+        for name in missing:
+            out[name] = self._read_disk_column(name,rows)
+        return out
+
+    def load_columns(self, names=None):
+        """
+        Lazy mode: decode the given columns (default: all remaining) into self.data.
+        Does nothing for columns that are already loaded.
+        """
+        if not self.lazy: return
+        if isinstance(names,basestring): names = [names]
+        for name in self._missing_columns(names):
+            # align on halo id so any sorting/cuts applied to self.data carry over
+            rows = self._diskrow.ix[self.data.index].values
+            self.data[name] = self._read_disk_column(name)[rows]
+
     def get_particles_from_halo(self, haloID):
         """
         @param haloID: id number of halo. Not its row position in matrix
@@ -357,12 +712,80 @@ class RSDataReader:
             f.close()
             return particleIDs
 
+    def _get_hierarchy(self):
+        """
+        CSR-style index of the host -> subhalo relation: hostIDs sorted (stably) with
+        the row positions that sort them. Rebuilt whenever self.data is replaced
+        or hostID is set through rscat['hostID'] = ...
+        """
+        if self._hierarchy is None or self._hierarchy[0] is not self.data:
+            hostIDs = np.array(self.data['hostID'])
+            order = np.argsort(hostIDs,kind='mergesort')
+            self._hierarchy = (self.data,hostIDs[order],order,np.array(self.data['id']))
+        return self._hierarchy[1:]
+
+    def get_subhalo_rows(self,haloIDs):
+        """
+        First level subhalos of many hosts at once.
+        @return: rows, offsets. rows[offsets[i]:offsets[i+1]] are the row positions
+                 (for self.data.iloc) of the subhalos of haloIDs[i], in catalogue order
+        """
+        sortedhosts,order,ids = self._get_hierarchy()
+        haloIDs = np.ravel(haloIDs)
+        lo = np.searchsorted(sortedhosts,haloIDs,side='left')
+        hi = np.searchsorted(sortedhosts,haloIDs,side='right')
+        offsets = np.concatenate(([0],np.cumsum(hi-lo)))
+        return order[expand_ranges(lo,hi-lo)],offsets
+
+    def get_descendant_ids(self,haloIDs):
+        """
+        ids of all subhalos, sub-subhalos, etc. of haloIDs, one level after another
+        """
+        sortedhosts,order,ids = self._get_hierarchy()
+        level = np.ravel(haloIDs)
+        out = []
+        while len(level) > 0:
+            rows,offsets = self.get_subhalo_rows(level)
+            level = ids[rows]
+            out.append(level)
+        if len(out)==0: return np.array([],dtype=ids.dtype)
+        return np.concatenate(out)
+
+    def get_particles_from_halos(self, haloIDs):
+        """
+        Batched version of get_particles_from_halo.
+        @param haloIDs: array of halo id numbers
+        @return: pids, offsets. pids is one int64 array; pids[offsets[i]:offsets[i+1]]
+                 are the particle IDs of haloIDs[i]
+        Without AllParticles, each block file is memory-mapped once and all requested
+        ranges in it are gathered in a single fancy-index.
+        """
+        haloIDs = np.ravel(haloIDs)
+        counts = np.array(self.data[self.num_p].ix[haloIDs]).astype(np.int64)
+        offsets = np.concatenate(([0],np.cumsum(counts)))
+        pids = np.zeros(offsets[-1],dtype=np.int64)
+        if self.AllParticles:
+            starts = np.array(self.data['particle_offset'].ix[haloIDs]).astype(np.int64)
+            pids[:] = self.particles[expand_ranges(starts,counts)]
+            return pids,offsets
+        files = np.array(self.files['file'].ix[haloIDs])
+        starts = np.array(self.data['offset'].ix[haloIDs]).astype(np.int64)//self.particlebytes
+        for file_name in np.unique(files):
+            ii = np.where(files==file_name)[0]
+            ii = ii[counts[ii] > 0]
+            if len(ii)==0: continue
+            particles = np.memmap(file_name,dtype=np.int64,mode='r')
+            pids[expand_ranges(offsets[ii],counts[ii])] = particles[expand_ranges(starts[ii],counts[ii])]
+            del particles
+        return pids,offsets
+
     def get_subhalos_from_halo(self,haloID):
         """
         # Retrieve subhalos only one level deep.
         # Does not get sub-sub halos, etc.
         """
-        return self.data[self.data['hostID']==haloID]
+        rows,offsets = self.get_subhalo_rows(haloID)
+        return self.data.iloc[rows]
 
     def get_subhalos_from_halos(self,haloIDs):
         """
@@ -371,18 +794,18 @@ class RSDataReader:
         # for multiple halos, returns the subhalos of each halo as an array of arrays.
         """
         if type(haloIDs) == list or type(haloIDs) == np.ndarray:
-            return np.array([ self.data[self.data['hostID']==ID] for ID in haloIDs])
+            rows,offsets = self.get_subhalo_rows(haloIDs)
+            return np.array([ self.data.iloc[rows[offsets[i]:offsets[i+1]]] for i in range(len(haloIDs))])
         else:
-            return self.data[self.data['hostID']==haloIDs] 
+            return self.get_subhalos_from_halo(haloIDs)
 
     def get_subhalos_from_halos_flat(self,haloIDs):
         """
         returns a flattened pandas data frame of all subhalos within
         the hosts given by haloIDs. Returns only first level of subhalos.
         """
-        subs = self.get_subhalo_ids_from_halos(haloIDs)
-        subIDs = [item for sublist in subs for item in sublist]
-        return self.data.ix[subIDs]
+        rows,offsets = self.get_subhalo_rows(haloIDs)
+        return self.data.iloc[rows]
     
     def get_hosts(self):
         return self.data[self.data['hostID']==-1]
@@ -391,22 +814,22 @@ class RSDataReader:
         return self.data[self.data['hostID']!=-1]
 
     def get_subhalo_ids_from_halos(self,haloIDs):
+        sortedhosts,order,ids = self._get_hierarchy()
+        rows,offsets = self.get_subhalo_rows(haloIDs)
         if type(haloIDs) == list or type(haloIDs) == np.ndarray:
-            return np.array([ np.array(self.data[self.data['hostID']==ID]['id']) for ID in haloIDs])
+            return np.array([ ids[rows[offsets[i]:offsets[i+1]]] for i in range(len(haloIDs))])
         else:
-            return np.array([self.data[self.data['hostID']==haloIDs]['id']])
+            return np.array([ids[rows]])
 
     def get_all_subs_recurse(self,haloID):
         """
         # Retrieve all subhalos: sub and sub-sub, etc. 
         # just need mask of all subhalos, then return data frame subset
         """
-        subs = self.get_subhalo_ids_from_halos(haloID)
-        subs = [item for sublist in subs for item in sublist]
-        if subs == []:
+        subs = self.get_descendant_ids(haloID)
+        if len(subs)==0:
             return [] 
-        else:
-            return np.append(subs,self.get_all_subs_recurse(subs))
+        return subs
                                        
     def get_all_subhalos_from_halo(self,haloID):
         """
@@ -416,6 +839,50 @@ class RSDataReader:
         return self.data.ix[self.get_all_subs_recurse(haloID)]
 
         
+    def get_kdtree(self):
+        """
+        Periodic (in boxsize) scipy cKDTree on posX,posY,posZ. Built on first use
+        and rebuilt whenever self.data is replaced. Tree indices are row positions.
+        """
+        if self._kdtree is None or self._kdtree[0] is not self.data:
+            from scipy.spatial import cKDTree
+            pos = np.array(self[['posX','posY','posZ']]).astype(float)
+            self._kdtree = (self.data,cKDTree(np.mod(pos,self.boxsize),boxsize=self.boxsize),pos)
+        return self._kdtree[1]
+
+    def query_ball(self, centers, radius):
+        """
+        @param centers: one position or an (N,3) array of positions (Mpc/h)
+        @param radius: scalar or array of N radii (Mpc/h)
+        @return: rows, offsets. rows[offsets[i]:offsets[i+1]] are the sorted row
+                 positions of the halos within radius[i] of centers[i]
+        """
+        tree = self.get_kdtree()
+        centers = np.mod(np.reshape(centers,(-1,3)),self.boxsize)
+        radius = np.zeros(len(centers))+radius
+        found = [np.sort(tree.query_ball_point(c,r)) for c,r in zip(centers,radius)]
+        offsets = np.concatenate(([0],np.cumsum([len(x) for x in found]))).astype(int)
+        if offsets[-1]==0: return np.array([],dtype=int),offsets
+        return np.concatenate(found).astype(int),offsets
+
+    def query_nearest(self, centers, k=1):
+        """
+        @param centers: one position or an (N,3) array of positions (Mpc/h)
+        @return: dists, rows of the k nearest halos of each centre (periodic distances in Mpc/h)
+        """
+        tree = self.get_kdtree()
+        centers = np.mod(np.reshape(centers,(-1,3)),self.boxsize)
+        return tree.query(centers,k=k)
+
+    def _get_halos_within(self, haloID, radius):
+        """ halos within radius (kpc) of haloID, excluding haloID itself, in catalogue order """
+        halopos = np.array(self.ix[haloID][['posX','posY','posZ']]).astype(float)
+        # pad the search radius slightly, the exact cut is done on the candidates
+        rows,offsets = self.query_ball(halopos,radius/1000.*(1+1e-8))
+        halos = self.data.iloc[rows]
+        dists = distance(self._kdtree[2][rows],halopos,boxsize=self.boxsize)*1000
+        return halos[(dists<radius)*(dists>0)]
+
     def get_subhalos_within_halo(self, haloID, radius=None):
         """
         # return all halos within radis of halo specified by haloID
@@ -424,8 +891,7 @@ class RSDataReader:
         """
         if radius==None:
             radius = float(self.ix[haloID]['rvir'])
-        dists = distance(np.array(self[['posX','posY','posZ']]), np.array(self.ix[haloID][['posX','posY','posZ']]))*1000
-        halos = self[(dists<radius)*(dists>0)] # exclude host
+        halos = self._get_halos_within(haloID,radius) # exclude host
         halos = halos[np.logical_or(halos['hostID']==haloID,halos['hostID']==-1)] # only take 1 level deep halos
         return halos
 
@@ -436,9 +902,7 @@ class RSDataReader:
         """
         if radius==None:
             radius = float(self.ix[haloID]['rvir'])
-        dists = distance(np.array(self[['posX','posY','posZ']]), np.array(self.ix[haloID][['posX','posY','posZ']]))*1000
-        halos = self[(dists<radius)*(dists>0)] # exclude host
-        return halos
+        return self._get_halos_within(haloID,radius) # exclude host
                 
 
     def get_all_sub_particles_from_halo(self,haloID):
@@ -446,25 +910,16 @@ class RSDataReader:
         returns int array of particle IDs belonging to all substructure
         within host of haloID
         # updated 3/26 2013 to include support for array/list input of haloID. Also streamlined the code.
+        For array/list input, returns a list with one int array per host.
         """
-        if type(haloID) == list or type(haloID)==np.ndarray:
+        def getsubids(ID):
             if self.version>=7:
-                subids = [self.get_subhalos_from_halo(id)['id'] for id in haloID]
-            else:
-                subids = [self.get_all_subhalos_from_halo(id)['id'] for id in haloID]
-            idlist = [[item for s in sid for item in self.get_particles_from_halo(s)] for sid in subids]
-            return idlist
+                return np.array(self.get_subhalos_from_halo(ID)['id'])
+            return np.array(self.get_all_subhalos_from_halo(ID)['id'])
+        if type(haloID) == list or type(haloID)==np.ndarray:
+            return [self.get_particles_from_halos(getsubids(ID))[0] for ID in haloID]
         else:
-            if self.version>=7:
-                subids = self.get_subhalos_from_halo(haloID)['id']
-            else:
-                subids = self.get_all_subhalos_from_halo(haloID)['id']
-            return [item for s in subids for item in self.get_particles_from_halo(s)]
-            # old method
-            # idlist = np.array([])
-            #for sid in subids:
-            #    idlist = np.append(idlist, self.get_particles_from_halo(sid))
-            #return idlist.astype(int)
+            return self.get_particles_from_halos(getsubids(haloID))[0]
 
     def get_all_particles_from_halo(self,haloID):
         """
@@ -484,18 +939,62 @@ class RSDataReader:
         subdat = self.get_all_subhalos_from_halo(haloID)
         return thisnum + np.sum(subdat['npart'])
 
+    def _get_boundindex(self):
+        """
+        Sorted index of iterboundindex.csv (hid -> loc, numbound) and a memory map
+        of iterboundparts.dat, built on first use.
+        """
+        if self._boundlookup is None:
+            hids = np.array(self.boundindex['hid']).astype(np.int64)
+            order = np.argsort(hids,kind='mergesort')
+            locs = np.array(self.boundindex['loc']).astype(np.int64)[order]
+            numbound = np.array(self.boundindex['numbound']).astype(np.int64)[order]
+            if os.path.getsize(self.boundpartspath) % self.particlebytes == 0 and np.all(locs % self.particlebytes == 0):
+                parts = np.memmap(self.boundpartspath,dtype=np.int64,mode='r')
+            else:
+                parts = None
+            self._boundlookup = (hids[order],locs,numbound,parts)
+        return self._boundlookup
+
+    def _boundindex_rows(self,haloIDs):
+        sortedhids,locs,numbound,parts = self._get_boundindex()
+        haloIDs = np.ravel(haloIDs)
+        rows = np.searchsorted(sortedhids,haloIDs)
+        found = rows < len(sortedhids)
+        found[found] = sortedhids[rows[found]] == haloIDs[found]
+        if not np.all(found):
+            raise KeyError("halos not in iterboundindex: "+str(haloIDs[~found]))
+        return rows
+
     def get_bound_particles_from_halo(self,haloID):
+        """
+        @return: int64 array (a view of the memory-mapped iterboundparts.dat) of the bound particle IDs of haloID
+        """
         assert self.minboundpart != None        
-        ixid = self.boundindex['hid']
-        row = np.where(ixid==haloID)[0][0]
-        loc = self.boundindex[row]['loc']
-        numbound = self.boundindex[row]['numbound']
-        fmt = "q"*numbound
-        with open(self.boundpartspath,'rb') as f:
-            f.seek(loc)
-            line = f.read(struct.calcsize(fmt))
-            boundids = struct.unpack(fmt,line)
-        return boundids
+        sortedhids,locs,numbound,parts = self._get_boundindex()
+        row = self._boundindex_rows(haloID)[0]
+        if parts is None:
+            return np.memmap(self.boundpartspath,dtype=np.int64,mode='r',offset=locs[row],shape=(numbound[row],))
+        start = locs[row]//self.particlebytes
+        return parts[start:start+numbound[row]]
+
+    def get_bound_particles_from_halos(self,haloIDs):
+        """
+        Batched version of get_bound_particles_from_halo.
+        @return: pids, offsets. pids is one int64 array; pids[offsets[i]:offsets[i+1]]
+                 are the bound particle IDs of haloIDs[i]
+        """
+        assert self.minboundpart != None        
+        sortedhids,locs,numbound,parts = self._get_boundindex()
+        rows = self._boundindex_rows(haloIDs)
+        counts = numbound[rows]
+        offsets = np.concatenate(([0],np.cumsum(counts)))
+        if parts is None:
+            pids = np.zeros(offsets[-1],dtype=np.int64)
+            for i,row in enumerate(rows):
+                pids[offsets[i]:offsets[i+1]] = self.get_bound_particles_from_halo(sortedhids[row])
+            return pids,offsets
+        return parts[expand_ranges(locs[rows]//self.particlebytes,counts)],offsets
         
     def get_block_from_halo(self, snapshot_dir, haloID, blockname, allparticles=True):
         if allparticles:
@@ -504,7 +1003,7 @@ class RSDataReader:
             pids = self.get_particles_from_halo(haloID)
         pids = np.sort(pids)
         path = snapshot_dir+'/snapdir_'+str(self.snap_num).zfill(3)+'/snap_'+str(self.snap_num).zfill(3)
-        return rsg.read_block(path, blockname,parttype=1,ids=pids)
+        return rsg.read_blocks_by_id(path, [blockname], pids, parttype=1)[0]
 
     # compute hubble value for this catalogue
     # return value in km/s/Mpc
@@ -519,39 +1018,80 @@ class RSDataReader:
         pids = self.get_all_particles_from_halo(haloID)
         pids = np.sort(pids)
         path = snapshot_dir+'/snapdir_'+str(self.snap_num).zfill(3)+'/snap_'+str(self.snap_num).zfill(3)
-        pot = rsg.read_block(path, "POT ", parttype=1, ids=pids)/self.scale
+        pot = rsg.read_blocks_by_id(path, ["POT "], pids, parttype=1)[0]/self.scale
         boundsort = np.argsort(pot)
         return pids[boundsort]
 
-    # Get most bound particles in a halo
-    # Use gadget Potential block if it exists, otherwise compute estimate of it.
-    def get_most_bound_particles_from_halo(self, snapshot_dir, haloID):
-        pids = self.get_all_particles_from_halo(haloID)
-        pids = np.sort(pids)
-        path = snapshot_dir+'/snapdir_'+str(self.snap_num).zfill(3)+'/snap_'+str(self.snap_num).zfill(3)
-    
-        pos = rsg.read_block(path, "POS ", parttype=1, ids=pids)
-        vel = rsg.read_block(path, "VEL ", parttype=1, ids=pids)*np.sqrt(self.scale)
-        halopos = np.array(self.ix[haloID][['posX','posY','posZ']])
-        halovel = np.array(self.ix[haloID][['pecVX','pecVY','pecVZ']])
-        
-        peculiarVel = vel-halovel
-        Hflow = self.H()*(pos-halopos)*self.scale/self.h0
-        physicalVel = peculiarVel+Hflow
-        T = .5*sum((physicalVel**2).T)    
+    def get_all_particles_from_halos(self,haloIDs):
+        """
+        Batched version of get_all_particles_from_halo.
+        @return: pids, offsets. pids[offsets[i]:offsets[i+1]] are all particles of haloIDs[i]
+                 (the halo's own particles first, then those of its subhalos)
+        """
+        haloIDs = np.ravel(haloIDs)
+        if self.version>=7:
+            return self.get_particles_from_halos(haloIDs)
+        members = [np.append([haloID],self.get_descendant_ids([haloID])) for haloID in haloIDs]
+        nmembers = np.array([len(m) for m in members],dtype=np.int64)
+        pids,memberoffsets = self.get_particles_from_halos(np.concatenate(members) if len(members) > 0 else [])
+        return pids,memberoffsets[np.concatenate(([0],np.cumsum(nmembers)))]
 
-        try:
-            U = rsg.read_block(path, "POT ", parttype=1, ids=pids)/self.scale
-        except:
-            print 'computing potential instead'
-            dr = distance(pos,halopos,boxsize=self.boxsize)*self.scale/self.h0#in Mpc physical
-            mask = dr==0
-            dr=dr[~mask]
-            U = self.PotentialE(dr)
+    def get_most_bound_particles_from_halos(self, snapshot_dir, haloIDs, usepot=True, energies=False):
+        """
+        Binding energies of the particles of many halos at once. POS, VEL (and POT) are
+        read once for the union of all their particles.
+        Use gadget Potential block if it exists (and usepot), otherwise compute the
+        spherical potential of each halo's particles with spherical_potentials.
+        @return: pids, offsets. pids[offsets[i]:offsets[i+1]] are all particles of haloIDs[i]
+                 sorted from most to least bound. If energies, also returns T, U, Etot in the same order
+        """
+        haloIDs = np.ravel(haloIDs)
+        pids,offsets = self.get_all_particles_from_halos(haloIDs)
+        group = np.repeat(np.arange(len(haloIDs)),np.diff(offsets))
+        T = np.zeros(len(pids)); U = np.zeros(len(pids))
+        if len(pids) > 0:
+            upids = np.unique(pids)
+            prow = np.searchsorted(upids,pids)
+            path = snapshot_dir+'/snapdir_'+str(self.snap_num).zfill(3)+'/snap_'+str(self.snap_num).zfill(3)
+            snap = rsg.snapshot(path)
+            try:
+                pos,vel = snap.read_blocks_by_id(["POS ","VEL "], upids, parttype=1)
+                pos = pos[prow]
+                vel = vel[prow]*np.sqrt(self.scale)
+                halopos = np.array(self.data[['posX','posY','posZ']].ix[haloIDs])[group]
+                halovel = np.array(self.data[['pecVX','pecVY','pecVZ']].ix[haloIDs])[group]
+
+                dpos = pos-halopos
+                dpos -= self.boxsize*np.round(dpos/self.boxsize)
+                physicalVel = vel-halovel + self.H()*dpos*self.scale/self.h0
+                T = .5*np.sum(physicalVel**2,axis=1)
+
+                # read_rows exits if a subfile lacks the block, so check every subfile with type 1 particles
+                havepot = usepot and all([snap.contains(num,1,'Potential') for num in np.flatnonzero(snap.npart[:,1])])
+                if usepot and not havepot:
+                    print 'no Potential block, computing potential instead'
+                if havepot:
+                    try:
+                        U = snap.read_blocks_by_id(["POT "], upids, parttype=1)[0][prow]/self.scale
+                    except IOError as e:
+                        print 'could not read Potential block ('+str(e)+'), computing potential instead'
+                        havepot = False
+            finally:
+                snap.close()
+            if not havepot:
+                dr = np.sqrt(np.sum(dpos**2,axis=1))*self.scale/self.h0 #in Mpc physical
+                U = spherical_potentials(dr,offsets,self.particle_mass/self.h0)
 
         Etot = T + U
-        boundsort = np.argsort(Etot)
-        return pids[boundsort]
+        boundsort = np.lexsort((Etot,group))
+        if energies:
+            return pids[boundsort],offsets,T[boundsort],U[boundsort],Etot[boundsort]
+        return pids[boundsort],offsets
+
+    # Get most bound particles in a halo
+    # Use gadget Potential block if it exists, otherwise compute estimate of it.
+    def get_most_bound_particles_from_halo(self, snapshot_dir, haloID):
+        return self.get_most_bound_particles_from_halos(snapshot_dir,[haloID])[0]
 
     def get_bound_subhalos_from_halo(self, hpath,haloID):
         subids = np.array(self.get_all_subhalos_from_halo(haloID)['id'])
@@ -571,10 +1111,8 @@ class RSDataReader:
         pids = self.get_all_particles_from_halo(haloID)
         path = hpath+'/outputs/snapdir_'+str(self.snap_num).zfill(3)+'/snap_'+str(self.snap_num).zfill(3)
     
-        ppos = rsg.read_block(path, "POS ", parttype=1, ids=np.sort(pids))
+        ppos = rsg.read_blocks_by_id(path, ["POS "], np.sort(pids), parttype=1)[0]
         drp = distance(ppos,halopos,boxsize=self.boxsize)*self.scale/self.h0#in Mpc physical
-        mask = drp==0
-        drp=drp[~mask]
         U = self.PotentialE_halos(drp,drhalos)
 
         Etot = T + U
@@ -582,62 +1120,16 @@ class RSDataReader:
         return T[boundsort],U[boundsort],Etot[boundsort],subids[boundsort]
 
     def PotentialE_halos(self, dr,drhalos):
-        from scipy import interpolate
-        from scipy.integrate import quad
-        G = 1.326*10**11 # in km^3/s^2/Msun
-        mpc_to_km = 3.086*10**19
-        
-        rarr = 10**np.linspace(np.log10(min(dr))-.01, np.log10(max(dr))+.01,70) # in Mpc
-        h_r, x_r = np.histogram(dr, bins=np.concatenate(([0],rarr)))
-        m_lt_r = np.cumsum(h_r)*self.particle_mass/self.h0
-        tck = interpolate.splrep(rarr,m_lt_r) # gives mass in Msun
-        def Ufunc(x):
-            return interpolate.splev(x,tck)/(x**2)
-    
-        # do it even faster by using an interpolative function
-        # for computing potential energy
-        # pick 60 - 100 data points
-        # compute potential for all, then use an interpolation scheme
-        U = np.zeros(len(rarr))
-        for i in range(len(rarr)):
-            r = rarr[i]
-            if r > max(dr)+.05:
-                print 'warning - particle outside of halo. likely inaccurate PE'
-                U[i] = -G*m_lt_r[-1]/(r*mpc_to_km)
-            else:
-                tmp = -G*m_lt_r[-1]/(max(dr)*mpc_to_km)
-                U[i] = tmp+G*quad(Ufunc,max(dr),r,full_output=1)[0]/mpc_to_km
-        tck2 = interpolate.splrep(rarr,U)
-        return interpolate.splev(drhalos,tck2)
+        """
+        Potential (km^2/s^2) at radii drhalos of the particles at radii dr (Mpc physical)
+        """
+        return spherical_potential_at(dr,self.particle_mass/self.h0,drhalos)
 
     def PotentialE(self, dr):
-        from scipy import interpolate
-        from scipy.integrate import quad
-        G = 1.326*10**11 # in km^3/s^2/Msun
-        mpc_to_km = 3.086*10**19
-        
-        rarr = 10**np.linspace(np.log10(min(dr))-.01, np.log10(max(dr))+.01,70) # in Mpc
-        h_r, x_r = np.histogram(dr, bins=np.concatenate(([0],rarr)))
-        m_lt_r = np.cumsum(h_r)*self.particle_mass/self.h0
-        tck = interpolate.splrep(rarr,m_lt_r) # gives mass in Msun
-        def Ufunc(x):
-            return interpolate.splev(x,tck)/(x**2)
-    
-        # do it even faster by using an interpolative function
-        # for computing potential energy
-        # pick 60 - 100 data points
-        # compute potential for all, then use an interpolation scheme
-        U = np.zeros(len(rarr))
-        for i in range(len(rarr)):
-            r = rarr[i]
-            if r > max(dr)+.05:
-                print 'warning - particle outside of halo. likely inaccurate PE'
-                U[i] = -G*m_lt_r[-1]/(r*mpc_to_km)
-            else:
-                tmp = -G*m_lt_r[-1]/(max(dr)*mpc_to_km)
-                U[i] = tmp+G*quad(Ufunc,max(dr),r,full_output=1)[0]/mpc_to_km
-        tck2 = interpolate.splrep(rarr,U)
-        return interpolate.splev(dr,tck2)
+        """
+        Potential (km^2/s^2) of each particle at radius dr (Mpc physical) due to all of them
+        """
+        return spherical_potentials(dr,[0,len(dr)],self.particle_mass/self.h0)
 
     def getversion(self):
         if self.version == 2:
@@ -661,9 +1153,18 @@ class RSDataReader:
         return "ERROR: Not a valid version number!"
 
 
-    def to_ascii(self,filename):
+    def to_ascii(self,filename,chunksize=100000,compress=False):
+        """
+        Write the catalogue in rockstar's out_*.list format.
+        Rows are formatted chunksize at a time with a single string format per chunk.
+        @param compress: if True, write gzip-compressed output
+        """
         assert self.version==10
-        with open(filename,'w') as f:
+        if compress:
+            opener = gzip.open
+        else:
+            opener = open
+        with opener(filename,'wb') as f:
             # print first line to match rockstar
             f.write("#id num_p mvir mbound_vir rvir vmax rvmax vrms x y z vx vy vz Jx Jy Jz E Spin PosUncertainty VelUncertainty bulk_vx bulk_vy bulk_vz BulkVelUnc n_core m200b m200c m500c m2500c Xoff Voff spin_bullock b_to_a c_to_a A[x] A[y] A[z] b_to_a(500c) c_to_a(500c) A[x](500c) A[y](500c) A[z](500c) Rs Rs_Klypin T/|U| M_pe_Behroozi M_pe_Diemer Halfmass_Radius idx i_so i_ph num_cp mmetric\n")
             # First line for modified version
@@ -694,10 +1195,10 @@ class RSDataReader:
             #cols = ['id','npart','mvir','mgrav','rvir','vmax','rvmax','vrms','posX','posY','posZ','pecVX','pecVY','pecVZ','Jx','Jy','Jz','Epot','spin','min_pos_err','min_vel_err','bulkvelx','bulkvely','bulkvelz','min_bulkvel_err','n_core','altm1','altm2','altm3','altm4','Xoff','Voff','spin_bullock','b_to_a','c_to_a','A[x]','A[y]','A[z]','b_to_a2','c_to_a2','A2[x]','A2[y]','A2[z]','rs','rs_klypin','T/|U|','m_pe_b','m_pe_d','halfmassrad','num_cp','num_bound','num_iter']
             #fmt = "%i %i %.3e %.3e %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %i %e %e %e %e %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %f %i %i %i\n"
 
-            for i in range(self.num_halos):
-                halo = self.data.iloc[i]
-                data = tuple(np.array(halo[cols]))
-                f.write(fmt % data)
+            self.load_columns(cols)
+            for start in xrange(0,self.num_halos,chunksize):
+                chunk = np.array(self.data.iloc[start:start+chunksize][cols],dtype=np.float64)
+                f.write((fmt*len(chunk)) % tuple(chunk.ravel().tolist()))
             #        id+id_offset,
             #        th->num_p, th->m, th->mgrav, th->r, th->vmax, th->rvmax, th->vrms,
             #        th->pos[0], th->pos[1], th->pos[2], th->pos[3], th->pos[4],
@@ -712,9 +1213,18 @@ class RSDataReader:
             #        i, extra_info[i].sub_of, extra_info[i].ph, th->num_child_particles, extra_info[i].max_metric);
 
     def __getitem__(self,key):
+        if self.lazy:
+            if isinstance(key,basestring):
+                self.load_columns([key])
+            elif type(key) == list or type(key) == tuple:
+                self.load_columns(list(key))
+            else:
+                # row selector (boolean mask or slice): same columns as an eager reader
+                return self._fill_missing_rows(self.data[key])
         return self.data[key]
     def __setitem__(self,key, item):
         self.data[key] = item
+        if key == 'hostID': self._hierarchy = None
     def __len__(self):
         return len(self.data)
     def __repr__(self):
@@ -727,6 +1237,81 @@ class RSDataReader:
         return out + "Sorted by "+self.sort_by    
 
 
+def expand_ranges(starts,counts):
+    """
+    Concatenation of np.arange(starts[i],starts[i]+counts[i]) for all i, without a python loop
+    """
+    starts = np.asarray(starts,dtype=np.int64); counts = np.asarray(counts,dtype=np.int64)
+    offsets = np.cumsum(counts)-counts
+    return np.repeat(starts-offsets,counts)+np.arange(np.sum(counts),dtype=np.int64)
+
+class _LazyIndexer:
+    """
+    Stands in for rscat.ix when RSDataReader is lazy. Indexing with explicit columns
+    decodes those columns; indexing rows only fills in the undecoded columns for just
+    the selected rows, straight from the memory-mapped blocks.
+    """
+    def __init__(self, reader):
+        self.reader = reader
+    def __getitem__(self, key):
+        reader = self.reader
+        if type(key) == tuple and len(key) == 2:
+            cols = key[1]
+            if isinstance(cols,basestring): cols = [cols]
+            if type(cols) == list or type(cols) == np.ndarray:
+                reader.load_columns(list(cols))
+            return reader.data.ix[key]
+        return reader._fill_missing_rows(reader.data.ix[key])
+
+# G in km^3/s^2/Msun and Mpc in km
+G = 1.326*10**11
+mpc_to_km = 3.086*10**19
+
+def spherical_potentials(dr,offsets,mass):
+    """
+    Exact potential of spherical shells: for particle i of a halo,
+    U_i = -G*mass*(N(<=r_i)/r_i + sum_{r_j > r_i} 1/r_j), using the other particles of the same halo.
+    All halos are done at once with one sort and cumulative sums.
+    @param dr: radii in Mpc (physical), dr[offsets[k]:offsets[k+1]] belong to halo k
+    @param mass: particle mass in Msun
+    @return: U in km^2/s^2, in the same order as dr
+    """
+    dr = np.asarray(dr,dtype=np.float64)
+    offsets = np.asarray(offsets,dtype=np.int64)
+    n = len(dr)
+    U = np.zeros(n)
+    if n==0: return U
+    group = np.repeat(np.arange(len(offsets)-1),np.diff(offsets))
+    order = np.lexsort((dr,group))
+    rs = dr[order]; gs = group[order]
+    # last sorted position with the same halo and radius, so ties count as enclosed
+    runend = np.ones(n,dtype=bool)
+    runend[:-1] = (rs[1:] != rs[:-1]) | (gs[1:] != gs[:-1])
+    last = np.arange(n)
+    last = np.minimum.accumulate(np.where(runend,last,n)[::-1])[::-1]
+    inv = np.zeros(n)
+    inv[rs > 0] = 1./rs[rs > 0]
+    cinv = np.concatenate(([0],np.cumsum(inv)))
+    enclosed = (last-offsets[gs]+1)*inv
+    outside = cinv[offsets[gs+1]]-cinv[last+1]
+    U[order] = -G*mass*(enclosed+outside)/mpc_to_km
+    return U
+
+def spherical_potential_at(dr,mass,r):
+    """
+    Potential at radii r (Mpc physical) of particles of mass (Msun) at radii dr
+    @return: U in km^2/s^2
+    """
+    rs = np.sort(np.asarray(dr,dtype=np.float64))
+    r = np.asarray(r,dtype=np.float64)
+    inv = np.zeros(len(rs))
+    inv[rs > 0] = 1./rs[rs > 0]
+    cinv = np.concatenate(([0],np.cumsum(inv)))
+    nle = np.searchsorted(rs,r,side='right')
+    rinv = np.zeros(r.shape)
+    rinv[r > 0] = 1./r[r > 0]
+    return -G*mass*(nle*rinv+cinv[-1]-cinv[nle])/mpc_to_km
+
 # compute distance from posA to posB.
 # posA can be an array. boxsize must be in same units as positions.
 def distance(posA, posB,boxsize=100.):
@@ -0,0 +1,274 @@
+"""
+Benchmark for RSDataReader on a synthetic multi-file Rockstar catalogue.
+
+Usage: python bench_RSDataReader.py [numfiles] [halos_per_file] [version]
+       python bench_RSDataReader.py scaling [totalhalos] [maxthreads]
+       python bench_RSDataReader.py potential [numhalos] [npart]
+
+Writes a fake halos_<snap>/halos_<snap>.<i>.(bound|full)bin catalogue plus
+parents.list into a temporary directory, then times RSDataReader against the
+old per-row struct.unpack loader and checks that both give the same data, also
+for the particle IDs read with AllParticles (eager and lazy), for row selections
+(rscat[mask], rscat[slice]) of a lazy reader, and that
+rs_probeversion identifies synthetic version 7 and 8 catalogues.
+The scaling mode splits a fixed number of halos over more and more block files
+and times RSDataReader with 1..maxthreads threads.
+The potential mode compares the batched spherical_potentials against the old
+per-halo spline + quad PotentialE on random Hernquist halos.
+"""
+import numpy as np
+import struct
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import RSDataReader as RDR
+
+def block_filename(outdir,snap,file_num,version,base='halos_',digits=1):
+    snapstr = str(snap).zfill(digits)
+    if version==10: ext = 'boundbin'
+    elif version==7 or version==8: ext = 'fullbin'
+    else: ext = 'bin'
+    return outdir+'/'+base+snapstr+'/'+base+snapstr+'.'+str(file_num)+'.'+ext
+
+def write_synthetic_catalogue(outdir,snap=0,numfiles=8,halos_per_file=10000,version=10,
+                              maxpart=50,seed=0,digits=1):
+    """
+    Writes numfiles Rockstar binary blocks with random halo properties, random particle
+    IDs and a matching parents.list. Returns the total number of halos.
+    """
+    np.random.seed(seed)
+    headerfmt,varlist,datatypesstr = RDR.rs_layout(version)
+    diskdtype = RDR.rs_diskdtype(datatypesstr,varlist)
+    num_p = {10:'num_bound',7:'total_npart',8:'total_npart'}.get(version,'npart')
+    snapdir = outdir+'/halos_'+str(snap).zfill(digits)
+    if not os.path.exists(snapdir): os.makedirs(snapdir)
+
+    allids = []
+    nextid = 0
+    for file_num in xrange(numfiles):
+        halos = np.zeros(halos_per_file,dtype=diskdtype)
+        for name in diskdtype.names:
+            if diskdtype[name].kind == 'f':
+                halos[name] = np.random.rand(halos_per_file)*100.
+            else:
+                halos[name] = np.random.randint(0,1000,halos_per_file)
+        halos['id'] = np.arange(nextid,nextid+halos_per_file)
+        if 'halfmassrad' in diskdtype.names:
+            halos['halfmassrad'] = halos['rvir']*np.random.rand(halos_per_file)
+        halos['npart'] = np.random.randint(1,maxpart,halos_per_file)
+        halos[num_p] = halos['npart']
+        nextid += halos_per_file
+        allids.append(halos['id'])
+        num_particles = int(np.sum(halos[num_p]))
+        header = struct.pack(headerfmt,0,snap,file_num,1.0,.3175,.6825,.6711,
+                             0,0,0,100,100,100,halos_per_file,num_particles,
+                             100.,1.e5,1)
+        with open(block_filename(outdir,snap,file_num,version,digits=digits),'wb') as f:
+            f.write(header)
+            halos.tofile(f)
+            np.random.randint(0,2**40,num_particles).astype(np.int64).tofile(f)
+
+    allids = np.concatenate(allids)
+    hosts = np.where(np.random.rand(len(allids)) < .2,np.random.choice(allids,len(allids)),-1)
+    with open(snapdir+'/parents.list','w') as f:
+        f.write("#id x y z vx vy vz mvir rvir pid\n")
+        for hid,pid in zip(allids,hosts):
+            f.write("%i 0 0 0 0 0 0 0 0 %i\n" % (hid,pid))
+    return len(allids)
+
+def legacy_read(outdir,snap,version=10,digits=1):
+    """ The pre-vectorization RSDataReader inner loop (one struct.unpack per halo) """
+    headerfmt,varlist,datatypesstr = RDR.rs_layout(version)
+    num_p = {10:'num_bound',7:'total_npart',8:'total_npart'}.get(version,'npart')
+    numbytes = struct.calcsize(datatypesstr)
+    num_halos = 0; file_num = 0
+    file_name = block_filename(outdir,snap,file_num,version,digits=digits)
+    while os.path.exists(file_name):
+        with open(file_name,'rb') as f:
+            num_halos += struct.unpack(headerfmt,f.read(256))[13]
+        file_num += 1
+        file_name = block_filename(outdir,snap,file_num,version,digits=digits)
+    data = np.zeros(num_halos,dtype=varlist)
+    file_num = 0; i = 0; particleID_start2 = 0
+    file_name = block_filename(outdir,snap,file_num,version,digits=digits)
+    while os.path.exists(file_name):
+        f = open(file_name,'rb')
+        nh = struct.unpack(headerfmt,f.read(256))[13]
+        particleID_start = struct.calcsize(headerfmt)+nh*numbytes
+        for j in xrange(nh):
+            data[i] = struct.unpack(datatypesstr,f.read(numbytes))+(0,0,0)
+            data[i][-2] = particleID_start
+            data[i][-1] = particleID_start2
+            particleID_start  += 8*data[num_p][i]
+            particleID_start2 += data[num_p][i]
+            i += 1
+        f.close()
+        file_num += 1
+        file_name = block_filename(outdir,snap,file_num,version,digits=digits)
+    return data
+
+def check_allparticles(outdir,version,snap=0):
+    """ AllParticles with lazy=True must give the same particles as the eager reader """
+    eager = RDR.RSDataReader(outdir,snap,version=version,digits=1,sort_by=None,noparents=True,AllParticles=True)
+    lazy = RDR.RSDataReader(outdir,snap,version=version,digits=1,sort_by=None,noparents=True,AllParticles=True,lazy=True)
+    assert len(eager.particles)==eager.total_particles
+    assert np.array_equal(lazy.particles,eager.particles)
+    for hid in eager['id'][::max(1,len(eager)//100)]:
+        assert np.array_equal(lazy.get_particles_from_halo(hid),eager.get_particles_from_halo(hid)),hid
+
+def check_lazy_getitem(outdir,version,snap=0):
+    """ rscat[mask] and rscat[slice] with lazy=True must give the same columns and values as the eager reader """
+    eager = RDR.RSDataReader(outdir,snap,version=version,digits=1,sort_by=None,noparents=True)
+    lazy = RDR.RSDataReader(outdir,snap,version=version,digits=1,sort_by=None,noparents=True,
+                            lazy=True,columns=['posX','posY','posZ','mgrav','rvir','vmax'])
+    mask = eager['mgrav'] > np.median(eager['mgrav'])
+    for key in [mask, np.array(mask), slice(10,50)]:
+        e = eager[key]; l = lazy[key]
+        assert sorted(l.columns)==sorted(e.columns),sorted(set(e.columns)^set(l.columns))
+        assert np.array_equal(l.index,e.index)
+        for name in e.columns:
+            assert np.all(np.array(l[name])==np.array(e[name])),name
+
+def check_probeversion(versions=[7,8]):
+    """ rs_probeversion must find exactly the version written, also for 7 and 8 (same record size and extension) """
+    for version in versions:
+        outdir = tempfile.mkdtemp()
+        try:
+            write_synthetic_catalogue(outdir,numfiles=2,halos_per_file=1000,version=version)
+            found = RDR.rs_probeversion(outdir,0,digits=1)
+            assert found==[version],(version,found)
+        finally:
+            shutil.rmtree(outdir)
+
+def bench_scaling(totalhalos=400000,filecounts=[1,2,4,8,16,32,64],maxthreads=8):
+    threadcounts = [1]
+    while threadcounts[-1]*2 <= maxthreads: threadcounts.append(threadcounts[-1]*2)
+    print "{0} halos; seconds to read with numthreads={1}".format(totalhalos,threadcounts)
+    for numfiles in filecounts:
+        outdir = tempfile.mkdtemp()
+        try:
+            write_synthetic_catalogue(outdir,numfiles=numfiles,halos_per_file=totalhalos//numfiles)
+            times = []
+            for numthreads in threadcounts:
+                start = time.time()
+                RDR.RSDataReader(outdir,0,version=10,digits=1,sort_by=None,noparents=True,numthreads=numthreads)
+                times.append(time.time()-start)
+            print "  {0:3d} files: ".format(numfiles)+" ".join(["{0:.3f}".format(t) for t in times])
+        finally:
+            shutil.rmtree(outdir)
+
+def legacy_potential(dr,particle_mass):
+    """ The pre-vectorization RSDataReader.PotentialE (spline of M(<r) plus quad at 70 radii) """
+    from scipy import interpolate
+    from scipy.integrate import quad
+    G = 1.326*10**11 # in km^3/s^2/Msun
+    mpc_to_km = 3.086*10**19
+    rarr = 10**np.linspace(np.log10(min(dr))-.01, np.log10(max(dr))+.01,70) # in Mpc
+    h_r, x_r = np.histogram(dr, bins=np.concatenate(([0],rarr)))
+    m_lt_r = np.cumsum(h_r)*particle_mass
+    tck = interpolate.splrep(rarr,m_lt_r) # gives mass in Msun
+    def Ufunc(x):
+        return interpolate.splev(x,tck)/(x**2)
+    U = np.zeros(len(rarr))
+    for i in range(len(rarr)):
+        r = rarr[i]
+        if r > max(dr)+.05:
+            U[i] = -G*m_lt_r[-1]/(r*mpc_to_km)
+        else:
+            tmp = -G*m_lt_r[-1]/(max(dr)*mpc_to_km)
+            U[i] = tmp+G*quad(Ufunc,max(dr),r,full_output=1)[0]/mpc_to_km
+    tck2 = interpolate.splrep(rarr,U)
+    return interpolate.splev(dr,tck2)
+
+def bench_potential(numhalos=50,npart=2000,particle_mass=1.e5,seed=0):
+    """
+    Random Hernquist halos (scale radius 0.01-0.05 Mpc, truncated at 10 scale radii).
+    Reports the time of both methods, the median and 99th percentile relative difference
+    in U, and the overlap of the 10% most bound particles (by U alone).
+    """
+    np.random.seed(seed)
+    counts = np.random.randint(npart//2,npart*3//2,numhalos)
+    offsets = np.concatenate(([0],np.cumsum(counts)))
+    dr = []
+    for n in counts:
+        a = 0.01+0.04*np.random.rand()
+        q = np.random.rand(n)*(10./11)**2
+        dr.append(a*np.sqrt(q)/(1-np.sqrt(q)))
+    dr = np.concatenate(dr)
+
+    start = time.time()
+    Uold = np.concatenate([legacy_potential(dr[offsets[k]:offsets[k+1]],particle_mass) for k in xrange(numhalos)])
+    oldtime = time.time()-start
+    start = time.time()
+    Unew = RDR.spherical_potentials(dr,offsets,particle_mass)
+    newtime = time.time()-start
+
+    reldiff = np.abs(Unew-Uold)/np.abs(Unew)
+    overlap = []
+    for k in xrange(numhalos):
+        ntop = max(1,(offsets[k+1]-offsets[k])//10)
+        topold = np.argsort(Uold[offsets[k]:offsets[k+1]])[:ntop]
+        topnew = np.argsort(Unew[offsets[k]:offsets[k+1]])[:ntop]
+        overlap.append(len(np.intersect1d(topold,topnew))/float(ntop))
+    print "{0} halos, {1} particles".format(numhalos,len(dr))
+    print "  spline + quad:        {0:.3f} sec".format(oldtime)
+    print "  spherical_potentials: {0:.3f} sec ({1:.0f}x)".format(newtime,oldtime/newtime)
+    print "  |dU|/|U|: median {0:.2e}, 99th percentile {1:.2e}, max {2:.2e}".format(np.median(reldiff),np.percentile(reldiff,99),np.max(reldiff))
+    print "  10% most bound overlap: mean {0:.3f}, min {1:.3f}".format(np.mean(overlap),np.min(overlap))
+
+if __name__=="__main__":
+    if len(sys.argv) > 1 and sys.argv[1]=='potential':
+        numhalos = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+        npart = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+        bench_potential(numhalos=numhalos,npart=npart)
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1]=='scaling':
+        totalhalos = int(sys.argv[2]) if len(sys.argv) > 2 else 400000
+        maxthreads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+        bench_scaling(totalhalos=totalhalos,maxthreads=maxthreads)
+        sys.exit()
+    numfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    halos_per_file = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    version = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    outdir = tempfile.mkdtemp()
+    try:
+        numhalos = write_synthetic_catalogue(outdir,numfiles=numfiles,halos_per_file=halos_per_file,version=version)
+        print "Synthetic catalogue: {0} files, {1} halos, version {2}".format(numfiles,numhalos,version)
+
+        start = time.time()
+        olddata = legacy_read(outdir,0,version=version)
+        oldtime = time.time()-start
+        print "  legacy struct loop:  {0:.3f} sec".format(oldtime)
+
+        start = time.time()
+        rscat = RDR.RSDataReader(outdir,0,version=version,digits=1,sort_by=None,noparents=True)
+        newtime = time.time()-start
+        print "  RSDataReader:        {0:.3f} sec ({1:.1f}x)".format(newtime,oldtime/newtime)
+
+        start = time.time()
+        lazycat = RDR.RSDataReader(outdir,0,version=version,digits=1,sort_by=None,noparents=True,
+                                   lazy=True,columns=['posX','posY','posZ','mgrav','rvir','vmax'])
+        lazytime = time.time()-start
+        print "  RSDataReader (lazy): {0:.3f} sec ({1:.1f}x)".format(lazytime,oldtime/lazytime)
+
+        for name in olddata.dtype.names:
+            assert np.all(np.array(lazycat[name])==olddata[name]),name
+
+        start = time.time()
+        threadcat = RDR.RSDataReader(outdir,0,version=version,digits=1,sort_by=None,noparents=True,numthreads=4)
+        threadtime = time.time()-start
+        print "  RSDataReader (4 threads): {0:.3f} sec ({1:.1f}x)".format(threadtime,oldtime/threadtime)
+        for name in olddata.dtype.names:
+            assert np.all(np.array(threadcat[name])==olddata[name]),name
+        for name in olddata.dtype.names:
+            assert np.all(np.array(rscat[name])==olddata[name]),name
+        check_allparticles(outdir,version)
+        check_lazy_getitem(outdir,version)
+        check_probeversion()
+        print "  outputs identical"
+    finally:
+        shutil.rmtree(outdir)
@@ -1,12 +1,15 @@
 import numpy as np
+import pandas
 import os
 
-def readParents(dir, file, numhalos,sub=False):
+def readParents(dir, file, numhalos,sub=False,cache=False):
     """
     @ param dir: directory of file (string)
     @ param file: name of .list file produced by ./find_parents
     @ numhalos: number of halos in the list.
-    @ return:  
+    @ param cache: if True, save the parsed (id, parent id) array as a binary
+      sidecar file+'.npy' and load that instead whenever it is newer than the list
+    @ return: int array of shape (numhalos,2) with columns id, parent id
     """
     file_name = dir+'/'+file
     #print "Opening file: "+file_name
@@ -20,34 +23,36 @@ def readParents(dir, file, numhalos,sub=False):
         if(not os.path.exists(file_name)):
             raise IOError('file not found: '+file_name)
 
-    f = open(file_name)
-    data = np.zeros((numhalos,2))
+    sidecar = file_name+'.npy'
+    if cache and os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(file_name):
+        data = np.load(sidecar)
+    else:
+        # count columns from the first line after the header
+        numcols = 0
+        with open(file_name) as f:
+            for line in f:
+                if line[0] != '#':
+                    numcols = len(line.split())
+                    break
 
-    # read header
-    char = f.readline()[0]
-    while char=='#':
-        lastpos = f.tell()
-        char = f.readline()[0]
-    f.seek(lastpos)
-    
-    i = 0
-    for line in f:
-        a = line.split()
-        #print a
-        try:
-            data[i][0] = int(a[0])
-            data[i][1] = int(a[-1])
+        # let pandas' C parser pull out the first and last columns in one pass
+        if numcols == 0:
+            data = np.zeros((0,2),dtype='int')
+        else:
+            try:
+                data = pandas.read_csv(file_name,delim_whitespace=True,comment='#',header=None,
+                                       usecols=[0,numcols-1],dtype=np.int64).values.astype('int')
+            except ValueError as e:
+                raise IOError('could not parse '+file_name+': '+str(e))
+
+        if cache:
+            try:
+                np.save(sidecar,data)
+            except IOError as e:
+                print "WARNING: could not write "+sidecar+": "+str(e)
 
-        except:
-            print "ERROR: AHHHH"
-            print a
-            print i
-            print "numhalos: ",numhalos
-            print data[i][0], data[i][1]
-            print data[i-1][0], data[i-1][1]
-        i += 1
-    if i != numhalos:
+    if len(data) != numhalos:
         print 'numhalos does not match number of lines in readParentsList.py'
     #sortedIndices = data[:,0].argsort()
     #data = data[sortedIndices]
-    return data.astype('int')
+    return data
@@ -0,0 +1,138 @@
+"""
+Benchmark for readsnapHDF5_greg on a synthetic multi-file HDF5 snapshot.
+
+Usage: python bench_readsnapHDF5.py [numpart] [numfiles] [numids]
+       python bench_readsnapHDF5.py sparse [numpart] [numfiles] [numclumps]
+
+Writes a fake snap_000.<i>.hdf5 snapshot (particle types 1 and 2, each with
+numpart particles) into a temporary directory, then times reading POS, VEL,
+ID and MASS with one read_block call per block against a single read_blocks
+call, for all particles of type 1, of types 1 and 2, and for numids sorted
+particle indices. Checks that both give the same data.
+The sparse mode reads POS for a few clumps of particles (like the particles of
+some subhalos in a snapshot sorted by ID) with different maxgap values and
+reports the time and bytes read, compared to reading whole datasets.
+"""
+import numpy as np
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import h5py
+import readsnapHDF5_greg as rsg
+
+BLOCKS = ["POS ","VEL ","ID  ","MASS"]
+
+def write_synthetic_snapshot(base,numpart=1000000,numfiles=16,types=(1,2),seed=0):
+    """
+    Writes numfiles subfiles base.<i>.hdf5 with random positions, velocities and potentials.
+    Type 1 has a MassTable entry, the other types a Masses block. Particle IDs are sorted.
+    """
+    np.random.seed(seed)
+    splits = np.linspace(0,numpart,numfiles+1).astype(np.int64)
+    massarr = np.zeros(6); massarr[1] = 1.e-3
+    for num in xrange(numfiles):
+        n = splits[num+1]-splits[num]
+        f = h5py.File(base+'.'+str(num)+'.hdf5','w')
+        header = f.create_group('Header')
+        npart = np.zeros(6,dtype=np.int32); nall = np.zeros(6,dtype=np.uint32)
+        for ptype in types:
+            npart[ptype] = n; nall[ptype] = numpart
+        header.attrs['NumPart_ThisFile'] = npart
+        header.attrs['NumPart_Total'] = nall
+        header.attrs['NumPart_Total_HighWord'] = np.zeros(6,dtype=np.uint32)
+        header.attrs['MassTable'] = massarr
+        for name,value in [('Time',1.),('Redshift',0.),('BoxSize',100.),('NumFilesPerSnapshot',numfiles),
+                           ('Omega0',.3175),('OmegaLambda',.6825),('HubbleParam',.6711)]:
+            header.attrs[name] = value
+        for name in ['Flag_Sfr','Flag_Cooling','Flag_StellarAge','Flag_Metals','Flag_Feedback','Flag_DoublePrecision']:
+            header.attrs[name] = 0
+        for ptype in types:
+            group = f.create_group('PartType'+str(ptype))
+            group.create_dataset('Coordinates',data=(np.random.rand(n,3)*100.).astype(np.float32))
+            group.create_dataset('Velocities',data=(np.random.randn(n,3)*100.).astype(np.float32))
+            group.create_dataset('Potential',data=(-np.random.rand(n)*1.e5).astype(np.float32))
+            group.create_dataset('ParticleIDs',data=np.arange(splits[num],splits[num+1],dtype=np.uint64)+ptype*numpart)
+            if massarr[ptype]==0:
+                group.create_dataset('Masses',data=np.random.rand(n).astype(np.float32))
+        f.close()
+
+def bench(label,base,parttype,ids=-1,repeats=3):
+    times = []
+    for i in xrange(repeats):
+        start = time.time()
+        if np.iterable(parttype):
+            sequential = [np.concatenate([rsg.read_block(base,block,parttype=ptype) for ptype in parttype]) for block in BLOCKS]
+        else:
+            sequential = [rsg.read_block(base,block,parttype=parttype,ids=ids) for block in BLOCKS]
+        times.append(time.time()-start)
+    oldtime = np.median(times)
+    times = []
+    for i in xrange(repeats):
+        start = time.time()
+        single = rsg.read_blocks(base,BLOCKS,parttype=parttype,ids=ids)
+        times.append(time.time()-start)
+    newtime = np.median(times)
+    for block,a,b in zip(BLOCKS,sequential,single):
+        assert a.dtype==b.dtype and np.array_equal(a,b),block
+    print "  {0}".format(label)
+    print "    read_block x{0}: {1:.3f} sec".format(len(BLOCKS),oldtime)
+    print "    read_blocks:    {0:.3f} sec ({1:.1f}x)".format(newtime,oldtime/newtime)
+
+def clumped_ids(numpart,numclumps=20,clumpsize=2000,fill=.5):
+    """ sorted indices: numclumps windows of clumpsize particles, each holding a random fraction fill of them """
+    ids = []
+    for start in np.random.randint(0,numpart-clumpsize,numclumps):
+        window = np.arange(start,start+clumpsize)
+        ids.append(window[np.random.rand(clumpsize) < fill])
+    return np.unique(np.concatenate(ids))
+
+def bench_sparse(base,numpart,numclumps=20,repeats=3):
+    ids = clumped_ids(numpart,numclumps)
+    snap = rsg.snapshot(base)
+    rowbytes = 12
+    print "{0} sorted ids in {1} clumps; whole POS dataset is {2:.1f} MB".format(len(ids),numclumps,numpart*rowbytes/1.e6)
+    expected = rsg.read_block(base,"POS ",parttype=1)[ids]
+    for maxgap in [0,4096,65536,2**62]:
+        snap.maxgap = maxgap
+        times = []
+        for i in xrange(repeats):
+            snap.bytesread = 0
+            start = time.time()
+            pos = snap.read_block("POS ",parttype=1,ids=ids)
+            times.append(time.time()-start)
+        assert np.array_equal(pos,expected)
+        label = "first to last id" if maxgap==2**62 else "maxgap {0} bytes".format(maxgap)
+        print "  {0:18s} {1:.4f} sec, {2:.2f} MB read".format(label+":",np.median(times),snap.bytesread/1.e6)
+    snap.close()
+
+if __name__=="__main__":
+    if len(sys.argv) > 1 and sys.argv[1]=='sparse':
+        numpart = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+        numfiles = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+        numclumps = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+        outdir = tempfile.mkdtemp()
+        try:
+            write_synthetic_snapshot(outdir+'/snap_000',numpart=numpart,numfiles=numfiles,types=(1,))
+            bench_sparse(outdir+'/snap_000',numpart,numclumps)
+        finally:
+            shutil.rmtree(outdir)
+        sys.exit()
+    numpart = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    numfiles = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    numids = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+
+    outdir = tempfile.mkdtemp()
+    try:
+        base = outdir+'/snap_000'
+        write_synthetic_snapshot(base,numpart=numpart,numfiles=numfiles)
+        print "Synthetic snapshot: {0} files, {1} particles of types 1 and 2; blocks {2}".format(numfiles,numpart,BLOCKS)
+        bench("parttype=1",base,1)
+        bench("parttype=[1,2]",base,[1,2])
+        ids = np.sort(np.random.choice(numpart,min(numids,numpart),replace=False))
+        bench("parttype=1, {0} ids".format(len(ids)),base,1,ids=ids)
+        print "  outputs identical"
+    finally:
+        shutil.rmtree(outdir)
@@ -7,6 +7,8 @@
 # mass = rs.read_block("snap_063","MASS",parttype=5) # reads mass for particles of type 5, using block names should work for both format 1 and 2 snapshots
 # print "mass for", mass.size, "particles read"
 # print mass[0:10]
+# snap = rs.snapshot("snap_063") # memory-maps all files, reads headers and block offsets once
+# pos = snap.read_block("POS ",parttype=1,rows=ids) # only reads (and byte swaps) the particles in rows
 #
 # before using read_block, make sure that the description (and order if using format 1 snapshot files) of the data blocks
 # is correct for your configuration of Gadget 
@@ -85,130 +87,77 @@ class snapshot_header:
       self.omega_m = self.omega_m.byteswap()
       self.omega_l = self.omega_l.byteswap()
       self.hubble = self.hubble.byteswap()
-      self.doubleprecision = self.doubleprec.byteswap()
+      self.doubleprecision = self.doubleprecision.byteswap()
     f.close()
  
-# ----- find offset and size of data block ----- 
+# ----- block table of a file, scanned once -----
 
-def find_block(filename, format, swap, block, block_num, only_list_blocks=False):
+_block_tables = {}
+def block_table(filename, format, swap):
+  """
+  @return: list of (name, offset, size) of the data blocks of a snapshot file, in file order.
+           name is None for format 1 files, the header is the first block.
+           The table is cached per file and only rescanned if its mtime or size change.
+  """
   if (not os.path.exists(filename)):
       print "file not found:", filename
       sys.exit()
-            
+  stamp = (os.path.getmtime(filename), os.path.getsize(filename), format, swap)
+  if filename in _block_tables and _block_tables[filename][0] == stamp:
+    return _block_tables[filename][1]
+
   f = open(filename,'rb')
-  f.seek(0, os.SEEK_END)
-  filesize = f.tell()
-  f.seek(0, os.SEEK_SET)
-  
-  found = False
-  curblock_num = 1
-  while ((not found) and (f.tell()<filesize)):
+  filesize = stamp[1]
+  blocks = []
+  while (f.tell()<filesize):
+    curblock = None
     if format==2:
       f.seek(4, os.SEEK_CUR)
       curblock = f.read(4)
-      if (block == curblock):
-        found = True
-      f.seek(8, os.SEEK_CUR)  
-    else:
-      if curblock_num==block_num:
-        found = True
-        
+      f.seek(8, os.SEEK_CUR)
     curblocksize = (np.fromfile(f,dtype=np.uint32,count=1))[0]
     if swap:
       curblocksize = curblocksize.byteswap()
-    
-    # - print some debug info about found data blocks -
-    #if format==2:
-    #  print curblock, curblock_num, curblocksize
-    #else:
-    #  print curblock_num, curblocksize
-    
-    if only_list_blocks:
-      if (verbose):	
-	      print curblock_num,curblock,f.tell(),curblocksize
-      found = False
-    
-    if found:
-      blocksize = curblocksize
-      offset = f.tell()
-    else:
-      f.seek(curblocksize, os.SEEK_CUR)
-      blocksize_check = (np.fromfile(f,dtype=np.int32,count=1))[0]
-      if swap: blocksize_check = blocksize_check.byteswap()
-      if (curblocksize != blocksize_check):
-        print "something wrong"
-        sys.exit()
-      curblock_num += 1
-      
+    blocks.append((curblock, f.tell(), curblocksize))
+    f.seek(curblocksize, os.SEEK_CUR)
+    blocksize_check = (np.fromfile(f,dtype=np.uint32,count=1))[0]
+    if swap: blocksize_check = blocksize_check.byteswap()
+    if (curblocksize != blocksize_check):
+      print "something wrong"
+      sys.exit()
   f.close()
-      
-  if ((not found) and (not only_list_blocks)):
-    print "Error: block not found"
-    sys.exit()
-    
-  if (not only_list_blocks):
-    return offset,blocksize
- 
-# ----- read data block -----
+
+  _block_tables[filename] = (stamp, blocks)
+  return blocks
+
+# ----- find offset and size of data block ----- 
+
+def find_block(filename, format, swap, block, block_num, only_list_blocks=False):
+  blocks = block_table(filename, format, swap)
+
+  if only_list_blocks:
+    for curblock_num,(curblock,offset,curblocksize) in enumerate(blocks):
+      print curblock_num+1,curblock,offset,curblocksize
+    return
+
+  for curblock_num,(curblock,offset,blocksize) in enumerate(blocks):
+    if (format==2 and curblock==block) or (format!=2 and curblock_num+1==block_num):
+      return offset,blocksize
+
+  print "Error: block not found"
+  sys.exit()
  
-def read_block(filename, block, parttype=-1, physical_velocities=True, arepo=0, no_masses=False, verbose=False, mult=True, doubleprec=True, memmap=None):
-  if (verbose):
-	  print "reading block", block
-  
-  blockadd=0
-  blocksub=0
-  
-  if arepo==0:
-    if (verbose):	
-	    print "Gadget format"
-    blockadd=0
-  if arepo==1:
-    if (verbose):	
-	    print "Arepo format"
-    blockadd=1	
-  if arepo==2:
-    if (verbose):
-	   print "Arepo extended format"
-    blockadd=4	
-  if no_masses==True:
-    if (verbose):	
-	    print "No mass block present"    
-    blocksub=1
-		 
-  if parttype not in [-1,0,1,2,3,4,5]:
-    print "wrong parttype given"
-    sys.exit()
-  
-  if os.path.exists(filename):
-    curfilename = filename
-  elif os.path.exists(filename+".0"):
-    curfilename = filename+".0"
-  else:
-    print "file not found:", filename
-    print "and:", curfilename
-    sys.exit()
+# ----- description of data blocks -----
 
-  if verbose:
-    print curfilename
-  
-  head = snapshot_header(curfilename)
-  format = head.format
+def block_description(block, massarr, arepo=0, no_masses=False, doubleprec=True):
+  """
+  @return: data_for_type, dt, block_num. data_for_type[j] is True if the block stores data for
+           particle type j, dt the data type of one entry, block_num the position of the block
+           in format 1 files (the header is block 1)
+  """
+  blockadd = {0:0, 1:1, 2:4}.get(arepo, 0)
+  blocksub = 1 if no_masses==True else 0
 
-  if verbose:
-    print "FORMAT=", format
-  swap = head.swap
-  npart = head.npart
-  massarr = head.massarr
-  if (mult==True):
-	  nall = head.nall
-  else:
-          nall = head.npart
-  filenum = head.filenum
-  redshift = head.redshift
-  time = head.time
-  del head
-  
-  # - description of data blocks -
   # add or change blocks as needed for your Gadget version
   data_for_type = np.zeros(6,bool) # should be set to "True" below for the species for which data is stored in the data block
   if (doubleprec==True):
@@ -236,10 +185,6 @@ def read_block(filename, block, parttype=-1, physical_velocities=True, arepo=0,
   elif block=="MASS":
     data_for_type[np.where(massarr==0)] = True
     block_num = 5
-    if parttype>=0 and massarr[parttype]>0:   
-      if (verbose):	
-	      print "filling masses according to massarr"   
-      return np.ones(nall[parttype],dtype=dt)*massarr[parttype]
   elif block=="U   ":
     data_for_type[:] = True
     block_num = 6-blocksub
@@ -291,7 +236,66 @@ def read_block(filename, block, parttype=-1, physical_velocities=True, arepo=0,
   else:
     print "Sorry! Block type", block, "not known!"
     sys.exit()
-  # - end of block description -
+  return data_for_type, dt, block_num
+
+# ----- read data block -----
+ 
+def read_block(filename, block, parttype=-1, physical_velocities=True, arepo=0, no_masses=False, verbose=False, mult=True, doubleprec=True, memmap=None):
+  if (verbose):
+	  print "reading block", block
+  
+  if arepo==0:
+    if (verbose):	
+	    print "Gadget format"
+  if arepo==1:
+    if (verbose):	
+	    print "Arepo format"
+  if arepo==2:
+    if (verbose):
+	   print "Arepo extended format"
+  if no_masses==True:
+    if (verbose):	
+	    print "No mass block present"    
+		 
+  if parttype not in [-1,0,1,2,3,4,5]:
+    print "wrong parttype given"
+    sys.exit()
+  
+  if os.path.exists(filename):
+    curfilename = filename
+  elif os.path.exists(filename+".0"):
+    curfilename = filename+".0"
+  else:
+    print "file not found:", filename
+    print "and:", curfilename
+    sys.exit()
+
+  if verbose:
+    print curfilename
+  
+  head = snapshot_header(curfilename)
+  format = head.format
+
+  if verbose:
+    print "FORMAT=", format
+  swap = head.swap
+  npart = head.npart
+  massarr = head.massarr
+  if (mult==True):
+	  nall = head.nall
+  else:
+          nall = head.npart
+  filenum = head.filenum
+  redshift = head.redshift
+  time = head.time
+  del head
+  
+  # - description of data blocks -
+  data_for_type, dt, block_num = block_description(block, massarr, arepo, no_masses, doubleprec)
+  if block=="MASS" and parttype>=0 and massarr[parttype]>0:
+    if (verbose):	
+      print "filling masses according to massarr"   
+    return np.ones(nall[parttype],dtype=dt)*massarr[parttype]
     
   actual_data_for_type = np.copy(data_for_type)  
   if parttype >= 0:
@@ -382,6 +386,121 @@ def read_block(filename, block, parttype=-1, physical_velocities=True, arepo=0,
 
   return data
   
+# ----- memory-mapped snapshot -----
+
+class snapshot:
+  """
+  Multi-file format 1/2 snapshot whose subfiles are memory-mapped. Headers and block tables
+  are read once; blocks are returned as views of the mapped files in the byte order on disk,
+  so only the bytes of the particles actually used are read (and byte swapped, by numpy,
+  when they are converted or computed with).
+
+  snap = rs.snapshot("snap_063")
+  pos = snap.block("POS ", parttype=1)                     # views, one per subfile
+  pos = snap.read_block("POS ", parttype=1, rows=[5,7,9])  # native byte order copy
+
+  @param filename: as for read_block (e.g. "snap_063" for snap_063.0, snap_063.1, ...)
+  other arguments as for read_block
+  """
+  def __init__(self, filename, arepo=0, no_masses=False, doubleprec=True, mult=True):
+    if os.path.exists(filename):
+      self.filenames = [filename]
+    elif os.path.exists(filename+".0"):
+      self.filenames = [filename+".0"]
+    else:
+      print "file not found:", filename
+      sys.exit()
+    self.header = snapshot_header(self.filenames[0])
+    if (self.header.filenum>1) and mult and (self.filenames[0]==filename+".0"):
+      self.filenames = [filename+"."+str(i) for i in range(self.header.filenum)]
+    self.headers = [self.header]+[snapshot_header(name) for name in self.filenames[1:]]
+    self.format = self.header.format
+    self.swap = self.header.swap
+    self.massarr = self.header.massarr
+    self.npart = np.array([head.npart for head in self.headers],dtype=np.int64)
+    self.nall = self.npart.sum(axis=0)
+    self.arepo = arepo
+    self.no_masses = no_masses
+    self.doubleprec = doubleprec
+    self.tables = [block_table(name,self.format,self.swap) for name in self.filenames]
+    self._maps = [None]*len(self.filenames)
+
+  def _map(self, i):
+    if self._maps[i] is None:
+      self._maps[i] = np.memmap(self.filenames[i],dtype=np.uint8,mode='r')
+    return self._maps[i]
+
+  def block(self, block, parttype):
+    """
+    @return: list with one array per subfile: the block's data for parttype in that file,
+             a view of the memory-mapped file (no data is read until it is used)
+    """
+    data_for_type, dt, block_num = block_description(block, self.massarr, self.arepo, self.no_masses, self.doubleprec)
+    if data_for_type[parttype]==False:
+      print "Error: no data for specified particle type", parttype, "in the block", block
+      sys.exit()
+    dt = np.dtype(dt)
+    views = []
+    for i in range(len(self.filenames)):
+      npart = self.npart[i]
+      curpartnum = np.sum(npart[data_for_type])
+      offset,blocksize = find_block(self.filenames[i],self.format,self.swap,block,block_num)
+      if block=="ID  " and blocksize == dt.itemsize*curpartnum*2: # long IDs
+        dt = np.dtype(np.uint64)
+      if dt.itemsize*curpartnum != blocksize:
+        print "something wrong with blocksize! expected =",dt.itemsize*curpartnum,"actual =",blocksize
+        sys.exit()
+      start = offset+np.sum(npart[:parttype][data_for_type[:parttype]])*dt.itemsize
+      base = dt.base.newbyteorder('S') if self.swap else dt.base
+      view = self._map(i)[start:start+npart[parttype]*dt.itemsize].view(base)
+      views.append(view.reshape((npart[parttype],)+dt.shape))
+    return views
+
+  def read_block(self, block, parttype=-1, rows=None, physical_velocities=True):
+    """
+    @param rows: indices into the particles of parttype (any order); only these are read
+    @return: same as read_block(filename, block, parttype), or its rows, in native byte order
+    """
+    if parttype==-1:
+      if rows is not None:
+        print "rows only supported for specific parttype"
+        sys.exit()
+      data_for_type, dt, block_num = block_description(block, self.massarr, self.arepo, self.no_masses, self.doubleprec)
+      if block=="MASS":
+        data_for_type[:] = True
+      parts = [self.read_block(block, j, physical_velocities=physical_velocities) for j in range(6) if data_for_type[j] and self.nall[j]>0]
+      if len(parts)==0:
+        return np.zeros(0,dtype=dt)
+      return np.concatenate(parts)
+
+    if block=="MASS" and self.massarr[parttype]>0:
+      n = self.nall[parttype] if rows is None else len(rows)
+      dt = block_description(block, self.massarr, self.arepo, self.no_masses, self.doubleprec)[1]
+      return np.ones(n,dtype=dt)*self.massarr[parttype]
+
+    views = self.block(block, parttype)
+    dt = views[0].dtype.newbyteorder('=')
+    if rows is None:
+      data = np.empty((self.nall[parttype],)+views[0].shape[1:],dt)
+      start = 0
+      for view in views:
+        data[start:start+len(view)] = view
+        start += len(view)
+    else:
+      rows = np.asarray(rows,dtype=np.int64)
+      offsets = np.concatenate(([0],np.cumsum(self.npart[:,parttype])))
+      if len(rows)>0 and (rows.min()<0 or rows.max()>=offsets[-1]):
+        print "rows out of range for parttype", parttype
+        sys.exit()
+      filenum = np.searchsorted(offsets,rows,side='right')-1
+      data = np.empty((len(rows),)+views[0].shape[1:],dt)
+      for i in np.unique(filenum):
+        mask = filenum==i
+        data[mask] = views[i][rows[mask]-offsets[i]]
+    if physical_velocities and block=="VEL " and self.header.redshift!=0:
+      data *= math.sqrt(self.header.time)
+    return data
+
 # ----- list all data blocks in a format 2 snapshot file -----
 
 def list_format2_blocks(filename):
@@ -14,6 +14,8 @@ import numpy as np
 import os
 import sys
 import math
+import shutil
+import cPickle as pickle
 import hdf5lib
 
 ############ 
@@ -121,7 +123,9 @@ class snapshot_header:
 		if (len(args) == 1):
 			filename = args[0]
 
-			if os.path.exists(filename):
+			if not isinstance(filename, basestring):
+				f=filename #already open subfile, left open
+			elif os.path.exists(filename):
 				curfilename=filename
 			elif os.path.exists(filename+".hdf5"):
 				curfilename = filename+".hdf5"
@@ -132,7 +136,8 @@ class snapshot_header:
 				sys.stdout.flush()
 				sys.exit()
 
-			f=hdf5lib.OpenFile(curfilename)
+			if isinstance(filename, basestring):
+				f=hdf5lib.OpenFile(curfilename)
 			self.npart = hdf5lib.GetAttr(f, "Header", "NumPart_ThisFile") 
 			self.nall = hdf5lib.GetAttr(f, "Header", "NumPart_Total")
 			self.nall_highword = hdf5lib.GetAttr(f, "Header", "NumPart_Total_HighWord") 
@@ -154,7 +159,8 @@ class snapshot_header:
 				self.sorted = hdf5lib.GetAttr(f, "Header", "Sorted_Ids") 
 			except:
 				pass
-			f.close()
+			if isinstance(filename, basestring):
+				f.close()
 		else:
 			#read arguments
 			self.npart = kwargs.get("npart")
@@ -363,258 +369,587 @@ def read_block_single_file(filename, block_name, dim2, parttype=-1, no_mass_repl
 
 	return [ret_val, True]
 
-##############
-#READ ROUTINE#
-##############
-def read_block(filename, block, parttype=-1, no_mass_replicate=False, fill_block="", slab_start=-1, slab_len=-1,ids=-1, verbose=False): #GREG - added ids as a parameter
-	if (verbose):
-		print "reading block          : ", block
-		sys.stdout.flush()	
-
-	if parttype not in [-1,0,1,2,3,4,5]:
-		print "[error] wrong parttype given"
-		sys.stdout.flush()
-		sys.exit()
+################################
+#CONTIGUOUS RUNS OF SORTED ROWS#
+################################
+def coalesce_runs(rows, maxgap=0):
+	"""
+	@param rows: sorted row indices (repeats allowed)
+	@param maxgap: gaps of up to maxgap unwanted rows between wanted rows are read through
+	@return: runstarts, runstops. rows[i] is in runstarts[k]:runstops[k] for exactly one k
+	"""
+	rows = np.asarray(rows)
+	if len(rows)==0:
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+	breaks = np.nonzero(np.diff(rows) > maxgap+1)[0]
+	runstarts = rows[np.concatenate(([0], breaks+1))]
+	runstops = rows[np.concatenate((breaks, [len(rows)-1]))]+1
+	return runstarts.astype(np.int64), runstops.astype(np.int64)
+
+##########################################
+#SNAPSHOT WITH OPEN-ONCE SUBFILE HANDLES#
+##########################################
+class snapshot:
+	"""
+	All subfiles of a snapshot, opened once. Headers, per-file particle counts and
+	block dtypes are cached so that repeated read_block calls reuse the same handles:
+
+	snap = snapshot("snap_063")
+	pos = snap.read_block("POS ", parttype=1)
+	vel = snap.read_block("VEL ", parttype=1)
+	snap.close()
+
+	@param filename: snapshot base name, as for read_block (or a single .hdf5 file)
+	@param maxgap: id reads fetch contiguous runs of rows with one hyperslab read each,
+	  reading through gaps of up to maxgap bytes between wanted rows
+	npart[i,t]: number of particles of type t in subfile i
+	offsets[i,t]: index of the first type t particle of subfile i (offsets[-1] = nall)
+	bytesread: bytes read from disk so far
+	sorted_ids: True if the header says Sorted_Ids = yes (particle ID = index)
+	"""
+	def __init__(self, filename, verbose=False, maxgap=65536):
+		self.filename = filename
+		self.maxgap = maxgap
+		self.bytesread = 0
+		if os.path.exists(filename):
+			self.filenames = [filename]
+		elif os.path.exists(filename+".hdf5"):
+			self.filenames = [filename+".hdf5"]
+		elif os.path.exists(filename+".0.hdf5"):
+			self.filenames = [filename+".0.hdf5"]
+		else:
+			print "[error] file not found : ", filename
+			sys.stdout.flush()
+			sys.exit()
+		self.files = [hdf5lib.OpenFile(self.filenames[0])]
+		self.header = snapshot_header(self.files[0])
+		if self.filenames[0]==filename+".0.hdf5":
+			self.filenames = [filename+"."+str(num)+".hdf5" for num in range(int(self.header.filenum))]
+			self.files += [None]*(len(self.filenames)-1)
+		if (verbose):
+			print "Opening files          : ", len(self.filenames)
+			sys.stdout.flush()
 
-	if os.path.exists(filename):
-		curfilename=filename
-		multiple_files=False
-	elif os.path.exists(filename+".hdf5"):
-		curfilename = filename+".hdf5"
-		multiple_files=False
-	elif os.path.exists(filename+".0.hdf5"):
-		curfilename = filename+".0.hdf5"
-		multiple_files=True
-	else:
-		print "[error] file not found : ", filename
-		sys.stdout.flush()
-		sys.exit()
+		self.headers = [self.header]+[snapshot_header(self.file(num)) for num in range(1,len(self.filenames))]
+		self.npart = np.array([head.npart for head in self.headers], dtype=np.int64)
+		self.offsets = np.zeros((len(self.filenames)+1,6), dtype=np.int64)
+		self.offsets[1:] = np.cumsum(self.npart, axis=0)
+		self.nall = self.offsets[-1]
+		self.massarr = self.header.massarr
+		self.sorted_ids = (getattr(self.header, "sorted", "no")=="yes")
+		self._dtypes = {}
+		self._idindex = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def file(self, num):
+		"""
+		@return: open handle of subfile num (reopened if the snapshot was closed)
+		"""
+		if self.files[num] is None:
+			self.files[num] = hdf5lib.OpenFile(self.filenames[num])
+		return self.files[num]
+
+	def close(self):
+		for num in range(len(self.files)):
+			if self.files[num] is not None:
+				self.files[num].close()
+				self.files[num] = None
+
+	def contains(self, num, parttype, block_name):
+		part_name = 'PartType'+str(parttype)
+		f = self.file(num)
+		return hdf5lib.Contains(f,"",part_name) and hdf5lib.Contains(f,part_name,block_name)
+
+	def skipped(self, num, parttype, block_name, no_mass_replicate=False, fill_block_name=""):
+		"""
+		@return: True if parttype of subfile num is left out of block_name when reading every type
+		  (no such dataset, or masses from the mass table with no_mass_replicate)
+		"""
+		if ((block_name=="Masses") & (self.massarr[parttype]>0)):
+			return no_mass_replicate
+		return (block_name!=fill_block_name) and (self.contains(num, parttype, block_name)==False)
+
+	def dtype(self, block_name, parttype=-1):
+		"""
+		@return: dtype of block_name in the first subfile that has it (None if no subfile does)
+		"""
+		key = (block_name, parttype)
+		if not self._dtypes.has_key(key):
+			alloc_type = None
+			ptypes = range(0,6) if parttype==-1 else [parttype]
+			for num in range(len(self.filenames)):
+				for ptype in ptypes:
+					if self.contains(num, ptype, block_name):
+						alloc_type = hdf5lib.GetData(self.file(num),'PartType'+str(ptype)+'/'+block_name)[0:1].dtype
+						break
+				if alloc_type is not None:
+					break
+			self._dtypes[key] = alloc_type
+		return self._dtypes[key]
+
+	def read_rows(self, num, block_name, dim2, parttype, start, stop, fill_block_name="", rows=None):
+		"""
+		Rows start:stop (or start+rows, rows sorted and < stop-start) of one particle type in subfile num
+		"""
+		n = stop-start if rows is None else len(rows)
+		if ((block_name=="Masses") & (self.massarr[parttype]>0)):
+			return np.repeat(self.massarr[parttype], n)
+		if (self.contains(num, parttype, block_name)==False):
+			if (block_name==fill_block_name):
+				return np.zeros((n,dim2) if dim2 > 1 else n)
+			print "[error] block : ", block_name, "of parttype : ", parttype, "not found in ", self.filenames[num]
+			sys.stdout.flush()
+			sys.exit()
+		data = hdf5lib.GetData(self.file(num), 'PartType'+str(parttype)+'/'+block_name)
+		rowbytes = data.dtype.itemsize*dim2
+		if rows is None:
+			self.bytesread += (stop-start)*rowbytes
+			return data[start:stop]
+		runstarts, runstops = coalesce_runs(rows, self.maxgap//rowbytes)
+		ret_val = np.ndarray((len(rows),)+data.shape[1:], data.dtype)
+		bounds = np.searchsorted(rows, runstops)
+		lo = 0
+		for runstart, runstop, hi in zip(runstarts, runstops, bounds):
+			ret_val[lo:hi] = data[start+runstart:start+runstop][rows[lo:hi]-runstart]
+			lo = hi
+		self.bytesread += np.sum(runstops-runstarts)*rowbytes
+		return ret_val
+
+	def read_block(self, block, parttype=-1, no_mass_replicate=False, fill_block="", slab_start=-1, slab_len=-1, ids=-1, verbose=False):
+		"""
+		Same arguments and result as the module level read_block.
+		ids (sorted indices into the particles of parttype) and slabs may span subfiles.
+		"""
+		bytesread = self.bytesread
+		if (verbose):
+			print "reading block          : ", block
+			sys.stdout.flush()
 
-	slabflag=False
-	if ((slab_start!=-1) | (slab_len!=-1)):
-		slabflag=True
-		if (parttype==-1):
-			print "[error] slabs only supported for specific parttype"
+		if parttype not in [-1,0,1,2,3,4,5]:
+			print "[error] wrong parttype given"
 			sys.stdout.flush()
 			sys.exit()
-	
-	# GREG - added this next section to get specific particles, non-sequential
-        idsflag=False
-	if (type(ids)!=int):
-		idsflag=True
-		ids = np.array(ids) #GREG-make sure its a numpy array
-		if  (parttype==-1):
-			print "[error] id list only supported for specific parttype"
+
+		slabflag = ((slab_start!=-1) | (slab_len!=-1))
+		if (slabflag & (parttype==-1)):
+			print "[error] slabs only supported for specific parttype"
 			sys.stdout.flush()
 			sys.exit()
-		if (np.sum(ids==np.sort(ids)) < len(ids)):
-                    print "[error] input ids not sorted. must be in order!"
-                    return
 
-	head = snapshot_header(curfilename)
-	filenum = head.filenum
+		idsflag = (type(ids)!=int)
+		if (idsflag):
+			if (parttype==-1):
+				print "[error] id list only supported for specific parttype"
+				sys.stdout.flush()
+				sys.exit()
+			ids = self.check_ids(ids, parttype)
+			if ids is None:
+				return
 
-	#GREG - need to determine size of array and data type to pre-allocate data
-	if idsflag==True:
-		length = len(ids)
-        if slabflag==True:
-		length = slab_len
-	if idsflag==False and slabflag==False:
-		if parttype!=-1:
-			length=head.nall[parttype]
+		if (datablocks.has_key(block)):
+			block_name=datablocks[block][0]
+			dim2=datablocks[block][1]
 		else:
-			length=head.nall.sum()
-	if (verbose):
-		print "Length of data allocation:", length #GREG
-
-	del head
-
-	if (datablocks.has_key(block)):
-		block_name=datablocks[block][0]
-		dim2=datablocks[block][1]
-		first=True
-		if (verbose):
-			print "Reading HDF5           : ", block_name
-			print "Data dimension         : ", dim2
-			print "Multiple file          : ", multiple_files
-			print "Slab data              : ", slabflag
+			print "[error] Block type ", block, "not known!"
 			sys.stdout.flush()
-	else:
-		print "[error] Block type ", block, "not known!"
-		sys.stdout.flush()
-		sys.exit()
+			sys.exit()
 
-	fill_block_name=""
-	if (fill_block!=""):
-		if (datablocks.has_key(fill_block)):
-			fill_block_name=datablocks[fill_block][0]
-			dim2=datablocks[fill_block][1]
-			if (verbose):
-				print "Block filling active   : ", fill_block_name
+		fill_block_name=""
+		if (fill_block!=""):
+			if (datablocks.has_key(fill_block)):
+				fill_block_name=datablocks[fill_block][0]
+				dim2=datablocks[fill_block][1]
+
+		alloc_type = self.dtype(block_name, parttype)
+		if alloc_type is None:
+			if block=="ID  ":
+				alloc_type=np.uint32
+			elif block=="MASS":
+				alloc_type=np.float32 #default to float32 for MASS
+			elif block!=fill_block:
+				print "[error] block : ", block, "of parttype : ", parttype, "not found"
 				sys.stdout.flush()
+				sys.exit()
+			else:
+				alloc_type=np.float64
 
-	#GREG -  allocate array here
-#	if block=="ID  " or block=="NTSC":
-#		alloc_type = np.uint64
-#	else:
-#		alloc_type = np.float64
-
-        # set alloc_type here. read in example item to determine data type. -GREG
-	alloc_type=None
-
-	# need to loop over all files until block is found, or no more files left.
-
-	for subfile in np.arange(filenum):
-		g=hdf5lib.OpenFile(filename+"."+str(subfile)+".hdf5")
-		if parttype==-1:
-			for ptype in range(0,6):
-				try: contains=hdf5lib.Contains(g,'PartType'+str(ptype),block_name)
-				except: contains=False
-				if contains:
-					alloc_type = str(hdf5lib.GetData(g,'PartType'+str(ptype)+'/'+block_name)[0:1].dtype)
-					break
+		if (parttype==-1):
+			length = self.nall.sum()
 		else:
-			try: contains=hdf5lib.Contains(g,'PartType'+str(parttype),block_name)
-			except: contains=False
-			if contains:
-				alloc_type = str(hdf5lib.GetData(g,'PartType'+str(parttype)+'/'+block_name)[0:1].dtype)
-		g.close()
-		if contains==True:
-			break
-		
-
-
-
-	# if block does not exist - GREG
-	if alloc_type==None:
-		if block=="ID  ":
-			alloc_type=np.uint32
-		#else:
-		#	alloc_type=np.float32
-		elif block=="MASS":
-			alloc_type=np.float32 #default to float32 for MASS
-	        else:
-			print "[error] block : ", block, "of parttype : ", parttype, "not found"
+			pieces, length = self.selection(parttype, ids, slab_start, slab_len)
+		if dim2 > 1:
+			ret_val = np.ndarray((length,dim2),alloc_type)
+		else:
+			ret_val = np.ndarray((length,),alloc_type)
+		if (verbose):
+			print "Length of data allocation:", length
 			sys.stdout.flush()
-			sys.exit()
 
- 
-	if dim2 > 1:
-		ret_val = np.ndarray((length,dim2),alloc_type)
-	else:
-		ret_val = np.ndarray((length,),alloc_type)
-	if (verbose):
-		print "Allocated array"
-
-	if (multiple_files):
-		if (slabflag==False and idsflag==False):
-			first=True
-			dim1=long(0)
-			for num in range(0,filenum):
-				curfilename=filename+"."+str(num)+".hdf5"
-				if (verbose):
-					print "Reading file           : ", num, curfilename
-					sys.stdout.flush() 
-				data, succ = read_block_single_file(curfilename, block_name, dim2, parttype, no_mass_replicate, fill_block_name, slab_start, slab_len, verbose)
-				if (succ == True):
-					ret_val[dim1:dim1+len(data)] = data #GREG-assign data here
-					#GREG - no more need for if (first): clause.
-					dim1+=long(data.shape[0])
+		if (parttype==-1):
+			dim1 = 0
+			for num in range(len(self.filenames)):
+				for ptype in range(0,6):
+					n = self.npart[num,ptype]
+					if (n==0) or self.skipped(num, ptype, block_name, no_mass_replicate, fill_block_name):
+						continue
+					ret_val[dim1:dim1+n] = self.read_rows(num, block_name, dim2, ptype, 0, n, fill_block_name)
+					dim1 += n
+			ret_val = ret_val[:dim1]
+		else:
+			for num, start, stop, rows, lo in pieces:
+				data = self.read_rows(num, block_name, dim2, parttype, start, stop, fill_block_name, rows)
 				if (verbose):
-					if (succ):
-						print "Read particles (total) : ", ret_val.shape[0] #GREG - no longer need to divide by dim2. append would flatten array, not now.
-						sys.stdout.flush()
-					else:
-						print "Read particles (total) : none"
-						sys.stdout.flush()
-						
-		#GREG - implementation of reading specified particle positions.
-		if (idsflag==True):
-			dim1=long(0)
-			for num in range(0,filenum):
-				curfilename=filename+"."+str(num)+".hdf5"
-				head = snapshot_header(curfilename)
-				nloc=head.npart[parttype]
-
-				low=ids[0] #GREG first particle to read
-				high=ids[-1] #GREG last particle to read
-
-				if (nloc > low): #GREG - something to read in this file
-					toread = ids[ids<nloc] #GREG - need to get subset of ids still in this file
-                                        if (verbose):
-                                            print "Reading file           : ", num, curfilename
-                                            sys.stdout.flush()
-					data, succ = read_block_single_file(curfilename, block_name, dim2, parttype, no_mass_replicate, fill_block_name, ids=toread, verbose=verbose)
-                                        if (succ == True):
-						ret_val[dim1:dim1+len(data)] = data#GREG-assign data here
-						dim1+=data.shape[0]
-                                        if (verbose):
-                                            if (succ):
-						print "Read particles (total) : ", ret_val.shape[0]#GREG - no longer need to divide by dim2. append would flatten array, not now.
-						sys.stdout.flush()
-                                            else:
-						print "Read particles (total) : none"
-						sys.stdout.flush()
-
-                                ids -= nloc
-				ids = ids[ids>=0] #GREG - only keep particles not yet read
-				if (len(ids)==0 or high<0):
-					break
-
-
-		if (slabflag==True):
-			off=slab_start
-			left=slab_len
-			first=True
-			dim1=long(0)
-			for num in range(0,filenum):
-				curfilename=filename+"."+str(num)+".hdf5"
-				head = snapshot_header(curfilename)
-				nloc=head.npart[parttype]
-				if (nloc > off):
-					start = off
-					if (nloc - off > left):
-						count = left
-					else:
-						count = nloc - off
-					if (verbose):
-						print "Reading file           : ", num, curfilename, start, count
-						sys.stdout.flush()
-					data, succ = read_block_single_file(curfilename, block_name, dim2, parttype, no_mass_replicate, fill_block_name, slab_start=start, slab_len=count, verbose=verbose)
-					if (succ == True):
-						ret_val[dim1:dim1+len(data)] = data#GREG- assign data here
-						dim1+=data.shape[0]
-					if (verbose):
-						if (succ):
-							print "Read particles (total) : ", ret_val.shape[0]#GREG - no longer need to divide by dim2. append would flatten array, not now.
-							sys.stdout.flush()
-						else:
-							print "Read particles (total) : none"
-							sys.stdout.flush()
-
-					left -= count
-					off += count
-				if (left==0):
-					break
-				off -= nloc
-
-
+					print "Reading file           : ", num, self.filenames[num], len(data)
+					sys.stdout.flush()
+				ret_val[lo:lo+len(data)] = data
 		if (verbose):
-			print "all partial files read in"
+			print "Bytes read             : ", self.bytesread-bytesread
+			sys.stdout.flush()
+		return ret_val
+
+	def read_blocks(self, blocks, parttype=-1, ids=-1, slab_start=-1, slab_len=-1, no_mass_replicate=False, verbose=False):
+		"""
+		Several blocks read in a single pass over the subfiles, into preallocated arrays:
+
+		pos, vel, pids = snap.read_blocks(["POS ","VEL ","ID  "], parttype=[1,2])
+
+		@param parttype: a type or a list of types. Particles are grouped by type in the given order;
+		  -1 is every type present, ordered as for read_block(parttype=-1)
+		@param ids, slab_start, slab_len: as for read_block, for a single parttype only
+		@param no_mass_replicate: as for read_block
+		@return: list with one array per block. For -1 or a list of types, the types (and subfiles)
+		  without a block are left out of it as read_block(parttype=-1) does, so blocks can differ in length
+		"""
+		bytesread = self.bytesread
+		multitype = (parttype==-1) or np.iterable(parttype)
+		if (parttype==-1):
+			ptypes = [ptype for ptype in range(0,6) if self.nall[ptype]>0]
+		else:
+			ptypes = [int(ptype) for ptype in np.atleast_1d(parttype)]
+		for ptype in ptypes:
+			if ptype not in [0,1,2,3,4,5]:
+				print "[error] wrong parttype given"
+				sys.stdout.flush()
+				sys.exit()
+		if ((type(ids)!=int) | (slab_start!=-1) | (slab_len!=-1)) and ((parttype==-1) | (len(ptypes)!=1)):
+			print "[error] id list and slabs only supported for a single parttype"
+			sys.stdout.flush()
+			sys.exit()
+		if (type(ids)!=int):
+			ids = self.check_ids(ids, ptypes[0])
+			if ids is None:
+				return
+
+		pieces = []
+		length = 0
+		for ptype in ptypes:
+			ptype_pieces, ptype_length = self.selection(ptype, ids, slab_start, slab_len)
+			pieces += [(num, ptype, start, stop, rows, length+lo) for num, start, stop, rows, lo in ptype_pieces]
+			length += ptype_length
+		if (parttype==-1):
+			pieces.sort(key=lambda piece: piece[:2])
+			lo = 0
+			for i in range(len(pieces)):
+				pieces[i] = pieces[i][:5]+(lo,)
+				lo += pieces[i][3]-pieces[i][2]
+		else:
+			pieces.sort(key=lambda piece: piece[0])
+		lengths = [stop-start if rows is None else len(rows) for num, ptype, start, stop, rows, lo in pieces]
+		layout = sorted(range(len(pieces)), key=lambda i: pieces[i][5])
+
+		outputs = []
+		for block in blocks:
+			if not datablocks.has_key(block):
+				print "[error] Block type ", block, "not known!"
+				sys.stdout.flush()
+				sys.exit()
+			block_name, dim2 = datablocks[block]
+			# where each piece goes in this block's array, closing the gaps of skipped pieces
+			keep = [not (multitype and self.skipped(num, ptype, block_name, no_mass_replicate)) for num, ptype, start, stop, rows, lo in pieces]
+			los = [0]*len(pieces)
+			block_length = 0
+			for i in layout:
+				los[i] = block_length
+				if keep[i]: block_length += lengths[i]
+			present = sorted(set([pieces[i][1] for i in range(len(pieces)) if keep[i]])) if multitype else ptypes
+			alloc_types = [self.dtype(block_name, ptype) for ptype in present]
+			alloc_types = [alloc_type for alloc_type in alloc_types if alloc_type is not None]
+			if len(alloc_types) > 0:
+				alloc_type = np.result_type(*alloc_types)
+			elif block=="ID  ":
+				alloc_type=np.uint32
+			elif block=="MASS":
+				alloc_type=np.float32 #default to float32 for MASS
+			else:
+				print "[error] block : ", block, "of parttype : ", parttype, "not found"
+				sys.stdout.flush()
+				sys.exit()
+			if dim2 > 1:
+				ret_val = np.ndarray((block_length,dim2),alloc_type)
+			else:
+				ret_val = np.ndarray((block_length,),alloc_type)
+			outputs.append((block_name, dim2, keep, los, ret_val))
+		if (verbose):
+			print "Length of data allocation:", length, "x", len(blocks), "blocks"
 			sys.stdout.flush()
 
-		#GREG - no longer need to reshape ret_val. Can delete this code
-		#if ((dim1>0) & (dim2>1)):
-		#	ret_val=ret_val.reshape(dim1,dim2)
-		#	if (verbose):
-		#		print "Reshape done (total): ", ret_val.shape
-		#		sys.stdout.flush()
-
-
-	else:	
-		ret_val, succ = read_block_single_file(curfilename, block_name, dim2, parttype, no_mass_replicate, fill_block_name, slab_start, slab_len, ids, verbose)
+		for i, (num, ptype, start, stop, rows, lo) in enumerate(pieces):
+			if (verbose):
+				print "Reading file           : ", num, self.filenames[num], "parttype", ptype
+				sys.stdout.flush()
+			for block_name, dim2, keep, los, ret_val in outputs:
+				if not keep[i]:
+					continue
+				data = self.read_rows(num, block_name, dim2, ptype, start, stop, rows=rows)
+				ret_val[los[i]:los[i]+len(data)] = data
+		if (verbose):
+			print "Bytes read             : ", self.bytesread-bytesread
+			sys.stdout.flush()
+		return [ret_val for block_name, dim2, keep, los, ret_val in outputs]
+
+	def idindex(self, parttype=1):
+		"""
+		@return: snapshot_idindex of parttype; the one saved by make_idindex if it is up to date,
+		  otherwise one built in memory from the ID block (kept as long as this object)
+		"""
+		if not self._idindex.has_key(parttype):
+			index = load_idindex(self, parttype)
+			if index is None:
+				index = build_idindex(self.read_block("ID  ", parttype))
+			self._idindex[parttype] = index
+		return self._idindex[parttype]
+
+	def rows_of_ids(self, partids, parttype=1):
+		"""
+		@return: index of each particle ID among the particles of parttype.
+		  Sorted snapshots are indexed by particle ID directly, as read_block(ids=...) always assumed
+		"""
+		partids = np.asarray(partids, dtype=np.int64)
+		if (self.sorted_ids):
+			return partids
+		rows = self.idindex(parttype).lookup(partids)
+		if (np.any(rows < 0)):
+			print "[error] particle IDs not found in parttype ", parttype, ": ", partids[rows < 0][:10]
+			sys.stdout.flush()
+			sys.exit()
+		return rows
+
+	def read_blocks_by_id(self, blocks, partids, parttype=1, verbose=False):
+		"""
+		Blocks of the particles with IDs partids (any order, e.g. halo particles from a halo
+		catalogue), whether the snapshot is sorted by ID or not
+		@return: list with one array per block, in the order of partids
+		"""
+		rows = self.rows_of_ids(partids, parttype)
+		order = np.argsort(rows, kind='mergesort')
+		outputs = []
+		for data in self.read_blocks(blocks, parttype, ids=rows[order], verbose=verbose):
+			ret_val = np.ndarray(data.shape, data.dtype)
+			ret_val[order] = data
+			outputs.append(ret_val)
+		return outputs
+
+	def check_ids(self, ids, parttype):
+		"""
+		@return: ids as int64 array, or None (after printing an error) if they are not sorted
+		"""
+		ids = np.array(ids, dtype=np.int64)
+		if (np.any(ids[1:] < ids[:-1])):
+			print "[error] input ids not sorted. must be in order!"
+			return None
+		if (len(ids) > 0) and ((ids[0] < 0) | (ids[-1] >= self.nall[parttype])):
+			print "[error] ids out of range for parttype : ", parttype
+			sys.stdout.flush()
+			sys.exit()
+		return ids
+
+	def selection(self, parttype, ids=-1, slab_start=-1, slab_len=-1):
+		"""
+		Splits a selection of the particles of one type over the subfiles.
+		@param ids: sorted indices into the particles of parttype (default: all of them)
+		@return: pieces, length. Piece (num, start, stop, rows, lo) is rows start:stop of subfile num
+		  (start+rows if rows is not None) and goes to lo: of the result
+		"""
+		slabflag = ((slab_start!=-1) | (slab_len!=-1))
+		if (type(ids)!=int):
+			length = len(ids)
+			bounds = np.searchsorted(ids, self.offsets[:,parttype])
+		elif (slabflag):
+			length = max(0, min(slab_len, self.nall[parttype]-slab_start))
+			bounds = np.clip(self.offsets[:,parttype]-slab_start, 0, length)
+		else:
+			length = self.nall[parttype]
+			bounds = self.offsets[:,parttype]
+		pieces = []
+		for num in np.nonzero(bounds[1:] > bounds[:-1])[0]:
+			lo = bounds[num]; hi = bounds[num+1]
+			if (type(ids)!=int):
+				pieces.append((num, 0, self.npart[num,parttype], ids[lo:hi]-self.offsets[num,parttype], lo))
+			else:
+				start = lo-self.offsets[num,parttype]+(slab_start if (slabflag) else 0)
+				pieces.append((num, start, start+hi-lo, None, lo))
+		return pieces, length
 
-	return ret_val
+##############
+#READ ROUTINE#
+##############
+def read_block(filename, block, parttype=-1, no_mass_replicate=False, fill_block="", slab_start=-1, slab_len=-1,ids=-1, verbose=False): #GREG - added ids as a parameter
+	"""
+	filename can also be an already opened snapshot, whose handles are then reused
+	"""
+	if isinstance(filename, snapshot):
+		return filename.read_block(block, parttype, no_mass_replicate, fill_block, slab_start, slab_len, ids, verbose)
+	snap = snapshot(filename, verbose)
+	try:
+		return snap.read_block(block, parttype, no_mass_replicate, fill_block, slab_start, slab_len, ids, verbose)
+	finally:
+		snap.close()
+
+def read_blocks(filename, blocks, parttype=-1, ids=-1, slab_start=-1, slab_len=-1, no_mass_replicate=False, verbose=False):
+	"""
+	Several blocks in one pass over the subfiles, see snapshot.read_blocks
+	pos, vel, pids = read_blocks("snap_063", ["POS ","VEL ","ID  "], parttype=1)
+	"""
+	if isinstance(filename, snapshot):
+		return filename.read_blocks(blocks, parttype, ids, slab_start, slab_len, no_mass_replicate, verbose)
+	snap = snapshot(filename, verbose)
+	try:
+		return snap.read_blocks(blocks, parttype, ids, slab_start, slab_len, no_mass_replicate, verbose)
+	finally:
+		snap.close()
+
+def read_blocks_by_id(filename, blocks, partids, parttype=1, verbose=False):
+	"""
+	Blocks of the particles with IDs partids, in the order of partids, see snapshot.read_blocks_by_id
+	"""
+	if isinstance(filename, snapshot):
+		return filename.read_blocks_by_id(blocks, partids, parttype, verbose)
+	snap = snapshot(filename, verbose)
+	try:
+		return snap.read_blocks_by_id(blocks, partids, parttype, verbose)
+	finally:
+		snap.close()
+
+
+########################################
+#PARTICLE ID -> SNAPSHOT INDEX TABLES#
+########################################
+class snapshot_idindex:
+	"""
+	Maps the particle IDs of one particle type to their index in the snapshot.
+	Dense IDs use a direct-address table (table[id-minid] = index, -1 for unused IDs),
+	otherwise the sorted IDs are kept together with the permutation that sorts them.
+	"""
+	def __init__(self, minid=0, table=None, ids=None, order=None):
+		self.minid = minid
+		self.table = table
+		self.ids = ids
+		self.order = order
+
+	def __len__(self):
+		if self.table is not None:
+			return int(np.sum(self.table >= 0))
+		return len(self.ids)
+
+	def lookup(self, partids):
+		"""
+		@return: index of each ID in partids, -1 if there is no particle with that ID
+		"""
+		partids = np.asarray(partids, dtype=np.int64)
+		rows = -np.ones(partids.shape, dtype=np.int64)
+		if self.table is not None:
+			rel = partids-self.minid
+			found = (rel >= 0) & (rel < len(self.table))
+			rows[found] = self.table[rel[found]]
+		else:
+			ii = np.searchsorted(self.ids, partids)
+			found = ii < len(self.ids)
+			found[found] = self.ids[ii[found]]==partids[found]
+			rows[found] = self.order[ii[found]]
+		return rows
+
+def build_idindex(ids, maxfill=2.):
+	"""
+	@param ids: ID block of one particle type
+	@param maxfill: use a direct-address table if it has at most maxfill entries per particle
+	@return: snapshot_idindex
+	"""
+	ids = np.asarray(ids, dtype=np.int64)
+	rowtype = np.int32 if len(ids) < 2**31 else np.int64
+	if len(ids)==0:
+		return snapshot_idindex(ids=ids, order=np.zeros(0, dtype=rowtype))
+	minid = ids.min()
+	span = ids.max()-minid+1
+	if span <= maxfill*len(ids):
+		table = -np.ones(span, dtype=rowtype)
+		table[ids-minid] = np.arange(len(ids), dtype=rowtype)
+		return snapshot_idindex(minid=minid, table=table)
+	order = np.argsort(ids, kind='mergesort').astype(rowtype)
+	return snapshot_idindex(ids=ids[order], order=order)
+
+def idindex_path(filename, parttype=1):
+	""" Directory holding the saved ID index of parttype next to the snapshot files """
+	return filename+".idindex"+str(parttype)
+
+def _file_stamps(filenames):
+	return [(os.path.getmtime(name), os.path.getsize(name)) for name in filenames]
+
+def make_idindex(filename, parttype=1, maxfill=2., recalc=False):
+	"""
+	Builds and saves the particle ID -> index table of one snapshot (see snapshot_idindex).
+	Run once per unsorted snapshot; snapshot.read_blocks_by_id then memory-maps it.
+	@param filename: snapshot base name or open snapshot
+	@return: directory of the index
+	"""
+	snap = filename if isinstance(filename, snapshot) else snapshot(filename)
+	path = idindex_path(snap.filename, parttype)
+	try:
+		if (recalc==False) and (load_idindex(snap, parttype) is not None):
+			return path
+		index = build_idindex(snap.read_block("ID  ", parttype), maxfill)
+		tmppath = path+".tmp"+str(os.getpid())
+		if not os.path.exists(tmppath):
+			os.makedirs(tmppath)
+		for name in ["table", "ids", "order"]:
+			if getattr(index, name) is not None:
+				np.save(tmppath+"/"+name+".npy", getattr(index, name))
+		with open(tmppath+"/meta.p", "wb") as f:
+			pickle.dump({"stamps":_file_stamps(snap.filenames), "minid":index.minid}, f, pickle.HIGHEST_PROTOCOL)
+		if os.path.exists(path):
+			shutil.rmtree(path)
+		os.rename(tmppath, path)
+	finally:
+		if snap is not filename:
+			snap.close()
+	return path
+
+def load_idindex(filename, parttype=1, mmap_mode='r'):
+	"""
+	@param filename: snapshot base name or open snapshot
+	@return: memory-mapped snapshot_idindex saved by make_idindex,
+	  None if there is none or the snapshot files changed since
+	"""
+	snap = filename if isinstance(filename, snapshot) else snapshot(filename)
+	if snap is not filename:
+		snap.close()
+	path = idindex_path(snap.filename, parttype)
+	try:
+		with open(path+"/meta.p", "rb") as f:
+			meta = pickle.load(f)
+	except (IOError, EOFError, pickle.UnpicklingError):
+		return None
+	if meta["stamps"] != _file_stamps(snap.filenames):
+		return None
+	arrays = {}
+	for name in ["table", "ids", "order"]:
+		if os.path.exists(path+"/"+name+".npy"):
+			arrays[name] = np.load(path+"/"+name+".npy", mmap_mode=mmap_mode)
+	return snapshot_idindex(minid=meta["minid"], **arrays)
 
 
 #############